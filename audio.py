@@ -0,0 +1,231 @@
+import hashlib
+import struct
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+CHUNK_SIZE = 1024 * 1024
+
+# Chunks that carry audio data and format, everything else (LIST, id3, ...) is metadata
+RIFF_AUDIO_CHUNKS = {b'fmt ', b'data'}
+AIFF_AUDIO_CHUNKS = {b'COMM', b'SSND'}
+
+OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+# Start of the first packet in an Ogg stream for each codec
+OGG_CODECS = {
+    b'\x7fFLAC': 'flac',
+    b'\x01vorbis': 'vorbis',
+    b'OpusHead': 'opus',
+    b'Speex   ': 'speex',
+}
+
+# Enough for the container header and the first Ogg page up to its first packet
+PROBE_SIZE = 512
+# Read from the end of an Ogg file to find its last page, which has the granule position of the last sample
+OGG_TAIL_SIZE = 64 * 1024
+# Granule positions of Opus streams count samples at 48 kHz, whatever the input rate was
+OPUS_GRANULE_RATE = 48000
+
+
+def fingerprint(path: str) -> str:
+    """
+    Hashes the audio payload of a file, leaving out metadata where the container format is known,
+    so retagging a file doesn't change its fingerprint.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for data in payload(f):
+            h.update(data)
+    return h.hexdigest()
+
+
+def probe(path: str) -> Optional[str]:
+    """
+    Detects the codec of a file from its first bytes: wav, aiff, flac (also in Ogg), vorbis, opus or speex.
+    Returns None for anything else.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(PROBE_SIZE)
+
+    if header[:4] == b'fLaC':
+        return 'flac'
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return 'wav'
+    if header[:4] == b'FORM' and header[8:12] in (b'AIFF', b'AIFC'):
+        return 'aiff'
+    if header[:4] == b'OggS' and len(header) >= OGG_PAGE_HEADER.size:
+        segments = header[OGG_PAGE_HEADER.size - 1]
+        packet = header[OGG_PAGE_HEADER.size + segments:]
+        for magic, codec in OGG_CODECS.items():
+            if packet.startswith(magic):
+                return codec
+    return None
+
+
+def duration(path: str) -> Optional[float]:
+    """
+    Reads the duration in seconds from the headers of a wav, aiff, flac or Ogg (FLAC, Vorbis, Opus) file, without
+    reading the audio. Returns None for other formats and headers that don't tell.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(12)
+        f.seek(0)
+        if magic[:4] == b'fLaC':
+            return flac_duration(f)
+        if magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+            return wav_duration(f)
+        if magic[:4] == b'FORM' and magic[8:12] in (b'AIFF', b'AIFC'):
+            return aiff_duration(f)
+        if magic[:4] == b'OggS':
+            return ogg_duration(f)
+    return None
+
+
+def flac_duration(f: BinaryIO) -> Optional[float]:
+    f.seek(4)
+    header = f.read(4)
+    if len(header) < 4 or header[0] & 0x7f != 0:
+        # STREAMINFO is always the first metadata block
+        return None
+    return streaminfo_duration(f.read(int.from_bytes(header[1:], 'big')))
+
+
+def streaminfo_duration(streaminfo: bytes) -> Optional[float]:
+    if len(streaminfo) < 18:
+        return None
+    # 20 bits sample rate, 3 bits channels, 5 bits bits per sample, 36 bits total samples (0 if unknown)
+    bits = int.from_bytes(streaminfo[10:18], 'big')
+    rate = bits >> 44
+    samples = bits & 0xfffffffff
+    return samples / rate if rate and samples else None
+
+
+def wav_duration(f: BinaryIO) -> Optional[float]:
+    byte_rate = None
+    for chunk_id, length in iff_chunks(f, '<'):
+        if chunk_id == b'fmt ':
+            _, _, _, byte_rate = struct.unpack('<HHII', f.read(12))
+        elif chunk_id == b'data':
+            return length / byte_rate if byte_rate else None
+    return None
+
+
+def aiff_duration(f: BinaryIO) -> Optional[float]:
+    for chunk_id, length in iff_chunks(f, '>'):
+        if chunk_id == b'COMM':
+            _, frames, _, exponent, mantissa = struct.unpack('>HIHHQ', f.read(18))
+            # 80 bit extended precision float
+            rate = mantissa * 2.0 ** ((exponent & 0x7fff) - 16383 - 63)
+            return frames / rate if rate else None
+    return None
+
+
+def ogg_duration(f: BinaryIO) -> Optional[float]:
+    header = f.read(PROBE_SIZE)
+    if len(header) < OGG_PAGE_HEADER.size:
+        return None
+    segments = header[OGG_PAGE_HEADER.size - 1]
+    packet = header[OGG_PAGE_HEADER.size + segments:]
+    if packet.startswith(b'\x7fFLAC'):
+        # Mapping version, header count, 'fLaC' and the STREAMINFO block header come before STREAMINFO
+        rate = int.from_bytes(packet[27:30], 'big') >> 4
+    elif packet.startswith(b'\x01vorbis'):
+        rate = int.from_bytes(packet[12:16], 'little')
+    elif packet.startswith(b'OpusHead'):
+        rate = OPUS_GRANULE_RATE
+    else:
+        return None
+
+    f.seek(0, 2)
+    f.seek(max(0, f.tell() - OGG_TAIL_SIZE))
+    tail = f.read()
+    last_page = tail.rfind(b'OggS')
+    if last_page < 0 or len(tail) - last_page < OGG_PAGE_HEADER.size:
+        return None
+    granule = OGG_PAGE_HEADER.unpack_from(tail, last_page)[3]
+    return granule / rate if rate and granule > 0 else None
+
+
+def payload(f: BinaryIO) -> Iterator[bytes]:
+    magic = f.read(12)
+    f.seek(0)
+
+    if magic[:4] == b'fLaC':
+        return flac_payload(f)
+    if magic[:4] == b'RIFF' and magic[8:12] == b'WAVE':
+        return iff_payload(f, '<', RIFF_AUDIO_CHUNKS)
+    if magic[:4] == b'FORM' and magic[8:12] in (b'AIFF', b'AIFC'):
+        return iff_payload(f, '>', AIFF_AUDIO_CHUNKS)
+    if magic[:4] == b'OggS':
+        return ogg_payload(f)
+    return read_chunks(f)
+
+
+def read_chunks(f: BinaryIO, length: int = -1) -> Iterator[bytes]:
+    while length != 0:
+        data = f.read(CHUNK_SIZE if length < 0 else min(length, CHUNK_SIZE))
+        if not data:
+            return
+        length -= len(data) if length > 0 else 0
+        yield data
+
+
+def flac_payload(f: BinaryIO) -> Iterator[bytes]:
+    f.seek(4)
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+        last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7f
+        length = int.from_bytes(header[1:], 'big')
+        if block_type == 0:
+            # STREAMINFO describes the audio, the other blocks are tags, pictures, padding etc.
+            yield f.read(length)
+        else:
+            f.seek(length, 1)
+    yield from read_chunks(f)
+
+
+def iff_chunks(f: BinaryIO, byte_order: str) -> Iterator[Tuple[bytes, int]]:
+    header_format = struct.Struct(byte_order + '4sI')
+    f.seek(12)
+    while True:
+        header = f.read(header_format.size)
+        if len(header) < header_format.size:
+            return
+        chunk_id, length = header_format.unpack(header)
+        start = f.tell()
+        yield chunk_id, length
+        # Chunks are padded to an even length
+        f.seek(start + length + (length & 1))
+
+
+def iff_payload(f: BinaryIO, byte_order: str, audio_chunks: set) -> Iterator[bytes]:
+    for chunk_id, length in iff_chunks(f, byte_order):
+        if chunk_id in audio_chunks:
+            yield chunk_id
+            yield from read_chunks(f, length)
+
+
+def ogg_pages(f: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """
+    Yields (granule position, body length) of every page, leaving f at the start of the page body.
+    """
+    while True:
+        header = f.read(OGG_PAGE_HEADER.size)
+        if len(header) < OGG_PAGE_HEADER.size or header[:4] != b'OggS':
+            return
+        _, _, _, granule, _, _, _, segments = OGG_PAGE_HEADER.unpack(header)
+        length = sum(f.read(segments))
+        start = f.tell()
+        yield granule, length
+        f.seek(start + length)
+
+
+def ogg_payload(f: BinaryIO) -> Iterator[bytes]:
+    # Header pages (identification, comments, setup) have granule position 0. Page headers are skipped as well,
+    # their sequence numbers and checksums change when the comment pages grow or shrink.
+    for granule, length in ogg_pages(f):
+        if granule != 0:
+            yield from read_chunks(f, length)
@@ -1,49 +1,149 @@
-import itertools
 import sys
 
-import configargparse
-import difflib
+import json
 import os
-from typing import List, Set
+from typing import Dict, Iterator, List, NamedTuple, Set
 
+import scan
+import to_opus
 
-def structure(directory: str, ignored_files: Set) -> List[str]:
-    s = []
-    for parent, dirs, files in sorted(os.walk(directory)):
-        for file in sorted(files):
+FORMATS = ['diff', 'json', 'nul']
+
+
+class Diff(NamedTuple):
+    # Relative paths in from_dir without their output in to_dir, see outputs
+    missing: List[str]
+    # Relative paths in to_dir that aren't the output of any file in from_dir
+    orphaned: List[str]
+    # Relative paths in from_dir that were modified after their outputs in to_dir
+    stale: List[str]
+
+    def __bool__(self) -> bool:
+        return bool(self.missing or self.orphaned or self.stale)
+
+
+def structure(directory: str, ignored_files: Set, threads: int = scan.SCAN_THREADS) -> List[str]:
+    return list(iter_structure(directory, ignored_files, threads))
+
+
+def iter_structure(directory: str, ignored_files: Set, threads: int = scan.SCAN_THREADS) -> Iterator[str]:
+    """
+    Yields the relative paths without extension of all files below directory, sorted by directory and name.
+    """
+    if not os.path.isdir(directory):
+        return
+
+    for listing in scan.iter_dirs(directory, stat=False, threads=threads, ordered=True):
+        for file, _ in listing.files:
             file_base, src_ext = os.path.splitext(file)
 
-            if os.path.basename(file) not in ignored_files:
-                s.append(os.path.relpath(parent + os.sep + file_base, directory))
-    return s
+            if file not in ignored_files:
+                yield scan.join(listing.rel_dir, file_base)
+
+
+def bases(index: scan.Index, ignored_files: Set) -> Dict[str, List[str]]:
+    """
+    Returns the extensions of the files in index by base name, without the ignored files.
+    """
+    result = {}
+    for rel_base, exts in index.files.items():
+        name = os.path.basename(rel_base)
+        kept = [ext for ext in exts if name + ext not in ignored_files]
+        if kept:
+            result[rel_base] = kept
+    return result
+
+
+def outputs(ext: str) -> List[str]:
+    """
+    Returns the extensions the output of a file with ext may have. Convertible files end up as .opus, or keep their
+    extension if they were copied (lossy sources, fallback copies). Everything else is copied as is.
+    """
+    return ['.opus', ext] if ext in to_opus.SOURCE_EXTENSIONS else [ext]
+
+
+def compare(from_dir: str, to_dir: str, ignored_files: Set, stale: bool = False,
+            threads: int = scan.SCAN_THREADS) -> Diff:
+    """
+    Looks up the output of every file in from_dir by base name (path without extension) and extension, which takes
+    linear time and memory unlike a sequence diff. So a missing sidecar (e.g. lyrics next to a track) is reported
+    even if other files of the same base name were migrated. With stale the modification times of the files and
+    their outputs are compared too.
+    """
+    from_index = scan.scan(from_dir, stat=stale, threads=threads)
+    to_index = scan.scan(to_dir, stat=stale, threads=threads)
+    from_bases = bases(from_index, ignored_files)
+    to_bases = bases(to_index, ignored_files)
+
+    missing = []
+    outdated = []
+    for rel_base, exts in from_bases.items():
+        found_exts = to_bases.get(rel_base, [])
+        for ext in exts:
+            found = [output for output in outputs(ext) if output in found_exts]
+            if not found:
+                missing.append(rel_base + ext)
+            elif stale and from_index.files[rel_base][ext].st_mtime \
+                    > min(to_index.files[rel_base][output].st_mtime for output in found):
+                outdated.append(rel_base + ext)
+
+    orphaned = []
+    for rel_base, exts in to_bases.items():
+        expected = {output for ext in from_bases.get(rel_base, []) for output in outputs(ext)}
+        orphaned.extend(rel_base + ext for ext in exts if ext not in expected)
+
+    return Diff(sorted(missing), sorted(orphaned), sorted(outdated))
 
 
 def parse_args():
+    import configargparse
+
     p = configargparse.ArgParser()
     p.add_argument('-s', '--from-dir', required=True, help='source dir')
     p.add_argument('-t', '--to-dir', required=True, help='target dir')
     p.add_argument('-i', '--ignore', action='append', default=[], help='files to exclude in the comparison (REGEXP)')
+    p.add_argument('--stale', action='store_true',
+                   help='also report source files that were modified after their counterpart in the target dir')
+    p.add_argument('-f', '--format', choices=FORMATS, default='diff',
+                   help='diff (default) prints missing base names with -, orphaned ones with + and stale ones with !. '
+                        'json prints the relative paths of each kind. '
+                        'nul prints the relative paths of all differences separated by NUL characters, '
+                        'for to_opus.py --files-from')
+    p.add_argument('--scan-threads', metavar='COUNT', type=int, default=scan.SCAN_THREADS,
+                   help='number of directories listed concurrently (default: %(default)s)')
     return p.parse_args()
 
 
-def diff_dirs(from_dir: str, to_dir: str, ignored_files: Set):
-    diff = difflib.unified_diff(structure(from_dir, ignored_files), structure(to_dir, ignored_files), from_dir, to_dir, n=0, lineterm='')
+def print_diff(from_dir: str, to_dir: str, diff: Diff, output_format: str = 'diff', out=sys.stdout) -> None:
+    if output_format == 'json':
+        json.dump({'from': from_dir, 'to': to_dir, **diff._asdict()}, out, indent=2)
+        out.write('\n')
+    elif output_format == 'nul':
+        # Source paths of missing and stale files, target paths of orphaned ones - to_opus handles all of them
+        for rel_path in diff.missing + diff.stale + diff.orphaned:
+            out.write(rel_path + '\0')
+    elif diff:
+        print('--- ' + from_dir, file=out)
+        print('+++ ' + to_dir, file=out)
+        for prefix, rel_paths in [('-', diff.missing), ('+', diff.orphaned), ('!', diff.stale)]:
+            for rel_base in sorted({os.path.splitext(rel_path)[0] for rel_path in rel_paths}):
+                print(prefix + rel_base, file=out)
+
 
-    peek = next(diff, None)
-    if peek is not None:
-        for line in itertools.chain([peek], diff):
-            print(line)
-        return 1
-    return 0
+def diff_dirs(from_dir: str, to_dir: str, ignored_files: Set, threads: int = scan.SCAN_THREADS,
+              stale: bool = False, output_format: str = 'diff') -> int:
+    diff = compare(from_dir, to_dir, ignored_files, stale, threads)
+    print_diff(from_dir, to_dir, diff, output_format)
+    return 1 if diff else 0
 
 
 def main(cfg) -> int:
     if cfg.ignore is not None:
         ignored_files = set(cfg.ignore)
     else:
-        ignored_files = None
+        ignored_files = set()
 
-    return diff_dirs(cfg.from_dir, cfg.to_dir, ignored_files)
+    return diff_dirs(cfg.from_dir, cfg.to_dir, ignored_files, cfg.scan_threads, cfg.stale, cfg.format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+import sys
+
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import scan
+import state
+import to_opus
+
+FORMATS = ['wav', 'flac', 'vorbis', 'jpg']
+EXTENSIONS = {'wav': '.wav', 'flac': '.flac', 'vorbis': '.ogg', 'jpg': '.jpg'}
+
+
+def stub_encode(src: str, dest: str, timeout: Optional[float] = None) -> None:
+    """
+    Stands in for opusenc: reads the whole source and writes an output a tenth of its size.
+    """
+    size = 0
+    with open(src, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            size += len(data)
+    with open(dest, 'wb') as f:
+        f.write(b'OggS' + bytes(size // 10))
+
+
+def header(fmt: str, size: int) -> bytes:
+    """
+    Just enough of each format for the codec detection, the rest of the file is filler.
+    """
+    if fmt == 'wav':
+        return b'RIFF' + struct.pack('<I', size - 8) + b'WAVEfmt ' + struct.pack('<IHHIIHH', 16, 1, 2, 44100,
+                                                                                  176400, 4, 16) \
+               + b'data' + struct.pack('<I', size - 44)
+    if fmt == 'flac':
+        return b'fLaC' + bytes([0x80]) + (34).to_bytes(3, 'big') + bytes(34)
+    if fmt == 'vorbis':
+        return b'OggS' + bytes(22) + bytes([1, 30]) + b'\x01vorbis' + bytes(23)
+    return b'\xff\xd8\xff\xe0'
+
+
+def generate(root: str, files: int, depth: int, file_size: int, formats: List[str], seed: int = 0) -> List[str]:
+    """
+    Creates a synthetic library of albums (directories of 10 tracks) in depth levels of directories,
+    returns the relative paths of all files.
+    """
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(files):
+        album = i // 10
+        rel_dir = os.sep.join('level%d-%d' % (level, album % (level + 3)) for level in range(depth))
+        rel_dir = os.path.join(rel_dir, 'album%d' % album)
+        fmt = formats[rnd.randrange(len(formats))]
+        rel_path = os.path.join(rel_dir, 'track%02d%s' % (i % 10, EXTENSIONS[fmt]))
+
+        os.makedirs(os.path.join(root, rel_dir), exist_ok=True)
+        data = header(fmt, file_size)
+        with open(os.path.join(root, rel_path), 'wb') as f:
+            f.write(data + bytes(max(file_size - len(data), 0)))
+        paths.append(rel_path)
+    return paths
+
+
+class Bench(object):
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.results: Dict[str, Dict] = {}
+
+    def time(self, stage: str, run: Callable[[], Any], files: int, size: int = 0) -> None:
+        """
+        Times one stage, an int returned by the stage overrides the number of files it handled.
+        """
+        start = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - start
+        if isinstance(result, int):
+            files = result
+
+        self.results[stage] = {
+            'seconds': seconds,
+            'files': files,
+            'files_per_s': files / seconds if seconds else None,
+            'mb_per_s': size / 1024 / 1024 / seconds if seconds and size else None,
+        }
+        logging.getLogger('bench').info('%-16s %8.3fs %10.1f files/s', stage, seconds, self.results[stage]['files_per_s'] or 0)
+
+    def migrator(self, source: str, target: str, db: Optional[state.Store]) -> to_opus.Migrator:
+        encoder = 'opusenc' if self.cfg.encoder == 'stub' else self.cfg.encoder
+        mig = to_opus.Migrator(source, target, self.cfg.threads, del_removed=True, db=db, encoder=encoder)
+        if self.cfg.encoder == 'stub':
+            mig.migrations['convert'] = stub_encode
+        return mig
+
+    def run(self, tmp_dir: str) -> Dict[str, Dict]:
+        cfg = self.cfg
+        source = os.path.join(tmp_dir, 'source')
+        target = os.path.join(tmp_dir, 'target')
+        formats = cfg.formats.split(',')
+
+        paths = generate(source, cfg.files, cfg.depth, cfg.file_size, formats)
+        total_size = cfg.files * cfg.file_size
+
+        # Encode everything once with an empty db, which also gives the db and the target of a converted library
+        db = state.open_store(os.path.join(tmp_dir, 'db.sqlite'))
+        mig = self.migrator(source, target, db)
+        plan = mig.plan()
+        self.time('encode', lambda: mig.execute(plan), cfg.files, total_size)
+
+        # Mix in fresh files and orphaned outputs
+        converted = int(cfg.files * cfg.converted)
+        for rel_path in paths[converted:]:
+            os.utime(os.path.join(source, rel_path), None)
+            db.pop(os.path.splitext(rel_path)[0], None)
+        for rel_path in paths[:cfg.orphans]:
+            open(os.path.join(target, rel_path + '.orphan'), 'w').close()
+
+        self.time('scan', lambda: len(scan.scan(source)) + len(scan.scan(target, stat=False)), 0)
+
+        mig = self.migrator(source, target, db)
+        source_index = scan.scan(source)
+        mig.target_index = scan.scan(target, stat=False)
+
+        def decide() -> int:
+            for rel_base, ext, src_stat in source_index.entries():
+                mig.plan_file(rel_base, ext, src_stat)
+            return len(source_index)
+        self.time('needs_migration', decide, 0)
+
+        mig = self.migrator(source, target, db)
+        self.time('plan', mig.plan, cfg.files)
+        self.time('delete_removed', lambda: mig.delete_removed(), cfg.orphans)
+        db.close()
+
+        for backend in ['json', 'sqlite']:
+            self.time('db_' + backend, lambda: self.checkpoint(os.path.join(tmp_dir, 'bench.' + backend), backend),
+                      cfg.files)
+
+        return self.results
+
+    def checkpoint(self, path: str, backend: str) -> None:
+        """
+        Records every file like a run does, with the db's own checkpointing.
+        """
+        store = state.open_store(path, backend)
+        for i in range(self.cfg.files):
+            store['album%d/track%d' % (i // 10, i % 10)] = {'size': i, 'last_modified': i, 'inode': i}
+        store.close()
+
+
+def parse_args():
+    import configargparse
+
+    p = configargparse.ArgParser(description='benchmarks the stages of a migration on a generated library')
+    p.add_argument('-n', '--files', type=int, default=1000, help='number of files in the generated library')
+    p.add_argument('-d', '--depth', type=int, default=2, help='directory levels above each album')
+    p.add_argument('--file-size', type=int, default=64 * 1024, help='size of each generated file in bytes')
+    p.add_argument('-f', '--formats', default=','.join(FORMATS),
+                   help='comma separated formats of the generated files, out of ' + ', '.join(FORMATS))
+    p.add_argument('--converted', type=float, default=0.9,
+                   help='fraction of the library that is already converted and unchanged')
+    p.add_argument('--orphans', type=int, default=100, help='number of outputs without a source')
+    p.add_argument('-thr', '--threads', type=int, default=8, help='thread count for parallel processing')
+    p.add_argument('-e', '--encoder', choices=['stub'] + to_opus.encoders.ENCODERS, default='stub',
+                   help='stub (default) only copies data around and needs no opusenc')
+    p.add_argument('-o', '--output', help='write the results as JSON to this file instead of stdout')
+    p.add_argument('--dir', help='directory to generate the library in (default: a temporary directory)')
+    return p.parse_args()
+
+
+def main(cfg) -> int:
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(levelname)-8s %(message)s', level=logging.WARNING,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('bench').setLevel(logging.INFO)
+
+    tmp_dir = tempfile.mkdtemp(dir=cfg.dir)
+    try:
+        results = Bench(cfg).run(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    output = json.dumps({'config': vars(cfg), 'stages': results}, indent=2)
+    if cfg.output is None:
+        print(output)
+    else:
+        with open(cfg.output, 'w') as f:
+            f.write(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
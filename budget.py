@@ -0,0 +1,109 @@
+import heapq
+import re
+from typing import Dict, List, NamedTuple, Optional
+
+# Bitrates (kbit/s) a directory is encoded with in budget mode. Coarse steps, so a few albums more or less rarely
+# change the bitrate of the others, and so the library isn't re-encoded for every small change.
+BITRATES = [32, 48, 64, 80, 96, 112, 128, 160, 192, 256]
+# Share of the target size the outputs are planned to fill. opusenc's bitrate is an average, some files end up larger
+HEADROOM = 0.97
+# Per output: Opus and Ogg headers, tags (cover art copied from the source isn't accounted for)
+FILE_OVERHEAD = 4096
+# Ogg page headers, relative to the audio data
+CONTAINER_OVERHEAD = 1.01
+
+SIZE_UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4}
+
+
+class Album(NamedTuple):
+    """
+    The converted files of a directory, which are all encoded with the same bitrate.
+    """
+    seconds: float
+    files: int
+    # The bitrate most of its outputs were encoded with, None if they weren't yet
+    bitrate: Optional[int] = None
+
+    def size(self, bitrate: int) -> float:
+        return self.seconds * bitrate * 1000 / 8 * CONTAINER_OVERHEAD + self.files * FILE_OVERHEAD
+
+
+def parse_size(text: str) -> int:
+    """
+    Parses a size like '64G', '500M' or '1.5TB' into bytes. Units are powers of 1000, like the capacity of phones
+    and memory cards is given.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError('invalid size: ' + text)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def with_bitrate(args: List[str], bitrate: int) -> List[str]:
+    """
+    Returns opusenc arguments with the given bitrate instead of the one in args (if any).
+    """
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif str(arg).strip() == '--bitrate':
+            skip = True
+        elif not str(arg).strip().startswith('--bitrate='):
+            result.append(arg)
+    return result + ['--bitrate', str(bitrate)]
+
+
+def uniform_bitrate(albums: Dict[str, Album], size: float) -> int:
+    """
+    Returns the highest bitrate all albums fit into size with, the lowest if they don't fit at all.
+    """
+    fitting = [bitrate for bitrate in BITRATES if sum(album.size(bitrate) for album in albums.values()) <= size]
+    return fitting[-1] if fitting else BITRATES[0]
+
+
+def assign(albums: Dict[str, Album], size: float) -> Dict[str, int]:
+    """
+    Picks a bitrate for each album (by directory) so that all of them fit into size, changing as few of the
+    bitrates they were encoded with before as possible:
+    - new albums get the highest bitrate all albums would fit with (the uniform bitrate), encoded albums keep theirs
+    - while they don't fit, the new albums with the highest bitrate (the longest first) go down a step, then the
+      encoded ones
+    - while there is room, new albums below the uniform bitrate and encoded ones two or more steps below it (the
+      shortest first) go up a step
+    So the library stays close to the uniform bitrate, without re-encoding everything whenever it changes a little.
+    """
+    uniform = BITRATES.index(uniform_bitrate(albums, size))
+    encoded = {rel_dir for rel_dir, album in albums.items() if album.bitrate in BITRATES}
+    steps = {rel_dir: BITRATES.index(album.bitrate) if rel_dir in encoded else uniform
+             for rel_dir, album in albums.items()}
+    total = sum(album.size(BITRATES[steps[rel_dir]]) for rel_dir, album in albums.items())
+
+    higher = [(rel_dir in encoded, -step, -albums[rel_dir].seconds, rel_dir)
+              for rel_dir, step in steps.items() if step > 0]
+    heapq.heapify(higher)
+    while total > size and higher:
+        _, _, _, rel_dir = heapq.heappop(higher)
+        album, step = albums[rel_dir], steps[rel_dir]
+        total -= album.size(BITRATES[step]) - album.size(BITRATES[step - 1])
+        steps[rel_dir] = step - 1
+        if step - 1 > 0:
+            heapq.heappush(higher, (rel_dir in encoded, -(step - 1), -album.seconds, rel_dir))
+
+    lower = [(step, albums[rel_dir].seconds, rel_dir) for rel_dir, step in steps.items()
+             if step < (uniform - 1 if rel_dir in encoded else uniform)]
+    heapq.heapify(lower)
+    while lower:
+        _, _, rel_dir = heapq.heappop(lower)
+        album, step = albums[rel_dir], steps[rel_dir]
+        growth = album.size(BITRATES[step + 1]) - album.size(BITRATES[step])
+        if total + growth > size:
+            # Longer albums at this step don't fit either, shorter ones at a higher step might
+            continue
+        total += growth
+        steps[rel_dir] = step + 1
+        if step + 1 < uniform:
+            heapq.heappush(lower, (step + 1, album.seconds, rel_dir))
+
+    return {rel_dir: BITRATES[step] for rel_dir, step in steps.items()}
@@ -0,0 +1,297 @@
+import sys
+
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from functools import partial
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import scheduler
+import worker
+
+# Coordinator and workers only talk to hosts that know this key, it's sent as HMAC challenges and never in plain text.
+# Tasks are pickled, so anyone with the key can run code on the workers.
+AUTHKEY_ENV = 'TO_OPUS_AUTHKEY'
+# Seconds a worker keeps trying to reach the coordinator, which might not be listening yet
+CONNECT_TIMEOUT = 60
+CONNECT_INTERVAL = 0.5
+
+
+class Task(NamedTuple):
+    func: Callable
+    args: Tuple
+    callback: Optional[Callable[[Any], None]]
+    error_callback: Optional[Callable[[BaseException], None]]
+
+
+def parse_address(address: str, default_host: str = 'localhost') -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or default_host, int(port)
+
+
+class Coordinator(object):
+    """
+    Hands tasks to workers on other hosts (see work), with the interface of the multiprocessing pools the lanes use.
+    Every connection is a worker slot that runs one task at a time and takes the next one when it's done, in the
+    order they were submitted. The task of a slot that disconnects goes to the next free one, so workers may come
+    and go during a run.
+    """
+
+    def __init__(self, address: Tuple[str, int], authkey: bytes, setup: Tuple):
+        self.logger = logging.getLogger('coordinator')
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        # Arguments of worker.init_worker, sent to every worker
+        self.setup = setup
+
+        self.condition = threading.Condition()
+        self.tasks: Deque[Task] = deque()
+        # Tasks submitted and not finished, including the ones running
+        self.unfinished = 0
+        self.slots = 0
+        self.stopped = False
+        # Callbacks are run one at a time, like by the result thread of a pool
+        self.callback_lock = threading.Lock()
+
+        self.acceptor = threading.Thread(target=self.accept, name='coordinator', daemon=True)
+        self.acceptor.start()
+        self.logger.info('waiting for workers on %s:%d', *self.address)
+
+    def apply_async(self, func: Callable, args: Tuple = (), callback: Optional[Callable[[Any], None]] = None,
+                    error_callback: Optional[Callable[[BaseException], None]] = None) -> None:
+        with self.condition:
+            self.tasks.append(Task(func, args, callback, error_callback))
+            self.unfinished += 1
+            self.condition.notify()
+
+    def close(self) -> None:
+        # Like Pool.close, no more tasks are submitted. The workers are sent home by join, once all are finished.
+        pass
+
+    def join(self) -> None:
+        """
+        Waits until all tasks are finished, then sends the workers home.
+        """
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+            self.stopped = True
+            self.condition.notify_all()
+        # accept doesn't return when the listener is closed, a connection of our own wakes it up
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+        self.acceptor.join()
+        self.listener.close()
+
+    def accept(self) -> None:
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                if self.stopped:
+                    return
+                self.logger.warning('rejected a connection: %s', e)
+                continue
+            if self.stopped:
+                connection.close()
+                return
+            threading.Thread(target=self.serve, args=(connection,), name='coordinator-slot', daemon=True).start()
+
+    def serve(self, connection: Connection) -> None:
+        with connection:
+            try:
+                name = connection.recv()
+                connection.send(self.setup)
+            except (OSError, EOFError):
+                return
+            with self.condition:
+                self.slots += 1
+            self.logger.info('worker slot on %s connected, %d slots', name, self.slots)
+            try:
+                self.run_tasks(connection, name)
+            finally:
+                with self.condition:
+                    self.slots -= 1
+
+    def run_tasks(self, connection: Connection, name: str) -> None:
+        while True:
+            task = self.next_task()
+            try:
+                if task is None:
+                    connection.send(None)
+                    return
+                connection.send((task.func, task.args))
+                succeeded, result = connection.recv()
+            except (OSError, EOFError) as e:
+                if task is not None:
+                    self.logger.warning('lost worker slot on %s: %s', name, e or 'connection closed')
+                    with self.condition:
+                        self.tasks.appendleft(task)
+                        self.condition.notify()
+                return
+            self.finish(task, succeeded, result)
+
+    def next_task(self) -> Optional[Task]:
+        with self.condition:
+            while not self.tasks and not self.stopped:
+                self.condition.wait()
+            return self.tasks.popleft() if self.tasks else None
+
+    def finish(self, task: Task, succeeded: bool, result: Any) -> None:
+        try:
+            with self.callback_lock:
+                if succeeded and task.callback is not None:
+                    task.callback(result)
+                elif not succeeded and task.error_callback is not None:
+                    task.error_callback(result)
+        finally:
+            with self.condition:
+                self.unfinished -= 1
+                self.condition.notify_all()
+
+
+def localize(value: Any, mapping: Dict[str, str]) -> Any:
+    """
+    Replaces the coordinator's paths in the arguments of a task by the paths of the same directories on this host.
+    """
+    if isinstance(value, str):
+        for remote, local in mapping.items():
+            if value == remote or value.startswith(remote.rstrip('/') + '/'):
+                return local.rstrip('/') + value[len(remote.rstrip('/')):]
+        return value
+    if isinstance(value, partial):
+        return partial(localize(value.func, mapping), *localize(value.args, mapping),
+                       **localize(value.keywords, mapping))
+    if isinstance(value, (list, tuple)):
+        return type(value)(localize(item, mapping) for item in value)
+    if isinstance(value, dict):
+        return {key: localize(item, mapping) for key, item in value.items()}
+    return value
+
+
+def connect(address: Tuple[str, int], authkey: bytes, timeout: float = CONNECT_TIMEOUT) \
+        -> Optional[Tuple[Connection, Tuple]]:
+    """
+    Connects a worker slot to the coordinator, returns the connection and the coordinator's setup.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = Client(address, authkey=authkey)
+            connection.send(socket.gethostname())
+            return connection, connection.recv()
+        except AuthenticationError:
+            logging.error('the coordinator has another key')
+            return None
+        except (ConnectionRefusedError, EOFError):
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(CONNECT_INTERVAL)
+
+
+def work(address: Tuple[str, int], authkey: bytes, slots: int, mapping: Dict[str, str],
+         timeout: float = CONNECT_TIMEOUT) -> int:
+    """
+    Runs tasks of a coordinator with a pool of slots encoder processes, until it has no more.
+    """
+    from multiprocessing import Pool
+
+    connections = []
+    for _ in range(slots):
+        connected = connect(address, authkey, timeout)
+        if connected is None:
+            break
+        connections.append(connected[0])
+        setup = connected[1]
+    if not connections:
+        logging.error('could not connect to %s:%d', *address)
+        return 1
+
+    logging.info('connected to %s:%d with %d slots', address[0], address[1], len(connections))
+    with Pool(len(connections), initializer=worker.init_worker, initargs=setup) as pool:
+        threads = [threading.Thread(target=run_slot, args=(connection, pool, mapping), name='slot')
+                   for connection in connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    logging.info('coordinator has no more tasks')
+    return 0
+
+
+def run_slot(connection: Connection, pool, mapping: Dict[str, str]) -> None:
+    with connection:
+        while True:
+            try:
+                task = connection.recv()
+            except (OSError, EOFError) as e:
+                logging.error('lost the coordinator: %s', e)
+                return
+            if task is None:
+                return
+            func, args = task
+            try:
+                result = (True, pool.apply(func, localize(args, mapping)))
+            except Exception as e:
+                result = (False, e)
+            try:
+                try:
+                    connection.send(result)
+                except Exception as e:
+                    if isinstance(e, OSError):
+                        raise
+                    # The error can't be pickled
+                    connection.send((False, RuntimeError(str(result[1]))))
+            except OSError as e:
+                logging.error('lost the coordinator: %s', e)
+                return
+
+
+def parse_mapping(specs: List[str]) -> Dict[str, str]:
+    mapping = {}
+    for spec in specs:
+        remote, sep, local = spec.partition('=')
+        if not sep or not remote or not local:
+            raise ValueError('expected REMOTE=LOCAL: ' + spec)
+        mapping[remote] = local
+    return mapping
+
+
+def parse_args():
+    import configargparse
+
+    p = configargparse.ArgParser(description='encode files for a to_opus.py coordinator (see --serve) on this host')
+    p.add_argument('--connect', required=True, metavar='HOST:PORT', help='address of the coordinator')
+    p.add_argument('--authkey', env_var=AUTHKEY_ENV, required=True,
+                   help='key shared with the coordinator, preferably set in the environment')
+    p.add_argument('-thr', '--threads', metavar='COUNT', type=int,
+                   help='number of parallel encoder processes (default: number of CPU cores)')
+    p.add_argument('--map', metavar='REMOTE=LOCAL', action='append', default=[],
+                   help='a directory of the coordinator (source or target) is mounted at LOCAL on this host, '
+                        'can be given multiple times')
+    p.add_argument('--connect-timeout', metavar='SECONDS', type=float, default=CONNECT_TIMEOUT,
+                   help='how long to wait for the coordinator (default: %(default)s)')
+    p.add_argument('-v', '--verbose', action='store_true', help='more verbose output')
+    options = p.parse_args()
+    try:
+        options.map = parse_mapping(options.map)
+    except ValueError as e:
+        p.error('argument --map: ' + str(e))
+    return options
+
+
+def main(cfg) -> int:
+    worker.configure_logging(logging.DEBUG if cfg.verbose else logging.INFO)
+    return work(parse_address(cfg.connect), cfg.authkey.encode(), cfg.threads or scheduler.cpu_count(), cfg.map,
+                cfg.connect_timeout)
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,259 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, check_output, CalledProcessError
+from typing import Iterator, List, Optional, Tuple
+
+import fileops
+
+ENCODERS = ['opusenc', 'sndfile']
+
+# Sample rates Opus supports natively, anything else has to be resampled
+OPUS_SAMPLE_RATES = [8000, 12000, 16000, 24000, 48000]
+# Containers the in-process encoder decodes itself, anything else is handed to opusenc
+SNDFILE_FORMATS = ['WAV', 'WAVEX', 'AIFF', 'FLAC']
+
+# Outputs are written next to their final path with this suffix and renamed once complete, so an interrupted run
+# never leaves a truncated file behind that looks like a finished output
+PARTIAL_SUFFIX = '.part'
+
+# Version of an encoder that can't be determined, e.g. because it isn't installed
+UNKNOWN_VERSION = 'unknown'
+# opusenc arguments that don't change the output, left out of profile fingerprints
+NEUTRAL_ARGS = ['--quiet']
+# Bytes read from the source at once when it's streamed to several opusenc processes
+STREAM_CHUNK = 1024 * 1024
+# Frames decoded at once by the in-process encoder, see SndfileEncoder
+SNDFILE_BLOCK = 64 * 1024
+
+# An output path and the encoder arguments it's written with
+Output = Tuple[str, List[str]]
+
+
+@lru_cache(maxsize=None)
+def find(command: str) -> Optional[str]:
+    """
+    Returns the path of an encoder executable, None if it isn't installed. Looked up once per process.
+    """
+    return shutil.which(command)
+
+
+def opusenc() -> str:
+    return find('opusenc') or 'opusenc'
+
+
+@lru_cache(maxsize=None)
+def version(name: str) -> str:
+    """
+    Returns the version of an encoder, which is part of profile fingerprints as a new version may encode differently.
+    """
+    try:
+        if name == 'opusenc':
+            return check_output([opusenc(), '--version'], stderr=DEVNULL).decode(errors='replace').splitlines()[0]
+        if name == 'sndfile':
+            import soundfile
+            return soundfile.__libsndfile_version__
+    except (OSError, CalledProcessError, ImportError, IndexError) as e:
+        logging.warning('could not determine the version of %s: %s', name, e)
+    return UNKNOWN_VERSION
+
+
+def profile(name: str, args: List[str], encoder_version: Optional[str] = None) -> str:
+    """
+    Returns a fingerprint of the encoder, its version (the installed one unless given) and the arguments that affect
+    the output. An output written with a different profile than the current one is encoded again.
+    """
+    # libsndfile doesn't take any arguments, see SndfileEncoder
+    relevant = [arg.strip() for arg in args if arg.strip() not in NEUTRAL_ARGS] if name == 'opusenc' else []
+    data = json.dumps([name, version(name) if encoder_version is None else encoder_version, relevant]).encode()
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+@contextmanager
+def partial_output(dest: str) -> Iterator[str]:
+    """
+    Yields the path to write dest to, which is renamed to dest if the block completes and removed otherwise.
+    """
+    partial = dest + PARTIAL_SUFFIX
+    try:
+        yield partial
+    except BaseException:
+        remove_partial(partial)
+        raise
+    os.replace(partial, dest)
+
+
+def remove_partial(partial: str) -> None:
+    if os.path.isfile(partial):
+        os.remove(partial)
+
+
+def copy(src: str, dest: str, hardlink: bool = False) -> None:
+    """
+    Copies src to dest, or hardlinks it if hardlink is set and both are on the same filesystem.
+    """
+    with partial_output(dest) as partial:
+        # Left over by an interrupted run, which would keep a new link from being created
+        remove_partial(partial)
+        if hardlink and fileops.link(src, partial):
+            method = 'hardlink'
+        else:
+            method = fileops.copy_file(src, partial)
+    logging.debug('copied "%s" -> "%s" (%s)', src, dest, method)
+
+
+class Encoder(object):
+    """
+    Converts a single source file to Opus. One instance lives in each pool worker and is reused for every file.
+    """
+
+    def __init__(self, args: List[str]):
+        self.args = args
+
+    def encode(self, src: str, dest: str, timeout: Optional[float] = None) -> None:
+        self.encode_many(src, [(dest, self.args)], timeout)
+
+    def encode_many(self, src: str, outputs: List[Output], timeout: Optional[float] = None) -> None:
+        """
+        Encodes src to several outputs (e.g. with different bitrates), reading it only once.
+        """
+        raise NotImplementedError
+
+
+class OpusencEncoder(Encoder):
+    """
+    Runs the opusenc command line tool for each file.
+    """
+
+    def encode_many(self, src: str, outputs: List[Output], timeout: Optional[float] = None) -> None:
+        if len(outputs) == 1:
+            dest, args = outputs[0]
+            self.wait(Popen([opusenc(), src, dest + PARTIAL_SUFFIX] + args), src, dest, timeout)
+            return
+
+        # Every process reads the source from stdin, so it's read from disk once however many outputs there are
+        deadline = None if timeout is None else time.monotonic() + timeout
+        processes = [Popen([opusenc(), '-', dest + PARTIAL_SUFFIX] + args, stdin=PIPE) for dest, args in outputs]
+        writing = list(processes)
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK), b''):
+                for process in list(writing):
+                    try:
+                        process.stdin.write(chunk)
+                    except BrokenPipeError:
+                        # Gave up on the source, its exit code tells
+                        writing.remove(process)
+                if not writing:
+                    break
+        for process in processes:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        for i, (process, (dest, _)) in enumerate(zip(processes, outputs)):
+            try:
+                self.wait(process, src, dest, None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                for other, (other_dest, _) in zip(processes[i + 1:], outputs[i + 1:]):
+                    other.kill()
+                    other.wait()
+                    remove_partial(other_dest + PARTIAL_SUFFIX)
+                raise
+
+    @staticmethod
+    def wait(process: Popen, src: str, dest: str, timeout: Optional[float]) -> None:
+        partial = dest + PARTIAL_SUFFIX
+        try:
+            exit_code = process.wait(timeout=timeout)
+        except TimeoutExpired:
+            process.kill()
+            process.wait()
+            remove_partial(partial)
+            raise TimeoutError('opusenc timed out after %ds on "%s"' % (timeout, src))
+
+        if exit_code == 0:
+            os.replace(partial, dest)
+            logging.info('converted "%s" -> "%s"', src, dest)
+        else:
+            remove_partial(partial)
+            # Fallback to copy
+            # Can happen if a .ogg file is encoded as Vorbis, not FLAC
+            logging.warning('Falling back to copy for %s', src)
+            _, src_ext = os.path.splitext(src)
+            target_base, _ = os.path.splitext(dest)
+            copy(src, target_base + src_ext)
+
+
+class SndfileEncoder(Encoder):
+    """
+    Decodes and encodes in-process through libsndfile (via the optional soundfile package), which saves starting
+    a process and re-reading the file for every track - that overhead dominates for short samples.
+
+    Needs libsndfile 1.0.29 or newer for Opus support. Sources that aren't at a sample rate Opus supports are
+    resampled to 48 kHz if the optional soxr package is installed, otherwise they are handed to opusenc, like
+    anything libsndfile doesn't decode (e.g. Ogg). opusenc arguments are not applied by libsndfile and
+    timeouts can't interrupt an in-process encode.
+    """
+
+    def __init__(self, args: List[str]):
+        super().__init__(args)
+        import soundfile
+        try:
+            import soxr
+        except ImportError:
+            soxr = None
+
+        self.soundfile = soundfile
+        self.soxr = soxr
+        self.fallback = OpusencEncoder(args)
+
+    def encode_many(self, src: str, outputs: List[Output], timeout: Optional[float] = None) -> None:
+        try:
+            info = self.soundfile.info(src)
+        except RuntimeError:
+            info = None
+
+        if info is None or info.format not in SNDFILE_FORMATS \
+                or (info.samplerate not in OPUS_SAMPLE_RATES and self.soxr is None):
+            self.fallback.encode_many(src, outputs, timeout)
+            return
+
+        sample_rate = info.samplerate if info.samplerate in OPUS_SAMPLE_RATES else 48000
+        resampler = None
+        if sample_rate != info.samplerate:
+            resampler = self.soxr.ResampleStream(info.samplerate, sample_rate, info.channels, dtype='float32')
+
+        # Decoded once for all outputs, a block at a time so long tracks don't have to fit into memory
+        with ExitStack() as stack:
+            source = stack.enter_context(self.soundfile.SoundFile(src))
+            sinks = [stack.enter_context(self.soundfile.SoundFile(stack.enter_context(partial_output(dest)), 'w',
+                                                                  sample_rate, info.channels,
+                                                                  format='OGG', subtype='OPUS'))
+                     for dest, _ in outputs]
+            block = None
+            for block in source.blocks(SNDFILE_BLOCK, dtype='float32', always_2d=True):
+                if resampler is not None:
+                    block = resampler.resample_chunk(block)
+                for sink in sinks:
+                    sink.write(block)
+            if resampler is not None and block is not None:
+                # Flushes what the resampler holds back
+                tail = resampler.resample_chunk(block[:0], last=True)
+                for sink in sinks:
+                    sink.write(tail)
+        for dest, _ in outputs:
+            logging.info('converted "%s" -> "%s"', src, dest)
+
+
+def create(name: str, args: List[str]) -> Encoder:
+    if name == 'opusenc':
+        return OpusencEncoder(args)
+    if name == 'sndfile':
+        return SndfileEncoder(args)
+    raise ValueError('unknown encoder: ' + name)
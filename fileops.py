@@ -0,0 +1,67 @@
+import os
+import shutil
+import sys
+from typing import BinaryIO
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+# ioctl that makes dest share the data blocks of src (reflink), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+# Bytes per copy_file_range call, larger files take several
+COPY_RANGE_CHUNK = 64 * 1024 * 1024
+
+
+def copy_file(src: str, dest: str) -> str:
+    """
+    Copies the content of src to dest with the cheapest method the filesystems support, returns its name:
+    - reflink: dest shares the data of src until either is changed (Btrfs, XFS, ZFS 2.2+, ...), no data is copied
+    - copy_file_range: the kernel copies the data (or the server does, for NFS 4.2 and SMB), it never passes
+      through user space
+    - copyfile: shutil.copyfile, which uses sendfile on Linux and buffered reads and writes elsewhere
+    """
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        if clone(fsrc, fdst):
+            return 'reflink'
+        if copy_range(fsrc, fdst):
+            return 'copy_file_range'
+    shutil.copyfile(src, dest)
+    return 'copyfile'
+
+
+def clone(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        # Not supported by the filesystem, or source and dest are on different ones
+        return False
+    return True
+
+
+def copy_range(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    try:
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_RANGE_CHUNK) > 0:
+            pass
+    except OSError:
+        # Kernels before 5.3 don't copy between filesystems, some filesystems don't support it at all.
+        # The caller starts over, dest might contain part of the data.
+        return False
+    return True
+
+
+def link(src: str, dest: str) -> bool:
+    """
+    Hardlinks dest to src, returns False if that's not possible, e.g. because they are on different filesystems.
+    """
+    try:
+        os.link(src, dest)
+    except OSError:
+        return False
+    return True
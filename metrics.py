@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Stages a run spends its time in:
+# - scan: listing the source and target directories
+# - decide: checking which files need to be migrated
+# - queue_wait: waiting for a free worker, a high value means the workers (or the throttle) are the bottleneck
+# - encode / copy: time the workers spent per file (summed over all workers)
+# - db: writing records, including the periodic flushes of JSON databases
+STAGES = ['scan', 'decide', 'queue_wait', 'encode', 'copy', 'db']
+
+# Metric names are prefixed with this in the exporters
+PREFIX = 'to_opus'
+
+
+class Exporter(object):
+    """
+    Publishes the current metrics somewhere, called periodically during a run and once at its end.
+    """
+
+    def export(self, metrics: 'Metrics') -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class PrometheusExporter(Exporter):
+    """
+    Writes the metrics in the Prometheus text format, e.g. for node_exporter's textfile collector.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, metrics: 'Metrics') -> None:
+        # All samples of a metric have to follow its (single) TYPE line
+        grouped: Dict[str, Tuple[str, List[str]]] = {}
+        for name, kind, labels, value in metrics.samples():
+            label_text = '{%s}' % ','.join('%s="%s"' % label for label in labels) if labels else ''
+            grouped.setdefault(name, (kind, []))[1].append('%s_%s%s %s' % (PREFIX, name, label_text, value))
+
+        lines = []
+        for name, (kind, samples) in grouped.items():
+            lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+            lines.extend(samples)
+        # Collectors may read the file at any time, so it's replaced rather than rewritten in place
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+class StatsdExporter(Exporter):
+    """
+    Sends the metrics as statsd gauges over UDP, so a lost packet doesn't matter and a missing daemon doesn't either.
+    """
+
+    def __init__(self, address: str):
+        import socket
+
+        host, _, port = address.rpartition(':')
+        self.address = (host or 'localhost', int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self, metrics: 'Metrics') -> None:
+        for name, _, labels, value in metrics.samples():
+            key = '.'.join([PREFIX, name] + [v for _, v in labels])
+            try:
+                self.socket.sendto(('%s:%s|g' % (key, value)).encode(), self.address)
+            except OSError as e:
+                logging.debug('could not send metric %s: %s', key, e)
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+class Metrics(object):
+    """
+    Counters and timers of a run. Thread safe, the pool's result thread reports finished jobs while the main thread
+    submits new ones.
+    """
+
+    def __init__(self, progress_interval: float = 60, exporters: Optional[List[Exporter]] = None):
+        self.logger = logging.getLogger('migrator')
+        self.progress_interval = progress_interval
+        self.exporters = exporters or []
+        self.lock = threading.Lock()
+
+        self.started = time.time()
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+        # Per stage: (number of timed operations, seconds)
+        self.stages: Dict[str, Tuple[int, float]] = {stage: (0, 0.0) for stage in STAGES}
+        # Per action: (files, bytes) of finished jobs
+        self.done: Dict[str, Tuple[int, int]] = {}
+        self.failures = 0
+        # Files and bytes the current plan is going to migrate
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        # Start of executing the plan, throughput and ETA are based on the time since then
+        self.execute_time: Optional[float] = None
+        # Migrations (or batches of them) that read from another source directory than the one started before
+        self.dir_switches = 0
+        self.source_dir: Optional[str] = None
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            count, total = self.stages[stage]
+            self.stages[stage] = (count + 1, total + seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.monotonic() - start)
+
+    def start(self, total_files: int, total_bytes: int) -> None:
+        """
+        Called when a plan starts executing. Progress is per plan (watch mode executes one per batch of changes),
+        the counters per action add up over the whole run.
+        """
+        with self.lock:
+            self.total_files = total_files
+            self.total_bytes = total_bytes
+            self.done_files = 0
+            self.done_bytes = 0
+            self.execute_time = time.monotonic()
+
+    def source_read(self, rel_dir: str) -> None:
+        """
+        Called when a migration starts reading from source directory rel_dir. Every switch to another directory
+        is a seek on spinning disks, and likely reads a directory that isn't in the page cache.
+        """
+        with self.lock:
+            if rel_dir != self.source_dir:
+                self.dir_switches += 1
+                self.source_dir = rel_dir
+
+    def job_done(self, action: str, size: int, failed: bool = False) -> None:
+        with self.lock:
+            if failed:
+                self.failures += 1
+            else:
+                files, total = self.done.get(action, (0, 0))
+                self.done[action] = (files + 1, total + size)
+            self.done_files += 1
+            self.done_bytes += size
+
+            now = time.monotonic()
+            if self.progress_interval <= 0 or now - self.last_report < self.progress_interval:
+                return
+            self.last_report = now
+            self.report()
+
+    def report(self) -> None:
+        self.logger.info(self.progress())
+        self.export()
+
+    def progress(self) -> str:
+        """
+        Returns a line like 'progress: 120/5000 files (2.4%), 0.3/50.0 GB, 3.4 files/s, 12.0 MB/s, ETA 1h23m'.
+        """
+        elapsed = time.monotonic() - (self.execute_time or self.start_time)
+        files_per_s = self.done_files / elapsed if elapsed else 0
+        bytes_per_s = self.done_bytes / elapsed if elapsed else 0
+
+        line = 'progress: %d/%d files (%.1f%%), %.1f/%.1f GB, %.1f files/s, %.1f MB/s' % (
+            self.done_files, self.total_files, 100 * self.done_files / self.total_files if self.total_files else 100,
+            self.done_bytes / 1e9, self.total_bytes / 1e9, files_per_s, bytes_per_s / 1e6)
+        if bytes_per_s:
+            line += ', ETA ' + format_duration((self.total_bytes - self.done_bytes) / bytes_per_s)
+        return line
+
+    def samples(self) -> List[Tuple[str, str, List[Tuple[str, str]], float]]:
+        """
+        Returns (name, type, labels, value) of all metrics for the exporters.
+        """
+        samples = [
+            ('files_total', 'gauge', [], self.total_files),
+            ('bytes_total', 'gauge', [], self.total_bytes),
+            ('files_done', 'gauge', [], self.done_files),
+            ('bytes_done', 'gauge', [], self.done_bytes),
+            ('failures', 'counter', [], self.failures),
+            ('dir_switches', 'counter', [], self.dir_switches),
+            ('elapsed_seconds', 'gauge', [], round(time.monotonic() - self.start_time, 3)),
+        ]
+        for action, (files, size) in sorted(self.done.items()):
+            samples.append(('action_files', 'counter', [('action', action)], files))
+            samples.append(('action_bytes', 'counter', [('action', action)], size))
+        for stage, (count, seconds) in self.stages.items():
+            samples.append(('stage_count', 'counter', [('stage', stage)], count))
+            samples.append(('stage_seconds', 'counter', [('stage', stage)], round(seconds, 3)))
+        return samples
+
+    def summary(self) -> Dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            return {
+                'started': self.started,
+                'elapsed_seconds': elapsed,
+                'files': {action: {'count': files, 'bytes': size} for action, (files, size) in self.done.items()},
+                'failures': self.failures,
+                'dir_switches': self.dir_switches,
+                'stages': {stage: {'count': count, 'seconds': seconds}
+                           for stage, (count, seconds) in self.stages.items()},
+                'files_per_second': self.done_files / elapsed if elapsed else 0,
+                'bytes_per_second': self.done_bytes / elapsed if elapsed else 0,
+            }
+
+    def export(self) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(self)
+            except OSError as e:
+                # Metrics are nice to have, they never fail a run
+                self.logger.warning('could not export metrics: %s', e)
+
+    def finish(self, summary_path: Optional[str] = None) -> None:
+        with self.lock:
+            if self.execute_time is not None:
+                self.logger.info(self.progress())
+            self.export()
+            for stage, (count, seconds) in self.stages.items():
+                self.logger.info('%-10s %8d times %10.1fs', stage, count, seconds)
+            if self.dir_switches:
+                self.logger.info('source directory switches: %d', self.dir_switches)
+        if summary_path is not None:
+            with open(summary_path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+        for exporter in self.exporters:
+            exporter.close()
+
+
+def create_exporter(spec: str) -> Exporter:
+    """
+    Creates an exporter from 'prometheus:PATH' or 'statsd:HOST:PORT'.
+    """
+    kind, _, target = spec.partition(':')
+    if kind == 'prometheus' and target:
+        return PrometheusExporter(target)
+    if kind == 'statsd' and target:
+        return StatsdExporter(target)
+    raise ValueError('unknown metrics exporter: ' + spec)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%dh%02dm' % (hours, minutes)
+    if minutes:
+        return '%dm%02ds' % (minutes, seconds)
+    return '%ds' % seconds
@@ -0,0 +1,254 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+# Directories listed concurrently. Listing is mostly waiting for the filesystem, on network mounts a lot
+SCAN_THREADS = 8
+# Listed directories that are not consumed yet, per thread. Bounds the memory while the consumer is slower
+QUEUED_PER_THREAD = 4
+
+
+class Entry(NamedTuple):
+    rel_base: str
+    ext: str
+    stat: Optional[os.stat_result]
+
+
+class Listing(NamedTuple):
+    """
+    The contents of a single directory.
+    """
+    rel_dir: str
+    # Names of subdirectories, including symlinks to directories
+    dirs: List[str]
+    # Names of symlinks to directories, which are listed but not followed (like os.walk)
+    links: List[str]
+    # Names of everything else, with their stat data if requested
+    files: List[Tuple[str, Optional[os.stat_result]]]
+    # Relative paths of entries that couldn't be read, or rel_dir itself if it couldn't be listed
+    unreadable: List[str]
+
+
+class Index(object):
+    """
+    All files of a directory tree by relative path without extension (rel_base) and extension,
+    like os.walk + os.path.splitext but from a single os.scandir pass.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files: Dict[str, Dict[str, Optional[os.stat_result]]] = {}
+        self.dirs: List[str] = []
+        # Relative paths (files also without extension) that couldn't be read, it's unknown what is below them
+        self.unreadable: Set[str] = set()
+
+    def add(self, rel_base: str, ext: str, stat: Optional[os.stat_result] = None) -> None:
+        self.files.setdefault(rel_base, {})[ext] = stat
+
+    def remove(self, rel_base: str, ext: str) -> None:
+        exts = self.files.get(rel_base)
+        if exts is not None:
+            exts.pop(ext, None)
+            if not exts:
+                del self.files[rel_base]
+
+    def extensions(self, rel_base: str) -> Dict[str, Optional[os.stat_result]]:
+        return self.files.get(rel_base, {})
+
+    def contains(self, rel_base: str, ext: str) -> bool:
+        return ext in self.files.get(rel_base, ())
+
+    def readable(self, rel_base: str) -> bool:
+        """
+        Returns whether rel_base and the directories above it could be read, so whether it's in the index or not
+        tells if it exists.
+        """
+        rel_path = rel_base
+        while rel_path and self.unreadable:
+            if rel_path in self.unreadable:
+                return False
+            rel_path = os.path.dirname(rel_path)
+        return True
+
+    def entries(self) -> Iterator[Entry]:
+        for rel_base, exts in self.files.items():
+            for ext, stat in exts.items():
+                yield Entry(rel_base, ext, stat)
+
+    def __len__(self) -> int:
+        return sum(len(exts) for exts in self.files.values())
+
+
+def scan(root: str, stat: bool = True, threads: int = SCAN_THREADS) -> Index:
+    """
+    Indexes all files below root, with their stat data if stat is set. A missing root results in an empty index.
+    Like os.walk, symlinks to directories are listed but not followed.
+    """
+    index = Index(root)
+    if os.path.isdir(root):
+        walk(index, '', stat, threads)
+    return index
+
+
+def scan_paths(root: str, rel_paths: Iterable[str], stat: bool = True, threads: int = SCAN_THREADS) -> Index:
+    """
+    Indexes the files below root that have the same path without extension as one of rel_paths, and everything
+    below the rel_paths that are directories. Saves scanning the whole tree when only a few files changed.
+    """
+    index = Index(root)
+    bases_by_dir: Dict[str, Set[str]] = {}
+    for rel_path in rel_paths:
+        path = root + os.sep + rel_path
+        if os.path.isdir(path) and not os.path.islink(path):
+            index.dirs.append(rel_path)
+            walk(index, rel_path, stat, threads)
+        else:
+            rel_base, _ = os.path.splitext(rel_path)
+            bases_by_dir.setdefault(os.path.dirname(rel_base), set()).add(rel_base)
+
+    for rel_dir, rel_bases in bases_by_dir.items():
+        try:
+            with os.scandir(root + os.sep + rel_dir if rel_dir else root) as entries:
+                for entry in entries:
+                    rel_base, ext = os.path.splitext(join(rel_dir, entry.name))
+                    if rel_base not in rel_bases:
+                        continue
+                    try:
+                        if not entry.is_dir():
+                            index.add(rel_base, ext, entry.stat() if stat else None)
+                    except OSError as e:
+                        index.unreadable.update(skip_unreadable(join(rel_dir, entry.name), e))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        except OSError as e:
+            index.unreadable.update(skip_unreadable(rel_dir, e))
+    return index
+
+
+def walk(index: Index, rel_dir: str, stat: bool, threads: int = SCAN_THREADS) -> None:
+    for listing in iter_dirs(index.root, rel_dir, stat, threads):
+        for name in listing.dirs:
+            index.dirs.append(join(listing.rel_dir, name))
+        for name, file_stat in listing.files:
+            rel_base, ext = os.path.splitext(join(listing.rel_dir, name))
+            index.add(rel_base, ext, file_stat)
+        index.unreadable.update(listing.unreadable)
+
+
+def join(rel_dir: str, name: str) -> str:
+    return rel_dir + os.sep + name if rel_dir else name
+
+
+def skip_unreadable(rel_path: str, error: OSError) -> List[str]:
+    """
+    Logs that rel_path can't be read, returns the paths to add to the unreadable ones.
+    """
+    logging.getLogger('scan').warning('skipping "%s": %s', error.filename or rel_path, error.strerror or error)
+    # Files are looked up without extension
+    return [rel_path, os.path.splitext(rel_path)[0]]
+
+
+def list_dir(root: str, rel_dir: str, stat: bool) -> Listing:
+    """
+    Lists a directory. Entries that can't be read (dangling symlinks, files removed meanwhile) are left out, like
+    subdirectories that can't be listed, and both end up in the unreadable paths. Only the root has to be readable.
+    """
+    listing = Listing(rel_dir, [], [], [], [])
+    try:
+        with os.scandir(root + os.sep + rel_dir if rel_dir else root) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        listing.dirs.append(entry.name)
+                        if entry.is_symlink():
+                            listing.links.append(entry.name)
+                    else:
+                        listing.files.append((entry.name, entry.stat() if stat else None))
+                except OSError as e:
+                    if isinstance(e, FileNotFoundError) and not os.path.lexists(entry.path):
+                        # Removed while the directory was being listed
+                        continue
+                    listing.unreadable.extend(skip_unreadable(join(rel_dir, entry.name), e))
+    except FileNotFoundError:
+        if not rel_dir:
+            raise
+        # Removed while the tree was being scanned
+    except OSError as e:
+        if not rel_dir:
+            raise
+        listing.unreadable.extend(skip_unreadable(rel_dir, e))
+    return listing
+
+
+def iter_dirs(root: str, rel_dir: str = '', stat: bool = True, threads: int = SCAN_THREADS,
+              ordered: bool = False) -> Iterator[Listing]:
+    """
+    Lists rel_dir and all directories below it with a pool of threads, and yields each listing as soon as it's
+    available. Unless ordered is set, the order depends on how fast each directory is listed. Ordered yields
+    parents before their subdirectories, with the names in each listing and the subdirectories sorted.
+    """
+    if threads <= 1:
+        for listing in iter_dirs_serial(root, rel_dir, stat):
+            yield sort(listing) if ordered else listing
+        return
+
+    with ThreadPoolExecutor(threads, thread_name_prefix='scan') as executor:
+        iterate = iter_dirs_ordered if ordered else iter_dirs_unordered
+        for listing in iterate(executor, threads * QUEUED_PER_THREAD, root, rel_dir, stat):
+            yield sort(listing) if ordered else listing
+
+
+def sort(listing: Listing) -> Listing:
+    return Listing(listing.rel_dir, sorted(listing.dirs), sorted(listing.links), sorted(listing.files),
+                   listing.unreadable)
+
+
+def subdirs(listing: Listing) -> List[str]:
+    """
+    Returns the relative paths of the subdirectories of listing that are scanned as well.
+    """
+    links = set(listing.links)
+    return [join(listing.rel_dir, name) for name in listing.dirs if name not in links]
+
+
+def iter_dirs_serial(root: str, rel_dir: str, stat: bool) -> Iterator[Listing]:
+    pending = [rel_dir]
+    while pending:
+        listing = list_dir(root, pending.pop(), stat)
+        yield listing
+        pending.extend(reversed(sorted(subdirs(listing))))
+
+
+def iter_dirs_unordered(executor: ThreadPoolExecutor, max_queued: int, root: str, rel_dir: str,
+                        stat: bool) -> Iterator[Listing]:
+    # Depth first, which keeps the frontier small in wide trees
+    frontier = [rel_dir]
+    running: Set[Future] = set()
+    while frontier or running:
+        while frontier and len(running) < max_queued:
+            running.add(executor.submit(list_dir, root, frontier.pop(), stat))
+
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            listing = future.result()
+            frontier.extend(subdirs(listing))
+            yield listing
+
+
+def iter_dirs_ordered(executor: ThreadPoolExecutor, max_queued: int, root: str, rel_dir: str,
+                      stat: bool) -> Iterator[Listing]:
+    # The directories in the order they are yielded, the next ones are listed ahead of time
+    pending: Deque[str] = deque([rel_dir])
+    running: Dict[str, Future] = {}
+    while pending:
+        for ahead in islice(pending, max_queued):
+            if ahead not in running:
+                running[ahead] = executor.submit(list_dir, root, ahead, stat)
+
+        listing = running.pop(pending.popleft()).result()
+        # Depth first like the serial walk, the subdirectories come next
+        pending.extendleft(reversed(sorted(subdirs(listing))))
+        yield listing
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from typing import Optional
+
+# Seconds between checks of the load average and I/O pressure
+THROTTLE_INTERVAL = 5
+# I/O pressure (percentage of time tasks waited for I/O) above which fewer copies run at once
+IO_PRESSURE_THRESHOLD = 20
+IO_PRESSURE_FILE = '/proc/pressure/io'
+
+
+def cpu_count() -> int:
+    """
+    Returns the number of cores this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def read_io_pressure(path: str = IO_PRESSURE_FILE) -> float:
+    """
+    Returns the share of the last 10 seconds (in percent) in which some task waited for I/O,
+    0 if the kernel doesn't report pressure stall information (Linux before 4.20, other systems).
+    """
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict(field.split('=') for field in fields[1:])['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0.0
+
+
+class Throttle(object):
+    """
+    Lowers the number of concurrent jobs while other processes keep the CPUs busy or the disks can't keep up.
+    """
+
+    def __init__(self, cores: Optional[int] = None, interval: float = THROTTLE_INTERVAL):
+        self.cores = cores or cpu_count()
+        self.interval = interval
+        self.checked: Optional[float] = None
+        self.load = 0.0
+        self.io_pressure = 0.0
+
+    def update(self) -> None:
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.interval:
+            return
+        self.checked = now
+        try:
+            self.load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            self.load = 0.0
+        self.io_pressure = read_io_pressure()
+
+    def cpu_limit(self, workers: int, running: int) -> int:
+        self.update()
+        # The load average includes the running encodes, only what other processes need is given up
+        others = max(0.0, self.load - running)
+        return max(1, min(workers, round(self.cores - others)))
+
+    def io_limit(self, workers: int) -> int:
+        self.update()
+        if self.io_pressure <= IO_PRESSURE_THRESHOLD:
+            return workers
+        return max(1, round(workers * (100 - self.io_pressure) / 100))
+
+
+class Lane(object):
+    """
+    A pool for one kind of job, with the number of jobs submitted to it and not finished yet.
+    """
+
+    def __init__(self, name: str, pool, workers: int, cpu_bound: bool, throttled: bool = True):
+        self.name = name
+        self.pool = pool
+        self.workers = workers
+        self.cpu_bound = cpu_bound
+        # Whether the load of this machine limits the lane, not for pools running jobs on other hosts
+        self.throttled = throttled
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def limit(self, throttle: Optional[Throttle]) -> int:
+        if throttle is None or not self.throttled:
+            return self.workers
+        if self.cpu_bound:
+            return throttle.cpu_limit(self.workers, self.running)
+        return throttle.io_limit(self.workers)
+
+    def try_acquire(self, throttle: Optional[Throttle]) -> bool:
+        with self.lock:
+            if self.running >= self.limit(throttle):
+                return False
+            self.running += 1
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.running -= 1
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
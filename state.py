@@ -0,0 +1,453 @@
+import sys
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+SQLITE_EXTENSIONS = ['.sqlite', '.sqlite3', '.db']
+
+# Columns with a fixed schema, anything else in a record is kept in the 'extra' JSON column
+SQLITE_COLUMNS = ['size', 'last_modified']
+# Directories whose records SqliteStore keeps in memory, the walk rarely comes back to a directory
+SQLITE_CACHED_DIRS = 64
+
+# Fields with few distinct values, whose values are shared between records
+SHARED_FIELDS = ['codec', 'profiles', 'encoder_version']
+SHARED_VALUES: Dict[Any, Any] = {}
+# Field names of packed records, shared by all records with the same fields in the same order, by field names.
+# Along with the positions of the SHARED_FIELDS in packed records.
+SHAPES: Dict[Tuple[str, ...], Tuple[Tuple[str, ...], Tuple[int, ...]]] = {}
+
+
+def pack(record: Dict) -> Tuple:
+    """
+    Packs a record into a tuple of its field names (see SHAPES) followed by its values, which takes less than half
+    the memory of a dict.
+    """
+    keys = tuple(record)
+    shape = SHAPES.get(keys)
+    if shape is None:
+        shape = SHAPES[keys] = (keys, tuple(i + 1 for i, key in enumerate(keys) if key in SHARED_FIELDS))
+    names, shared = shape
+
+    packed = [names, *record.values()]
+    for i in shared:
+        packed[i] = share(packed[i])
+    return tuple(packed)
+
+
+def unpack(packed: Tuple) -> Dict:
+    record = dict(zip(packed[0], packed[1:]))
+    if isinstance(record.get('profiles'), tuple):
+        record['profiles'] = dict(record['profiles'])
+    return record
+
+
+def share(value: Any) -> Any:
+    if isinstance(value, dict):
+        # profiles, unpacked to a dict again
+        value = tuple(value.items())
+    try:
+        return SHARED_VALUES.setdefault(value, value)
+    except TypeError:
+        # Not hashable, e.g. profiles of a newer version with lists in them
+        return value
+
+
+def split(rel_path: str) -> Tuple[str, str]:
+    rel_dir, _, name = rel_path.rpartition(os.sep)
+    return rel_dir, name
+
+
+class CompactRecords(MutableMapping):
+    """
+    Records grouped by directory, each packed into a tuple (see pack). Directory paths are kept once instead of in
+    every key. Records are unpacked when they are read.
+    """
+
+    def __init__(self):
+        self.dirs: Dict[str, Dict[str, Tuple]] = {}
+        self.count = 0
+
+    def __getitem__(self, rel_path: str) -> Dict:
+        rel_dir, name = split(rel_path)
+        try:
+            return unpack(self.dirs[rel_dir][name])
+        except KeyError:
+            raise KeyError(rel_path) from None
+
+    def __setitem__(self, rel_path: str, record: Dict) -> None:
+        self.set_packed(rel_path, pack(record))
+
+    def set_packed(self, rel_path: str, packed: Tuple) -> None:
+        rel_dir, name = split(rel_path)
+        records = self.dirs.get(rel_dir)
+        if records is None:
+            records = self.dirs[sys.intern(rel_dir)] = {}
+        if name not in records:
+            self.count += 1
+        records[name] = packed
+
+    def __delitem__(self, rel_path: str) -> None:
+        rel_dir, name = split(rel_path)
+        records = self.dirs.get(rel_dir)
+        if records is None or name not in records:
+            raise KeyError(rel_path)
+        del records[name]
+        self.count -= 1
+        if not records:
+            del self.dirs[rel_dir]
+
+    def __iter__(self) -> Iterator[str]:
+        for rel_dir, records in list(self.dirs.items()):
+            for name in list(records):
+                yield rel_dir + os.sep + name if rel_dir else name
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, rel_path) -> bool:
+        rel_dir, name = split(rel_path)
+        return name in self.dirs.get(rel_dir, ())
+
+    @staticmethod
+    def loads(text: str) -> 'CompactRecords':
+        """
+        Parses a JSON database, packing every record as soon as it's parsed so the dicts of all records never exist
+        at once.
+        """
+        def hook(data: Dict) -> Any:
+            if 'size' in data and 'last_modified' in data and not isinstance(data['size'], Packed):
+                return Packed(pack(data))
+            if data and isinstance(next(iter(data.values())), Packed):
+                # The database itself
+                records = CompactRecords()
+                for rel_path, record in data.items():
+                    if isinstance(record, Packed):
+                        records.set_packed(rel_path, record)
+                    else:
+                        records[rel_path] = record
+                return records
+            return data
+
+        data = json.loads(text, object_hook=hook)
+        if isinstance(data, CompactRecords):
+            return data
+        # Empty, or the first record is incomplete
+        records = CompactRecords()
+        for rel_path, record in data.items():
+            records[rel_path] = unpack(record) if isinstance(record, Packed) else record
+        return records
+
+    def write(self, f) -> None:
+        """
+        Writes the records as a JSON object, a directory at a time.
+        """
+        f.write('{')
+        first = True
+        for rel_dir, records in self.dirs.items():
+            prefix = rel_dir + os.sep if rel_dir else ''
+            if not first:
+                f.write(', ')
+            f.write(json.dumps({prefix + name: unpack(packed) for name, packed in records.items()})[1:-1])
+            first = False
+        f.write('}')
+
+
+class Packed(tuple):
+    """
+    A record packed while parsing, see CompactRecords.loads.
+    """
+    __slots__ = ()
+
+
+class Store(MutableMapping):
+    """
+    Maps relative source paths (without extension) to records like {'size': 123, 'last_modified': 1548508112.69}.
+    Records are replaced as a whole, mutating a record that was read from a store is not persisted.
+    """
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class JsonStore(Store):
+    """
+    The original database format, a single JSON object that is rewritten completely every write_frequency updates.
+    Databases loaded from a file are kept as CompactRecords.
+    """
+
+    def __init__(self, path: Optional[str] = None, data: Optional[MutableMapping] = None,
+                 write_frequency: int = 100):
+        if data is None:
+            data = CompactRecords()
+            if path is not None and os.path.exists(path):
+                with open(path, 'r') as f:
+                    data = CompactRecords.loads(f.read())
+
+        self.path = path
+        self.data = data
+        self.write_frequency = write_frequency
+        self.writes = 0
+
+    def __getitem__(self, rel_path: str) -> Dict:
+        return self.data[rel_path]
+
+    def __setitem__(self, rel_path: str, record: Dict) -> None:
+        self.data[rel_path] = record
+        self.written()
+
+    def __delitem__(self, rel_path: str) -> None:
+        del self.data[rel_path]
+        self.written()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, rel_path) -> bool:
+        return rel_path in self.data
+
+    def written(self) -> None:
+        if self.writes % self.write_frequency == 0:
+            self.flush()
+        self.writes += 1
+
+    def flush(self) -> None:
+        if self.path is None:
+            return
+
+        logging.info('updating db file')
+        # Write next to the old file and swap, so a crash never leaves a truncated database behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if isinstance(self.data, CompactRecords):
+                self.data.write(f)
+            else:
+                f.write(json.dumps(self.data))
+        os.replace(tmp_path, self.path)
+        logging.info('updated db file')
+
+
+class SqliteStore(Store):
+    """
+    SQLite database in WAL mode, every update is its own (cheap) transaction so a crash loses at most the record
+    that was being written.
+
+    Records are read a directory at a time, as the walk looks up the files of a directory one after the other, and
+    the last SQLITE_CACHED_DIRS directories are kept in memory (packed like CompactRecords).
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+
+        self.path = path
+        # Updates come from the walk and from the pool's result thread, callers serialize access
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries ('
+                                'rel_path TEXT PRIMARY KEY, size INTEGER, last_modified REAL, extra TEXT, dir TEXT)')
+        columns = [name for _, name, *_ in self.connection.execute('PRAGMA table_info(entries)')]
+        if 'dir' not in columns:
+            # Databases created before records were read by directory
+            self.connection.create_function('rel_dir', 1, lambda rel_path: split(rel_path)[0])
+            self.connection.execute('BEGIN')
+            self.connection.execute('ALTER TABLE entries ADD COLUMN dir TEXT')
+            self.connection.execute('UPDATE entries SET dir = rel_dir(rel_path)')
+            self.connection.execute('COMMIT')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir)')
+        # Packed records of recently read directories by name, least recently used first
+        self.cache: Dict[str, Dict[str, Tuple]] = OrderedDict()
+
+    def __getitem__(self, rel_path: str) -> Dict:
+        rel_dir, name = split(rel_path)
+        try:
+            return unpack(self.load_dir(rel_dir)[name])
+        except KeyError:
+            raise KeyError(rel_path) from None
+
+    def load_dir(self, rel_dir: str) -> Dict[str, Tuple]:
+        records = self.cache.get(rel_dir)
+        if records is not None:
+            self.cache.move_to_end(rel_dir)
+            return records
+
+        records = {}
+        for rel_path, size, last_modified, extra in self.connection.execute(
+                'SELECT rel_path, size, last_modified, extra FROM entries WHERE dir = ?', (rel_dir,)):
+            record = json.loads(extra) if extra else {}
+            record.update(size=size, last_modified=last_modified)
+            records[split(rel_path)[1]] = pack(record)
+        self.cache[rel_dir] = records
+        if len(self.cache) > SQLITE_CACHED_DIRS:
+            self.cache.popitem(last=False)
+        return records
+
+    def __setitem__(self, rel_path: str, record: Dict) -> None:
+        extra = {k: v for k, v in record.items() if k not in SQLITE_COLUMNS}
+        rel_dir, name = split(rel_path)
+        self.connection.execute('INSERT OR REPLACE INTO entries (rel_path, size, last_modified, extra, dir) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (rel_path, record.get('size'), record.get('last_modified'),
+                                 json.dumps(extra) if extra else None, rel_dir))
+        if rel_dir in self.cache:
+            self.cache[rel_dir][name] = pack(record)
+
+    def __delitem__(self, rel_path: str) -> None:
+        if self.connection.execute('DELETE FROM entries WHERE rel_path = ?', (rel_path,)).rowcount == 0:
+            raise KeyError(rel_path)
+        rel_dir, name = split(rel_path)
+        self.cache.get(rel_dir, {}).pop(name, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return (rel_path for rel_path, in self.connection.execute('SELECT rel_path FROM entries'))
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def __contains__(self, rel_path) -> bool:
+        rel_dir, name = split(rel_path)
+        return name in self.load_dir(rel_dir)
+
+    def update(self, other=(), **kwargs) -> None:
+        # One transaction for bulk updates instead of one per record
+        self.connection.execute('BEGIN')
+        try:
+            super().update(other, **kwargs)
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class Journal(object):
+    """
+    Append-only log of a plan being executed, so a run that died can continue where it stopped without planning
+    again. One JSON object per line: the plan first, then the key of every job when it is started and finished.
+    The file is removed once the plan was executed completely.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        # Jobs are started by the walk and finished on the pool's result thread
+        self.lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def begin(self, plan: Dict) -> None:
+        # Replaces the journal of an earlier run only once the new plan is complete on disk
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'plan': plan}) + '\n')
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a')
+
+    def started(self, key: Tuple) -> None:
+        self.write({'started': list(key)})
+
+    def finished(self, key: Tuple) -> None:
+        self.write({'finished': list(key)})
+
+    def write(self, entry: Dict) -> None:
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            # Only the OS buffers it from here, which survives the process getting killed
+            self.file.flush()
+
+    def load(self) -> Tuple[Dict, Set[Tuple], Set[Tuple]]:
+        """
+        Returns the plan and the keys of the started and of the finished jobs.
+        """
+        started: Set[Tuple] = set()
+        finished: Set[Tuple] = set()
+        with open(self.path, 'r') as f:
+            lines: List[str] = f.readlines()
+
+        plan = json.loads(lines[0])['plan']
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line was cut off when the run died
+                continue
+            if 'started' in entry:
+                started.add(tuple(entry['started']))
+            else:
+                finished.add(tuple(entry['finished']))
+        return plan, started, finished
+
+    def close(self, complete: bool = False) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if complete and self.exists():
+            os.remove(self.path)
+
+
+def backend_for(path: str) -> str:
+    _, ext = os.path.splitext(path)
+    return 'sqlite' if ext.lower() in SQLITE_EXTENSIONS else 'json'
+
+
+def open_store(path: str, backend: Optional[str] = None, write_frequency: int = 100) -> Store:
+    if backend is None:
+        backend = backend_for(path)
+
+    if backend == 'sqlite':
+        return SqliteStore(path)
+    if backend == 'json':
+        return JsonStore(path, write_frequency=write_frequency)
+    raise ValueError('unknown db backend: ' + backend)
+
+
+def import_json(json_path: str, store: Store) -> int:
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+
+    store.update(data)
+    store.flush()
+    return len(data)
+
+
+def parse_args():
+    import configargparse
+
+    p = configargparse.ArgParser(description='import an existing JSON database into another db backend')
+    p.add_argument('-i', '--input', required=True, help='path to the JSON database file')
+    p.add_argument('-o', '--output', required=True, help='path to the new database file')
+    p.add_argument('-b', '--backend', choices=['json', 'sqlite'],
+                   help='backend of the new database (default: by file extension)')
+    return p.parse_args()
+
+
+def main(cfg) -> int:
+    logging.basicConfig(stream=sys.stdout, format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    store = open_store(cfg.output, cfg.backend)
+    try:
+        count = import_json(cfg.input, store)
+    finally:
+        store.close()
+
+    logging.info('imported %d entries from "%s" into "%s"', count, cfg.input, cfg.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
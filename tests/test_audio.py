@@ -0,0 +1,111 @@
+import unittest
+
+import os
+import shutil
+import struct
+import tempfile
+
+import audio
+
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+source_dir = tests_dir + os.sep + 'source'
+
+
+def read(file: str) -> bytes:
+    with open(source_dir + os.sep + file, 'rb') as f:
+        return f.read()
+
+
+def with_riff_tag(data: bytes) -> bytes:
+    tag = b'LIST' + struct.pack('<I', 9) + b'INFOtitle' + b'\0'
+    return b'RIFF' + struct.pack('<I', len(data) - 8 + len(tag)) + data[8:] + tag
+
+
+def with_flac_padding(data: bytes) -> bytes:
+    # Appends a padding block after the last metadata block and clears the last-block flag of the previous one
+    offset = 4
+    while True:
+        last = data[offset] & 0x80
+        length = int.from_bytes(data[offset + 1:offset + 4], 'big')
+        if last:
+            break
+        offset += 4 + length
+    end = offset + 4 + length
+    padding = bytes([0x81]) + (16).to_bytes(3, 'big') + bytes(16)
+    return data[:offset] + bytes([data[offset] & 0x7f]) + data[offset + 1:end] + padding + data[end:]
+
+
+class TestAudio(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, file: str, data: bytes) -> str:
+        path = self.tmp_dir + os.sep + file
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_probe(self):
+        expected = {
+            'aifc.aif': 'aiff',
+            'aiff.aif': 'aiff',
+            'flac-ogg.ogg': 'flac',
+            'flac.flac': 'flac',
+            'opus.opus': 'opus',
+            'vorbis.ogg': 'vorbis',
+            'wave.wav': 'wav',
+            'desktop.ini.txt': None,
+        }
+
+        for file, codec in expected.items():
+            self.assertEqual(codec, audio.probe(source_dir + os.sep + file), file)
+
+    def test_duration(self):
+        # Read from the headers, not estimated from the file sizes
+        expected = {
+            'aifc.aif': 2.937,
+            'aiff.aif': 2.937,
+            'flac-ogg.ogg': 4.0,
+            'flac.flac': 4.0,
+            'opus.opus': 2.943,
+            'vorbis.ogg': 6.104,
+            'wave.wav': 2.937,
+        }
+
+        for file, seconds in expected.items():
+            self.assertAlmostEqual(seconds, audio.duration(source_dir + os.sep + file), places=3, msg=file)
+        self.assertIsNone(audio.duration(source_dir + os.sep + 'desktop.ini.txt'))
+        self.assertIsNone(audio.duration(self.write('empty.ogg', b'OggS')))
+
+    def test_fingerprint_wave_ignores_tags(self):
+        original = self.write('original.wav', read('wave.wav'))
+        tagged = self.write('tagged.wav', with_riff_tag(read('wave.wav')))
+
+        self.assertEqual(audio.fingerprint(original), audio.fingerprint(tagged))
+
+    def test_fingerprint_flac_ignores_metadata_blocks(self):
+        original = self.write('original.flac', read('flac.flac'))
+        padded = self.write('padded.flac', with_flac_padding(read('flac.flac')))
+
+        self.assertEqual(audio.fingerprint(original), audio.fingerprint(padded))
+
+    def test_fingerprint_changes_with_audio(self):
+        data = bytearray(read('wave.wav'))
+        data[1000] ^= 0xff
+        changed = self.write('changed.wav', bytes(data))
+
+        self.assertNotEqual(audio.fingerprint(source_dir + os.sep + 'wave.wav'), audio.fingerprint(changed))
+
+    def test_fingerprint_formats(self):
+        fingerprints = {audio.fingerprint(source_dir + os.sep + file)
+                        for file in ['aifc.aif', 'aiff.aif', 'flac.flac', 'opus.opus', 'vorbis.ogg', 'wave.wav']}
+
+        self.assertEqual(6, len(fingerprints))
+
+
+if __name__ == '__main__':
+    unittest.main()
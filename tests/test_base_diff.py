@@ -1,6 +1,10 @@
 import unittest
+import io
+import json
 import sys
 import os
+import shutil
+import tempfile
 
 import base_diff
 
@@ -72,7 +76,10 @@ class TestBaseDiff(unittest.TestCase):
         exit_code = base_diff.main(MicroMock(
             from_dir=source_dir,
             to_dir=golden_dir,
-            ignore=ignored_files
+            ignore=ignored_files,
+            scan_threads=8,
+            stale=False,
+            format='diff',
         ))
 
         self.assertEqual(0, exit_code)
@@ -81,11 +88,79 @@ class TestBaseDiff(unittest.TestCase):
         exit_code = base_diff.main(MicroMock(
             from_dir=source_dir,
             to_dir=source_dir + "/nested",
-            ignore=ignored_files
+            ignore=ignored_files,
+            scan_threads=8,
+            stale=False,
+            format='diff',
         ))
 
         self.assertEqual(1, exit_code)
 
 
+    def test_compare(self):
+        diff = base_diff.compare(source_dir + '/nested', source_dir, ignored_files)
+
+        self.assertEqual(['deep' + os.sep + 'aifc.aif', 'deep' + os.sep + 'aiff.aif'], diff.missing[:2])
+        self.assertEqual(8, len(diff.missing))
+        self.assertEqual(['aifc.aif', 'aiff.aif', 'flac-ogg.ogg', 'flac.flac', 'opus.opus', 'vorbis.ogg', 'wave.wav'],
+                         [rel_path for rel_path in diff.orphaned if os.sep not in rel_path])
+        self.assertEqual(15, len(diff.orphaned))
+        self.assertEqual([], diff.stale)
+
+    def test_compare_stale(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copytree(golden_dir, tmp_dir + os.sep + 'golden')
+            os.utime(tmp_dir + os.sep + 'golden' + os.sep + 'wave.opus', (0, 0))
+
+            diff = base_diff.compare(source_dir, tmp_dir + os.sep + 'golden', ignored_files, stale=True)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(base_diff.Diff([], [], ['wave.wav']), diff)
+
+    def test_compare_by_extension(self):
+        tmp_dir = tempfile.mkdtemp()
+        from_dir = tmp_dir + os.sep + 'source'
+        to_dir = tmp_dir + os.sep + 'golden'
+        try:
+            shutil.copytree(source_dir, from_dir)
+            shutil.copytree(golden_dir, to_dir)
+            # Sidecars of a migrated track, only one of them was migrated
+            for rel_path in ['flac.lrc', 'flac.cue']:
+                open(from_dir + os.sep + rel_path, 'w').close()
+            open(to_dir + os.sep + 'flac.cue', 'w').close()
+            # A fallback copy is an output too, a converted text file isn't
+            shutil.copyfile(source_dir + os.sep + 'wave.wav', to_dir + os.sep + 'wave.wav')
+            open(to_dir + os.sep + 'nested' + os.sep + 'text.opus', 'w').close()
+
+            diff = base_diff.compare(from_dir, to_dir, ignored_files)
+            exit_code = base_diff.diff_dirs(from_dir, to_dir, ignored_files, output_format='json')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(base_diff.Diff(['flac.lrc'], ['nested' + os.sep + 'text.opus'], []), diff)
+        self.assertEqual(1, exit_code)
+        out = io.StringIO()
+        base_diff.print_diff(from_dir, to_dir, diff, 'nul', out)
+        self.assertEqual('flac.lrc\0nested' + os.sep + 'text.opus\0', out.getvalue())
+
+    def test_print_diff(self):
+        diff = base_diff.Diff(['album' + os.sep + 'new.flac'], ['old.opus'], ['changed.wav'])
+
+        out = io.StringIO()
+        base_diff.print_diff('src', 'dest', diff, 'diff', out)
+        self.assertEqual(['--- src', '+++ dest', '-album' + os.sep + 'new', '+old', '!changed'],
+                         out.getvalue().splitlines())
+
+        out = io.StringIO()
+        base_diff.print_diff('src', 'dest', diff, 'json', out)
+        self.assertEqual(['changed.wav'], json.loads(out.getvalue())['stale'])
+
+        out = io.StringIO()
+        base_diff.print_diff('src', 'dest', diff, 'nul', out)
+        self.assertEqual('album' + os.sep + 'new.flac\0changed.wav\0old.opus\0', out.getvalue())
+
+
 if __name__ == '__main__':
     unittest.main()
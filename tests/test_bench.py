@@ -0,0 +1,57 @@
+import unittest
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import audio
+import bench
+from test_to_opus import LAZY_MODULES, MicroMock
+
+
+def bench_cfg(**kwargs):
+    cfg = dict(files=30, depth=2, file_size=4096, formats=','.join(bench.FORMATS), converted=0.5, orphans=5,
+               threads=2, encoder='stub', output=None, dir=None)
+    cfg.update(kwargs)
+    return MicroMock(**cfg)
+
+
+class TestBench(unittest.TestCase):
+
+    def test_generate(self):
+        with tempfile.TemporaryDirectory() as root:
+            paths = bench.generate(root, 25, 3, 1024, ['wav', 'flac'])
+
+            self.assertEqual(25, len(paths))
+            self.assertEqual(len(paths), len(set(paths)))
+            for rel_path in paths:
+                self.assertEqual(5, len(rel_path.split(os.sep)))
+                self.assertEqual(1024, os.path.getsize(os.path.join(root, rel_path)))
+                self.assertIn(audio.probe(os.path.join(root, rel_path)), ['wav', 'flac'])
+
+    def test_import(self):
+        code = 'import sys, bench; print(" ".join(m for m in %r if m in sys.modules))' % LAZY_MODULES
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        self.assertEqual(b'', output.strip())
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'bench.json')
+            self.assertEqual(0, bench.main(bench_cfg(output=output, dir=tmp_dir)))
+
+            with open(output) as f:
+                stages = json.load(f)['stages']
+            self.assertEqual({'encode', 'scan', 'needs_migration', 'plan', 'delete_removed', 'db_json', 'db_sqlite'},
+                             set(stages))
+            self.assertEqual(30, stages['encode']['files'])
+            self.assertIsNotNone(stages['encode']['mb_per_s'])
+            self.assertEqual(5, stages['delete_removed']['files'])
+            # Only the generated library was removed again
+            self.assertEqual(['bench.json'], os.listdir(tmp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
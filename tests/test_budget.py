@@ -0,0 +1,67 @@
+import unittest
+
+import budget
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(64 * 10 ** 9, budget.parse_size('64G'))
+        self.assertEqual(1500 * 10 ** 9, budget.parse_size('1.5TB'))
+        self.assertEqual(500 * 10 ** 6, budget.parse_size('500m'))
+        self.assertEqual(1024, budget.parse_size('1024'))
+        self.assertRaises(ValueError, budget.parse_size, '64 gigs')
+
+    def test_with_bitrate(self):
+        self.assertEqual(['--vbr', '--bitrate', '96'], budget.with_bitrate(['--bitrate', '160', '--vbr'], 96))
+        self.assertEqual(['--vbr', '--bitrate', '96'], budget.with_bitrate(['--bitrate=160', '--vbr'], 96))
+        self.assertEqual(['--bitrate', '64'], budget.with_bitrate([], 64))
+
+    def test_assign_uniform(self):
+        albums = {'a': budget.Album(3600, 10), 'b': budget.Album(1800, 5)}
+
+        bitrates = budget.assign(albums, albums['a'].size(128) + albums['b'].size(128))
+
+        self.assertEqual({'a': 128, 'b': 128}, bitrates)
+
+    def test_assign_keeps_bitrates_that_fit(self):
+        albums = {'a': budget.Album(3600, 10, 160), 'b': budget.Album(1800, 5, 96), 'new': budget.Album(600, 2)}
+        size = albums['a'].size(160) + albums['b'].size(96) + albums['new'].size(96)
+
+        bitrates = budget.assign(albums, size)
+
+        self.assertEqual({'a': 160, 'b': 96, 'new': 96}, bitrates)
+
+    def test_assign_lowers_new_albums_first(self):
+        albums = {'a': budget.Album(3600, 10, 160), 'b': budget.Album(1800, 5, 128), 'new': budget.Album(3600, 10)}
+        size = albums['a'].size(128) + albums['b'].size(128) + albums['new'].size(112)
+
+        bitrates = budget.assign(albums, size)
+
+        # Encoded albums aren't encoded again just to make room for the new one
+        self.assertEqual({'a': 160, 'b': 128, 'new': 80}, bitrates)
+
+    def test_assign_lowers_highest_first(self):
+        albums = {'a': budget.Album(3600, 10, 160), 'b': budget.Album(1800, 5, 128), 'new': budget.Album(3600, 10)}
+        size = albums['a'].size(112) + albums['b'].size(128) + albums['new'].size(32)
+
+        bitrates = budget.assign(albums, size)
+
+        self.assertEqual({'a': 112, 'b': 128, 'new': 32}, bitrates)
+        self.assertLessEqual(sum(album.size(bitrates[rel_dir]) for rel_dir, album in albums.items()), size)
+
+    def test_assign_raises_below_uniform(self):
+        albums = {'a': budget.Album(3600, 10, 64), 'b': budget.Album(1800, 5, 64)}
+
+        bitrates = budget.assign(albums, albums['a'].size(96) + albums['b'].size(96))
+
+        self.assertEqual({'a': 96, 'b': 96}, bitrates)
+
+    def test_assign_too_small(self):
+        albums = {'a': budget.Album(3600, 10)}
+
+        self.assertEqual({'a': budget.BITRATES[0]}, budget.assign(albums, 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from functools import partial
+from multiprocessing.connection import Client
+
+import base_diff
+import distributed
+import to_opus
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+source_dir = test_dir + os.sep + 'source'
+
+authkey = b'test'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestDistributed(unittest.TestCase):
+
+    def test_authkey_env(self):
+        # Defined twice, so to_opus.py doesn't import distributed just for its arguments
+        self.assertEqual(to_opus.AUTHKEY_ENV, distributed.AUTHKEY_ENV)
+
+    def test_localize(self):
+        mapping = {'/srv/music': '/mnt/music', '/srv/opus/': '/mnt/opus'}
+        task = (partial(to_opus.worker.encode, timeout=60, extra_outputs=[('/srv/opus/phone/a.opus', ['--quiet'])]),
+                '/srv/music/a.flac', '/srv/opus/a.opus')
+
+        migrate, src, dest = distributed.localize(task, mapping)
+
+        self.assertEqual('/mnt/music/a.flac', src)
+        self.assertEqual('/mnt/opus/a.opus', dest)
+        self.assertEqual([('/mnt/opus/phone/a.opus', ['--quiet'])], migrate.keywords['extra_outputs'])
+        self.assertEqual('/srv/musicians/a.flac', distributed.localize('/srv/musicians/a.flac', mapping))
+
+    def test_parse_mapping(self):
+        self.assertEqual({'/srv': '/mnt'}, distributed.parse_mapping(['/srv=/mnt']))
+        self.assertRaises(ValueError, distributed.parse_mapping, ['/srv'])
+
+    def test_coordinator_requeues_lost_tasks(self):
+        coordinator = distributed.Coordinator(('127.0.0.1', 0), authkey, ('opusenc', [], 0))
+        results = []
+        coordinator.apply_async(len, ('abc',), callback=results.append)
+
+        lost = Client(coordinator.address, authkey=authkey)
+        lost.send('lost')
+        self.assertEqual(('opusenc', [], 0), lost.recv())
+        self.assertEqual((len, ('abc',)), lost.recv())
+        lost.close()
+
+        with Client(coordinator.address, authkey=authkey) as connection:
+            connection.send('other')
+            connection.recv()
+            func, args = connection.recv()
+            connection.send((True, func(*args)))
+            joined = threading.Thread(target=coordinator.join)
+            joined.start()
+            # No more tasks
+            self.assertIsNone(connection.recv())
+        joined.join()
+
+        self.assertEqual([3], results)
+
+    def test_workers_loopback(self):
+        port = free_port()
+        workers = [subprocess.Popen([sys.executable, 'distributed.py', '--connect', '127.0.0.1:%d' % port,
+                                     '--authkey', authkey.decode(), '--threads', '2', '--connect-timeout', '30'],
+                                    cwd=os.path.dirname(test_dir), stdout=subprocess.DEVNULL)
+                   for _ in range(2)]
+        try:
+            with tempfile.TemporaryDirectory() as target_dir:
+                db = {}
+                mig = to_opus.Migrator(source_dir, target_dir, db=db, serve=('127.0.0.1', port), authkey=authkey)
+
+                mig.migrate()
+
+                self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, {'desktop.ini.txt', 'Folder.jpg.txt'}))
+                self.assertEqual([], mig.failures)
+                self.assertIn('encode_time', db['flac'])
+                self.assertEqual([0, 0], [process.wait(30) for process in workers])
+                # Recorded as reported by the workers, so the next run compares against what they encoded with
+                self.assertEqual(to_opus.encoders.version('opusenc'), db['flac']['encoder_version'])
+                again = to_opus.Migrator(source_dir, target_dir, db=db, serve=('127.0.0.1', port), authkey=authkey)
+                self.assertEqual(0, again.plan().summary()['convert']['count'])
+        finally:
+            for process in workers:
+                if process.poll() is None:
+                    process.kill()
+
+
+if __name__ == '__main__':
+    unittest.main()
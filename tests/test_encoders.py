@@ -0,0 +1,125 @@
+import unittest
+from unittest import mock
+
+import os
+import shutil
+import tempfile
+
+import encoders
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+source_dir = tests_dir + os.sep + 'source'
+
+
+class TestEncoders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_create_unknown(self):
+        with self.assertRaises(ValueError):
+            encoders.create('lame', [])
+
+    def test_opusenc(self):
+        dest = self.tmp_dir + os.sep + 'wave.opus'
+
+        encoders.create('opusenc', ['--quiet']).encode(source_dir + os.sep + 'wave.wav', dest)
+
+        self.assertTrue(os.path.isfile(dest))
+
+    def test_opusenc_fallback_copy(self):
+        encoders.create('opusenc', ['--quiet']).encode(source_dir + os.sep + 'vorbis.ogg',
+                                                       self.tmp_dir + os.sep + 'vorbis.opus')
+
+        self.assertEqual(['vorbis.ogg'], os.listdir(self.tmp_dir))
+
+    def test_opusenc_encode_many(self):
+        outputs = [(self.tmp_dir + os.sep + name + '.opus', ['--quiet']) for name in ['low', 'high']]
+
+        encoders.create('opusenc', []).encode_many(source_dir + os.sep + 'wave.wav', outputs)
+
+        self.assertEqual(['high.opus', 'low.opus'], sorted(os.listdir(self.tmp_dir)))
+
+    def test_profile(self):
+        default = encoders.profile('opusenc', [])
+
+        self.assertEqual(default, encoders.profile('opusenc', ['--quiet']))
+        self.assertNotEqual(default, encoders.profile('opusenc', ['--bitrate', '96']))
+        self.assertNotEqual(default, encoders.profile('sndfile', []))
+        # libsndfile ignores the arguments
+        self.assertEqual(encoders.profile('sndfile', []), encoders.profile('sndfile', ['--bitrate', '96']))
+
+    def test_partial_output(self):
+        dest = self.tmp_dir + os.sep + 'wave.opus'
+
+        with self.assertRaises(OSError):
+            with encoders.partial_output(dest) as partial:
+                with open(partial, 'w') as f:
+                    f.write('truncated')
+                raise OSError('disk full')
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+        with encoders.partial_output(dest) as partial:
+            with open(partial, 'w') as f:
+                f.write('complete')
+        self.assertEqual(['wave.opus'], os.listdir(self.tmp_dir))
+
+    def test_copy(self):
+        encoders.copy(source_dir + os.sep + 'vorbis.ogg', self.tmp_dir + os.sep + 'vorbis.ogg')
+
+        self.assertEqual(['vorbis.ogg'], os.listdir(self.tmp_dir))
+
+    def test_copy_hardlink(self):
+        src = self.tmp_dir + os.sep + 'cover.jpg'
+        with open(src, 'w') as f:
+            f.write('image')
+        os.makedirs(self.tmp_dir + os.sep + 'out')
+        dest = self.tmp_dir + os.sep + 'out' + os.sep + 'cover.jpg'
+
+        encoders.copy(src, dest, hardlink=True)
+
+        self.assertTrue(os.path.samefile(src, dest))
+        self.assertEqual(['cover.jpg'], os.listdir(self.tmp_dir + os.sep + 'out'))
+
+    @unittest.skipIf(soundfile is None, 'soundfile is not installed')
+    def test_sndfile(self):
+        encoder = encoders.create('sndfile', [])
+
+        for file in ['wave.wav', 'flac.flac', 'aiff.aif']:
+            dest = self.tmp_dir + os.sep + file + '.opus'
+            encoder.encode(source_dir + os.sep + file, dest)
+
+            info = soundfile.info(dest)
+            self.assertEqual(('OGG', 'OPUS'), (info.format, info.subtype))
+            self.assertAlmostEqual(soundfile.info(source_dir + os.sep + file).duration, info.duration, places=1)
+
+    @unittest.skipIf(soundfile is None, 'soundfile is not installed')
+    def test_sndfile_streams_to_several_outputs(self):
+        src = source_dir + os.sep + 'flac.flac'
+        dests = [self.tmp_dir + os.sep + name + '.opus' for name in ['a', 'b']]
+        with mock.patch('encoders.SNDFILE_BLOCK', 1024):
+            encoders.create('sndfile', []).encode_many(src, [(dest, []) for dest in dests])
+
+        duration = soundfile.info(src).duration
+        for dest in dests:
+            self.assertAlmostEqual(duration, soundfile.info(dest).duration, places=1)
+        self.assertEqual(['a.opus', 'b.opus'], sorted(os.listdir(self.tmp_dir)))
+
+    @unittest.skipIf(soundfile is None, 'soundfile is not installed')
+    def test_sndfile_hands_ogg_to_opusenc(self):
+        encoders.create('sndfile', ['--quiet']).encode(source_dir + os.sep + 'vorbis.ogg',
+                                                       self.tmp_dir + os.sep + 'vorbis.opus')
+
+        self.assertEqual(['vorbis.ogg'], os.listdir(self.tmp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
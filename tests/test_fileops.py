@@ -0,0 +1,60 @@
+import unittest
+
+import filecmp
+import os
+import shutil
+import tempfile
+
+import fileops
+
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+source_dir = tests_dir + os.sep + 'source'
+
+
+class TestFileops(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = source_dir + os.sep + 'wave.wav'
+        self.dest = self.tmp_dir + os.sep + 'wave.wav'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_copy_file(self):
+        method = fileops.copy_file(self.src, self.dest)
+
+        self.assertIn(method, ['reflink', 'copy_file_range', 'copyfile'])
+        self.assertTrue(filecmp.cmp(self.src, self.dest, shallow=False))
+
+    def test_copy_file_overwrites(self):
+        with open(self.dest, 'w') as f:
+            f.write('old content that is longer than nothing')
+        empty = self.tmp_dir + os.sep + 'empty'
+        open(empty, 'w').close()
+
+        fileops.copy_file(empty, self.dest)
+
+        self.assertEqual(0, os.path.getsize(self.dest))
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'copy_file_range is not available')
+    def test_copy_range(self):
+        with open(self.src, 'rb') as fsrc, open(self.dest, 'wb') as fdst:
+            copied = fileops.copy_range(fsrc, fdst)
+
+        if copied:
+            self.assertTrue(filecmp.cmp(self.src, self.dest, shallow=False))
+
+    def test_link(self):
+        src = self.tmp_dir + os.sep + 'cover.jpg'
+        with open(src, 'w') as f:
+            f.write('image')
+
+        self.assertTrue(fileops.link(src, self.dest))
+        self.assertTrue(os.path.samefile(src, self.dest))
+        # Existing files aren't replaced
+        self.assertFalse(fileops.link(src, self.dest))
+
+
+if __name__ == '__main__':
+    unittest.main()
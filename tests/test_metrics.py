@@ -0,0 +1,120 @@
+import unittest
+
+import os
+import socket
+import tempfile
+import time
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_timer(self):
+        stats = metrics.Metrics()
+
+        with stats.timer('scan'):
+            time.sleep(0.01)
+        stats.add_time('encode', 2.5)
+        stats.add_time('encode', 1.5)
+
+        count, seconds = stats.stages['scan']
+        self.assertEqual(1, count)
+        self.assertGreaterEqual(seconds, 0.01)
+        self.assertEqual((2, 4.0), stats.stages['encode'])
+
+    def test_progress(self):
+        stats = metrics.Metrics(progress_interval=0)
+        stats.start(4, 4000)
+        stats.execute_time -= 10
+
+        stats.job_done('convert', 1000)
+        stats.job_done('copy', 1000, failed=True)
+
+        progress = stats.progress()
+        self.assertTrue(progress.startswith('progress: 2/4 files (50.0%)'), progress)
+        self.assertIn('ETA 10s', progress)
+        self.assertEqual({'convert': (1, 1000)}, stats.done)
+        self.assertEqual(1, stats.failures)
+
+    def test_progress_of_next_plan(self):
+        stats = metrics.Metrics(progress_interval=0)
+        stats.start(2, 2000)
+        stats.job_done('convert', 1000)
+        stats.job_done('convert', 1000)
+
+        stats.start(1, 500)
+        stats.execute_time -= 10
+        stats.job_done('copy', 250)
+
+        progress = stats.progress()
+        self.assertTrue(progress.startswith('progress: 1/1 files (100.0%)'), progress)
+        self.assertIn('ETA 10s', progress)
+        self.assertEqual({'convert': (2, 2000), 'copy': (1, 250)}, stats.done)
+
+    def test_summary(self):
+        stats = metrics.Metrics()
+        stats.job_done('convert', 1000)
+        stats.add_time('db', 0.5)
+
+        summary = stats.summary()
+
+        self.assertEqual({'convert': {'count': 1, 'bytes': 1000}}, summary['files'])
+        self.assertEqual({'count': 1, 'seconds': 0.5}, summary['stages']['db'])
+        self.assertEqual(set(metrics.STAGES), set(summary['stages']))
+
+    def test_source_read(self):
+        stats = metrics.Metrics()
+
+        for rel_dir in ['a', 'a', 'b', 'a', 'a']:
+            stats.source_read(rel_dir)
+
+        self.assertEqual(3, stats.dir_switches)
+        self.assertEqual(3, stats.summary()['dir_switches'])
+
+    def test_prometheus_exporter(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = tmp_dir + os.sep + 'metrics.prom'
+            stats = metrics.Metrics(exporters=[metrics.create_exporter('prometheus:' + path)])
+            stats.job_done('convert', 1000)
+            stats.job_done('copy', 10)
+
+            stats.export()
+
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(1, lines.count('# TYPE to_opus_action_files counter'))
+            index = lines.index('# TYPE to_opus_action_files counter')
+            self.assertEqual(['to_opus_action_files{action="convert"} 1', 'to_opus_action_files{action="copy"} 1'],
+                             lines[index + 1:index + 3])
+            self.assertIn('to_opus_files_done 2', lines)
+            self.assertEqual(['metrics.prom'], os.listdir(tmp_dir))
+
+    def test_statsd_exporter(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server:
+            server.bind(('127.0.0.1', 0))
+            server.settimeout(5)
+            stats = metrics.Metrics(exporters=[metrics.create_exporter('statsd:127.0.0.1:%d' % server.getsockname()[1])])
+            stats.job_done('convert', 1000)
+
+            stats.finish()
+
+            received = set()
+            while b'to_opus.files_done:1|g' not in received:
+                received.add(server.recv(1024))
+            self.assertNotIn(b'to_opus.failures:1|g', received)
+
+    def test_create_exporter_unknown(self):
+        with self.assertRaises(ValueError):
+            metrics.create_exporter('graphite:localhost:2003')
+        with self.assertRaises(ValueError):
+            metrics.create_exporter('prometheus')
+
+    def test_format_duration(self):
+        self.assertEqual('42s', metrics.format_duration(42))
+        self.assertEqual('2m05s', metrics.format_duration(125))
+        self.assertEqual('1h23m', metrics.format_duration(5000))
+
+
+if __name__ == '__main__':
+    unittest.main()
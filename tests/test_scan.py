@@ -0,0 +1,160 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import scan
+
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+source_dir = tests_dir + os.sep + 'source'
+
+
+def locked_scandir(name: str):
+    """
+    Returns an os.scandir that fails with PermissionError for directories with the given name.
+    """
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if os.path.basename(path) == name:
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    return fake_scandir
+
+
+class TestScan(unittest.TestCase):
+
+    def test_scan(self):
+        index = scan.scan(source_dir)
+
+        expected = set()
+        for root, _, files in os.walk(source_dir):
+            for file in files:
+                rel_base, ext = os.path.splitext(os.path.relpath(root + os.sep + file, source_dir))
+                expected.add((rel_base, ext))
+        self.assertEqual(expected, {(e.rel_base, e.ext) for e in index.entries()})
+        self.assertEqual(len(expected), len(index))
+        self.assertEqual({'nested', 'nested' + os.sep + 'deep'}, set(index.dirs))
+        self.assertEqual(os.path.getsize(source_dir + os.sep + 'wave.wav'), index.extensions('wave')['.wav'].st_size)
+
+    def test_scan_without_stat(self):
+        index = scan.scan(source_dir, stat=False)
+
+        self.assertTrue(index.contains('nested' + os.sep + 'deep' + os.sep + 'flac-ogg', '.ogg'))
+        self.assertFalse(index.contains('nested' + os.sep + 'deep' + os.sep + 'flac-ogg', '.opus'))
+        self.assertIsNone(index.extensions('wave')['.wav'])
+
+    def test_scan_missing_root(self):
+        index = scan.scan(source_dir + os.sep + 'missing')
+
+        self.assertEqual(0, len(index))
+        self.assertEqual([], index.dirs)
+
+    def test_scan_does_not_follow_dir_symlinks(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.symlink(source_dir, tmp_dir + os.sep + 'link')
+            index = scan.scan(tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(['link'], index.dirs)
+        self.assertEqual(0, len(index))
+
+    def test_scan_skips_unreadable_entries(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(tmp_dir + os.sep + 'album')
+            for name in ['a.flac', 'c.flac', 'd.txt']:
+                open(tmp_dir + os.sep + 'album' + os.sep + name, 'w').close()
+            os.symlink(tmp_dir + os.sep + 'missing', tmp_dir + os.sep + 'album' + os.sep + 'b.flac')
+            index = scan.scan(tmp_dir, threads=1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        album = 'album' + os.sep
+        self.assertEqual({album + 'a', album + 'c', album + 'd'}, set(index.files))
+        self.assertFalse(index.readable(album + 'b'))
+        self.assertTrue(index.readable(album + 'a'))
+
+    def test_scan_skips_unreadable_dirs(self):
+        with mock.patch('os.scandir', side_effect=locked_scandir('nested')):
+            index = scan.scan(source_dir, threads=1)
+
+        self.assertIn('wave', index.files)
+        self.assertFalse([rel_base for rel_base in index.files if rel_base.startswith('nested')])
+        self.assertFalse(index.readable('nested' + os.sep + 'deep' + os.sep + 'wave'))
+        self.assertTrue(index.readable('wave'))
+
+    def test_scan_unreadable_root(self):
+        with mock.patch('os.scandir', side_effect=locked_scandir(os.path.basename(source_dir))):
+            self.assertRaises(PermissionError, scan.scan, source_dir)
+
+    def make_tree(self, root: str) -> None:
+        for i in range(20):
+            for j in range(5):
+                rel_dir = root + os.sep + 'artist%02d' % i + os.sep + 'album%d' % j
+                os.makedirs(rel_dir)
+                for k in range(3):
+                    open(rel_dir + os.sep + 'track%d.flac' % k, 'w').close()
+
+    def test_iter_dirs(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.make_tree(tmp_dir)
+            serial = list(scan.iter_dirs(tmp_dir, threads=1, ordered=True))
+            ordered = list(scan.iter_dirs(tmp_dir, threads=4, ordered=True))
+            unordered = list(scan.iter_dirs(tmp_dir, stat=False, threads=4))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(121, len(serial))
+        self.assertEqual([listing.rel_dir for listing in serial], [listing.rel_dir for listing in ordered])
+        self.assertEqual(['', 'artist00', 'artist00' + os.sep + 'album0'], [listing.rel_dir for listing in serial[:3]])
+        self.assertEqual([name for name, _ in serial[2].files], ['track0.flac', 'track1.flac', 'track2.flac'])
+        self.assertEqual({(listing.rel_dir, len(listing.dirs), len(listing.files)) for listing in serial},
+                         {(listing.rel_dir, len(listing.dirs), len(listing.files)) for listing in unordered})
+        self.assertIsNotNone(serial[2].files[0][1])
+        self.assertTrue(all(file_stat is None for listing in unordered for _, file_stat in listing.files))
+
+    def test_iter_dirs_consumer_stops_early(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.make_tree(tmp_dir)
+            listings = scan.iter_dirs(tmp_dir, threads=4)
+            first = next(listings)
+            listings.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual('', first.rel_dir)
+
+    def test_scan_threads(self):
+        serial = scan.scan(source_dir, threads=1)
+        parallel = scan.scan(source_dir, threads=4)
+
+        self.assertEqual(set(serial.files), set(parallel.files))
+        self.assertEqual(sorted(serial.dirs), sorted(parallel.dirs))
+
+    def test_scan_paths(self):
+        index = scan.scan_paths(source_dir, ['wave.wav', 'nested' + os.sep + 'deep', 'missing.flac'], stat=False)
+
+        self.assertEqual({'wave': {'.wav': None}}, {k: v for k, v in index.files.items() if os.sep not in k})
+        self.assertTrue(index.contains('nested' + os.sep + 'deep' + os.sep + 'flac', '.flac'))
+        self.assertFalse(index.contains('nested' + os.sep + 'text', '.txt'))
+        self.assertEqual(['nested' + os.sep + 'deep'], index.dirs)
+
+    def test_index_remove(self):
+        index = scan.scan(source_dir, stat=False)
+
+        index.remove('wave', '.wav')
+        index.remove('wave', '.wav')
+
+        self.assertFalse(index.contains('wave', '.wav'))
+        self.assertNotIn('wave', index.files)
+
+
+if __name__ == '__main__':
+    unittest.main()
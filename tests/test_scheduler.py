@@ -0,0 +1,61 @@
+import unittest
+
+import os
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import scheduler
+
+
+def throttle(load: float = 0.0, io_pressure: float = 0.0) -> scheduler.Throttle:
+    t = scheduler.Throttle(cores=8, interval=3600)
+    t.update()
+    t.load, t.io_pressure = load, io_pressure
+    return t
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_cpu_count(self):
+        self.assertGreaterEqual(scheduler.cpu_count(), 1)
+
+    def test_read_io_pressure(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('some avg10=42.50 avg60=10.00 avg300=2.00 total=123\n'
+                        'full avg10=30.00 avg60=5.00 avg300=1.00 total=100\n')
+            self.assertEqual(42.5, scheduler.read_io_pressure(path))
+        finally:
+            os.remove(path)
+
+        self.assertEqual(0.0, scheduler.read_io_pressure(path))
+
+    def test_cpu_limit(self):
+        # Only our own encodes are running
+        self.assertEqual(8, throttle(load=6).cpu_limit(8, running=6))
+        # Other processes use 5 of the 8 cores
+        self.assertEqual(3, throttle(load=9).cpu_limit(8, running=4))
+        # Never stops completely
+        self.assertEqual(1, throttle(load=20).cpu_limit(8, running=0))
+
+    def test_io_limit(self):
+        self.assertEqual(4, throttle(io_pressure=10).io_limit(4))
+        self.assertEqual(2, throttle(io_pressure=50).io_limit(4))
+        self.assertEqual(1, throttle(io_pressure=100).io_limit(4))
+
+    def test_lane(self):
+        lane = scheduler.Lane('io', ThreadPool(1), 2, cpu_bound=False)
+        try:
+            self.assertTrue(lane.try_acquire(None))
+            self.assertTrue(lane.try_acquire(None))
+            self.assertFalse(lane.try_acquire(None))
+            lane.release()
+            self.assertFalse(lane.try_acquire(throttle(io_pressure=90)))
+            self.assertTrue(lane.try_acquire(throttle()))
+        finally:
+            lane.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import json
+import unittest
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import tracemalloc
+
+import state
+
+tests_dir = os.path.dirname(os.path.realpath(__file__))
+db_full = tests_dir + os.sep + 'db_full.json'
+
+
+class MicroMock(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_journal(self):
+        path = self.tmp_dir + os.sep + 'journal'
+        journal = state.Journal(path)
+        self.assertFalse(journal.exists())
+
+        journal.begin({'jobs': []})
+        journal.started(('convert', 'a', '.opus'))
+        journal.started(('copy', 'b', '.jpg'))
+        journal.finished(('convert', 'a', '.opus'))
+        journal.close()
+        # Cut off in the middle of a line, as if the run was killed
+        with open(path, 'a') as f:
+            f.write('{"finished": ["co')
+
+        plan, started, finished = state.Journal(path).load()
+
+        self.assertEqual({'jobs': []}, plan)
+        self.assertEqual({('convert', 'a', '.opus'), ('copy', 'b', '.jpg')}, started)
+        self.assertEqual({('convert', 'a', '.opus')}, finished)
+
+    def test_journal_complete(self):
+        journal = state.Journal(self.tmp_dir + os.sep + 'journal')
+        journal.begin({'jobs': []})
+
+        journal.close(complete=True)
+
+        self.assertFalse(journal.exists())
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def check_store(self, store: state.Store):
+        store['a'] = {'size': 1, 'last_modified': 2.5}
+        store['b'] = {'size': 3, 'last_modified': 4.5, 'codec': 'flac'}
+
+        self.assertEqual({'size': 1, 'last_modified': 2.5}, store['a'])
+        self.assertEqual('flac', store['b']['codec'])
+        self.assertIn('a', store)
+        self.assertNotIn('c', store)
+        self.assertIsNone(store.get('c'))
+        self.assertEqual({'a', 'b'}, set(store))
+        self.assertEqual(2, len(store))
+
+        del store['a']
+        self.assertNotIn('a', store)
+        with self.assertRaises(KeyError):
+            del store['a']
+
+    def test_json_store(self):
+        path = self.tmp_dir + os.sep + 'db.json'
+        store = state.open_store(path)
+        self.assertIsInstance(store, state.JsonStore)
+        self.check_store(store)
+        store.close()
+
+        with open(path) as f:
+            self.assertEqual({'b': {'size': 3, 'last_modified': 4.5, 'codec': 'flac'}}, json.load(f))
+
+    def test_sqlite_store(self):
+        path = self.tmp_dir + os.sep + 'db.sqlite'
+        store = state.open_store(path)
+        self.assertIsInstance(store, state.SqliteStore)
+        self.check_store(store)
+        store.close()
+
+        store = state.open_store(path)
+        self.assertEqual({'size': 3, 'last_modified': 4.5, 'codec': 'flac'}, store['b'])
+        store.close()
+
+    def test_compact_records(self):
+        records = state.CompactRecords()
+        record = {'size': 1, 'last_modified': 2.5, 'codec': None, 'profiles': {'default': 'abc'}, 'other': [1]}
+        records['album' + os.sep + 'track'] = record
+        records['top'] = {'size': 3}
+
+        self.assertEqual(record, records['album' + os.sep + 'track'])
+        self.assertEqual({'size': 3}, records['top'])
+        self.assertEqual(2, len(records))
+        self.assertEqual({'album' + os.sep + 'track', 'top'}, set(records))
+        self.assertNotIn('album', records)
+
+        del records['album' + os.sep + 'track']
+        self.assertEqual({'top'}, set(records))
+        self.assertEqual({'': {'top': state.pack({'size': 3})}}, records.dirs)
+        with self.assertRaises(KeyError):
+            del records['album' + os.sep + 'track']
+
+    def test_compact_records_loads(self):
+        with open(db_full) as f:
+            text = f.read()
+
+        self.assertEqual(json.loads(text), dict(state.CompactRecords.loads(text).items()))
+        self.assertEqual({}, dict(state.CompactRecords.loads(' { } ').items()))
+        self.assertEqual({'a': {'size': 1}}, dict(state.CompactRecords.loads('{"a" : {"size": 1}}\n').items()))
+        with self.assertRaises(ValueError):
+            state.CompactRecords.loads('{"a": {"size": 1}')
+
+    def test_compact_records_memory(self):
+        data = {'album %d' % (i // 20) + os.sep + 'track %d' % i:
+                {'size': 30000000 + i, 'last_modified': 1548508112.5 + i, 'inode': 1000000 + i, 'codec': 'flac',
+                 'profiles': {'default': '0123456789abcdef'}}
+                for i in range(2000)}
+        text = json.dumps(data)
+
+        def allocated(load):
+            tracemalloc.start()
+            try:
+                loaded = load(text)
+                return tracemalloc.get_traced_memory()[0], loaded
+            finally:
+                tracemalloc.stop()
+
+        compact, records = allocated(state.CompactRecords.loads)
+        plain, _ = allocated(json.loads)
+        self.assertEqual(data, dict(records.items()))
+        self.assertLess(compact, plain * 0.5)
+
+    def test_sqlite_store_by_directory(self):
+        path = self.tmp_dir + os.sep + 'db.sqlite'
+        # Created before the dir column existed
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE entries (rel_path TEXT PRIMARY KEY, size INTEGER, last_modified REAL, '
+                           'extra TEXT)')
+        connection.execute("INSERT INTO entries VALUES (?, 1, 2.5, NULL)", ('album' + os.sep + 'a',))
+        connection.commit()
+        connection.close()
+
+        store = state.SqliteStore(path)
+        self.assertEqual({'size': 1, 'last_modified': 2.5}, store['album' + os.sep + 'a'])
+        self.assertIn('album', store.cache)
+
+        # Cached directories are updated along with the database
+        store['album' + os.sep + 'b'] = {'size': 3, 'last_modified': 4.5}
+        del store['album' + os.sep + 'a']
+        self.assertEqual({'b'}, set(store.cache['album']))
+        store.cache.clear()
+        self.assertNotIn('album' + os.sep + 'a', store)
+        self.assertEqual({'size': 3, 'last_modified': 4.5}, store['album' + os.sep + 'b'])
+        store.close()
+
+    def test_json_store_write_frequency(self):
+        path = self.tmp_dir + os.sep + 'db.json'
+        store = state.JsonStore(path, write_frequency=3)
+
+        for i in range(3):
+            store[str(i)] = {'size': i, 'last_modified': i}
+
+        with open(path) as f:
+            self.assertEqual(1, len(json.load(f)))
+
+    def test_import_json(self):
+        path = self.tmp_dir + os.sep + 'db.sqlite'
+
+        exit_code = state.main(MicroMock(input=db_full, output=path, backend=None))
+
+        self.assertEqual(0, exit_code)
+        with open(db_full) as f:
+            expected = json.load(f)
+        store = state.open_store(path)
+        self.assertEqual(expected, dict(store.items()))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,18 @@
+import io
+import json
+import subprocess
 import sys
+import threading
 import unittest
+from functools import partial
+from unittest import mock
 
 import os
 import shutil
 
 import base_diff
+import budget
+import state
 import to_opus
 
 test_dir = os.path.dirname(os.path.realpath(__file__))
@@ -17,6 +25,29 @@ db_empty_tmp = db_empty + '.tmp'
 db_full = test_dir + os.sep + 'db_full.json'
 db_full_tmp = db_full + '.tmp'
 db_nonexistent = test_dir + os.sep + 'db_nonexistent.json'
+db_sqlite = test_dir + os.sep + 'db.sqlite'
+plan_file = test_dir + os.sep + 'plan.json'
+summary_file = test_dir + os.sep + 'summary.json'
+journal_file = test_dir + os.sep + 'journal'
+metrics_file = test_dir + os.sep + 'metrics.prom'
+migration_log = test_dir + os.sep + 'migrations.log'
+
+# Modules only imported by the runs that need them, so short runs start fast
+LAZY_MODULES = ['multiprocessing', 'configargparse', 'sqlite3', 'socket', 'ctypes', 'filecmp', 'shlex', 'watch']
+# Seconds importing to_opus may take, a cold start is dominated by it
+IMPORT_BUDGET = 0.5
+
+
+def failing_migration(src: str, dest: str, timeout: float = None) -> None:
+    raise OSError('cannot migrate ' + src)
+
+
+def logging_migration(src: str, dest: str, timeout: float = None) -> None:
+    # Runs in pool processes, which only share the file
+    with open(migration_log, 'a') as f:
+        f.write(src + '\n')
+    if 'wave' in src:
+        raise OSError('cannot migrate ' + src)
 
 
 class MicroMock(object):
@@ -27,6 +58,53 @@ class MicroMock(object):
 ignored_files = {'desktop.ini.txt', 'Folder.jpg.txt'}
 
 
+def main_cfg(**kwargs) -> MicroMock:
+    cfg = dict(
+        source=source_dir,
+        target=target_dir,
+        verbose=True,
+        opusenc_args=[],
+        database=None,
+        db_backend=None,
+        check='stat',
+        encoder='opusenc',
+        del_removed=None,
+        threads=8,
+        copy_threads=4,
+        no_throttle=False,
+        hardlink=False,
+        extra_target=[],
+        group_albums=False,
+        target_size=None,
+        serve=None,
+        authkey=None,
+        exclude=None,
+        plan=None,
+        apply=None,
+        progress=60,
+        summary=None,
+        metrics=[],
+        journal=None,
+        watch=False,
+        poll=None,
+        settle=5,
+        scan_threads=8,
+        files_from=None,
+    )
+    cfg.update(kwargs)
+    return MicroMock(**cfg)
+
+
+def migrated(file: str) -> str:
+    """
+    Copies a golden file into the target dir, like a previous run would have done.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    dest_file = target_dir + os.sep + file
+    shutil.copyfile(golden_dir + os.sep + file, dest_file)
+    return dest_file
+
+
 def clean_up():
     if os.path.exists(target_dir):
         shutil.rmtree(target_dir)
@@ -36,6 +114,10 @@ def clean_up():
         os.remove(db_full_tmp)
     if os.path.exists(db_nonexistent):
         os.remove(db_nonexistent)
+    for path in [db_sqlite, db_sqlite + '-wal', db_sqlite + '-shm', plan_file, summary_file, metrics_file, journal_file,
+                 migration_log]:
+        if os.path.exists(path):
+            os.remove(path)
 
 
 class TestToOpus(unittest.TestCase):
@@ -49,61 +131,605 @@ class TestToOpus(unittest.TestCase):
         clean_up()
 
     def test_main(self):
-        to_opus.main(MicroMock(
-            source=source_dir,
-            target=target_dir,
-            verbose=True,
-            opusenc_args=[],
-            database=None,
-            del_removed=None,
-            threads=8,
-            exclude=None
-        ))
+        to_opus.main(main_cfg())
 
         self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
 
     def test_main_db_empty(self):
-        to_opus.main(MicroMock(
-            source=source_dir,
-            target=target_dir,
-            verbose=True,
-            opusenc_args=[],
-            database=db_empty_tmp,
-            del_removed=None,
-            threads=8,
-            exclude=None
-        ))
+        to_opus.main(main_cfg(database=db_empty_tmp))
 
         self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, set()))
 
     def test_main_db_full(self):
-        to_opus.main(MicroMock(
-            source=source_dir,
-            target=target_dir,
-            verbose=True,
-            opusenc_args=[],
-            database=db_full_tmp,
-            del_removed=None,
-            threads=8,
-            exclude=None
-        ))
+        to_opus.main(main_cfg(database=db_full_tmp))
 
         self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
 
     def test_main_db_nonexistent(self):
-        to_opus.main(MicroMock(
-            source=source_dir,
-            target=target_dir,
-            verbose=True,
-            opusenc_args=[],
-            database=db_nonexistent,
-            del_removed=None,
-            threads=8,
-            exclude=None
-        ))
+        to_opus.main(main_cfg(database=db_nonexistent))
 
         self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
 
+    def test_main_db_sqlite(self):
+        to_opus.main(main_cfg(database=db_sqlite))
+
+        self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
+        store = to_opus.state.open_store(db_sqlite)
+        self.assertEqual(os.path.getsize(source_dir + os.sep + 'wave.wav'), store['wave']['size'])
+        store.close()
+
+    def test_migrate_moved_files(self):
+        src_dir = target_dir + os.sep + 'src'
+        dest_dir = target_dir + os.sep + 'dest'
+        shutil.copytree(source_dir, src_dir)
+        db = {}
+        to_opus.Migrator(src_dir, dest_dir, threads=2, del_removed=True, db=db).migrate()
+
+        os.rename(src_dir + os.sep + 'nested', src_dir + os.sep + 'renamed')
+        mig = to_opus.Migrator(src_dir, dest_dir, threads=2, del_removed=True, db=db)
+        mig.migrations['convert'] = failing_migration
+        mig.migrate()
+
+        self.assertEqual([], mig.failures)
+        self.assertEqual(0, base_diff.diff_dirs(src_dir, dest_dir, ignored_files))
+        self.assertFalse(os.path.exists(dest_dir + os.sep + 'nested'))
+        self.assertIn('renamed' + os.sep + 'deep' + os.sep + 'wave', db)
+        self.assertNotIn('nested' + os.sep + 'deep' + os.sep + 'wave', db)
+
+    def test_profile_change(self):
+        db = {}
+        to_opus.Migrator(source_dir, target_dir, threads=2, db=db).migrate()
+        self.assertEqual(to_opus.encoders.profile('opusenc', []), db['wave']['profiles']['default'])
+
+        same = to_opus.Migrator(source_dir, target_dir, threads=2, opus_args=['--quiet'], db=db).plan()
+        self.assertEqual(0, same.summary()['convert']['count'])
+
+        changed = to_opus.Migrator(source_dir, target_dir, threads=2, opus_args=['--bitrate', '96'], db=db).plan()
+        # Every converted file is encoded again, copies are unaffected
+        self.assertEqual({'convert'}, {job.action for job in changed.jobs if job.rel_path in db
+                                       and db[job.rel_path].get('profiles')})
+        self.assertEqual(0, changed.summary()['copy']['count'])
+
+    def test_profile_change_after_upgrade(self):
+        db = {}
+        to_opus.Migrator(source_dir, target_dir, threads=2, db=db).migrate()
+        for record in db.values():
+            # Like the records of a version without profiles
+            record.pop('profiles', None)
+
+        to_opus.Migrator(source_dir, target_dir, threads=2, db=db).migrate()
+        self.assertEqual(to_opus.encoders.profile('opusenc', []), db['wave']['profiles']['default'])
+        self.assertNotIn('profiles', db['nested' + os.sep + 'text'])
+
+        changed = to_opus.Migrator(source_dir, target_dir, threads=2, opus_args=['--bitrate', '64'], db=db).plan()
+        self.assertEqual(10, changed.summary()['convert']['count'])
+
+    def test_profile_without_encoder(self):
+        db = {}
+        to_opus.Migrator(source_dir, target_dir, threads=2, db=db).migrate()
+        self.assertEqual(to_opus.encoders.version('opusenc'), db['wave']['encoder_version'])
+
+        # Like planning on a machine without opusenc
+        with mock.patch('encoders.version', return_value=to_opus.encoders.UNKNOWN_VERSION):
+            same = to_opus.Migrator(source_dir, target_dir, threads=2, db=db).plan()
+            changed = to_opus.Migrator(source_dir, target_dir, threads=2, opus_args=['--bitrate', '96'], db=db).plan()
+            for record in db.values():
+                record.pop('encoder_version', None)
+            unknown = to_opus.Migrator(source_dir, target_dir, threads=2, opus_args=['--bitrate', '96'], db=db).plan()
+
+        self.assertEqual(0, same.summary()['convert']['count'])
+        self.assertEqual(10, changed.summary()['convert']['count'])
+        self.assertEqual(0, unknown.summary()['convert']['count'])
+
+    def test_extra_targets(self):
+        phone_dir = target_dir + os.sep + 'phone'
+        car_dir = target_dir + os.sep + 'car'
+        dest_dir = target_dir + os.sep + 'dest'
+        db = {}
+        mig = to_opus.Migrator(source_dir, dest_dir, threads=2, db=db,
+                               extra_targets=[('phone', phone_dir, ['--bitrate', '64'])])
+        mig.migrate()
+
+        self.assertEqual([], mig.failures)
+        self.assertTrue(os.path.isfile(phone_dir + os.sep + 'nested' + os.sep + 'deep' + os.sep + 'wave.opus'))
+        self.assertFalse(os.path.exists(phone_dir + os.sep + 'desktop.ini.txt'))
+        self.assertEqual({'default', 'phone'}, set(db['wave']['profiles']))
+
+        # A new target only encodes for itself
+        extra_targets = [('phone', phone_dir, ['--bitrate', '64']), ('car', car_dir, ['--bitrate', '160'])]
+        plan = to_opus.Migrator(source_dir, dest_dir, threads=2, db=db, extra_targets=extra_targets).plan()
+        converts = [job for job in plan.jobs if job.action == 'convert']
+        self.assertGreater(len(converts), 0)
+        self.assertEqual([['car']], list({tuple(job.profiles): job.profiles for job in converts}.values()))
+
+        # Changed settings of one target
+        extra_targets = [('phone', phone_dir, ['--bitrate', '48'])]
+        plan = to_opus.Migrator(source_dir, dest_dir, threads=2, db=db, extra_targets=extra_targets).plan()
+        self.assertEqual({('phone',)}, {tuple(job.profiles) for job in plan.jobs if job.action == 'convert'})
+
+    def test_parse_extra_target(self):
+        self.assertEqual(('phone', '/media/phone', ['--bitrate', '64']),
+                         to_opus.parse_extra_target('phone:/media/phone:--bitrate 64'))
+        self.assertEqual(('car', '/media/car', []), to_opus.parse_extra_target('car:/media/car'))
+        with self.assertRaises(ValueError):
+            to_opus.parse_extra_target('/media/car')
+        with self.assertRaises(ValueError):
+            to_opus.parse_extra_target('default:/media/car')
+
+    def test_watch_changes(self):
+        src_dir = target_dir + os.sep + 'src'
+        dest_dir = target_dir + os.sep + 'dest'
+        shutil.copytree(source_dir, src_dir)
+        db = {}
+        mig = to_opus.Migrator(src_dir, dest_dir, threads=2, del_removed=True, db=db)
+        mig.migrate()
+
+        os.rename(src_dir + os.sep + 'nested', src_dir + os.sep + 'renamed')
+        os.remove(src_dir + os.sep + 'desktop.ini.txt')
+        shutil.copyfile(source_dir + os.sep + 'wave.wav', src_dir + os.sep + 'new.wav')
+        changes = {'nested', 'renamed', 'desktop.ini.txt', 'new.wav'}
+
+        summary = mig.plan_paths(changes).summary()
+        self.assertEqual(9, summary['move']['count'])
+        self.assertEqual(1, summary['delete']['count'])
+        self.assertEqual(1, summary['convert']['count'])
+        self.assertEqual(0, summary['skip']['count'])
+
+        to_opus.run_watch(mig, [changes, {'wave.wav'}])
+
+        self.assertEqual([], mig.failures)
+        self.assertEqual(0, base_diff.diff_dirs(src_dir, dest_dir, ignored_files))
+        self.assertFalse(os.path.exists(dest_dir + os.sep + 'nested'))
+        self.assertFalse(os.path.exists(dest_dir + os.sep + 'desktop.ini.txt'))
+        self.assertIn('new', db)
+        self.assertNotIn('desktop.ini', db)
+
+    def test_delete_removed(self):
+        to_opus.main(main_cfg())
+        orphans = [
+            target_dir + os.sep + 'orphan.opus',
+            target_dir + os.sep + 'orphan.jpg',
+            target_dir + os.sep + 'empty' + os.sep + 'nested' + os.sep + 'orphan.opus',
+        ]
+        for path in orphans:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        to_opus.Migrator(source_dir, target_dir).delete_removed()
+
+        for path in orphans:
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(target_dir + os.sep + 'empty'))
+        self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
+
+    def test_empty_dirs_only_deleted_with_del_removed(self):
+        empty_dir = target_dir + os.sep + 'empty'
+        os.makedirs(empty_dir)
+
+        to_opus.Migrator(source_dir, target_dir).migrate()
+        self.assertTrue(os.path.isdir(empty_dir))
+
+        to_opus.Migrator(source_dir, target_dir, del_removed=True).migrate()
+        self.assertFalse(os.path.exists(empty_dir))
+
+    def test_delete_removed_keeps_unreadable(self):
+        src_dir = target_dir + os.sep + 'src'
+        dest_dir = target_dir + os.sep + 'dest'
+        shutil.copytree(source_dir, src_dir)
+        broken = src_dir + os.sep + 'nested' + os.sep + 'broken.flac'
+        os.symlink(src_dir + os.sep + 'missing.flac', broken)
+        to_opus.Migrator(src_dir, dest_dir, threads=2, del_removed=True).migrate()
+        # Like the output of a source that can't be read right now
+        migrated_file = dest_dir + os.sep + 'nested' + os.sep + 'broken.opus'
+        open(migrated_file, 'w').close()
+
+        to_opus.Migrator(src_dir, dest_dir, threads=2, del_removed=True).migrate()
+
+        self.assertTrue(os.path.exists(migrated_file))
+        os.remove(broken)
+        os.remove(migrated_file)
+        self.assertEqual(0, base_diff.diff_dirs(src_dir, dest_dir, ignored_files))
+
+    def test_delete_removed_keeps_unreadable_dirs(self):
+        to_opus.main(main_cfg())
+        scandir = os.scandir
+        locked = source_dir + os.sep + 'nested'
+
+        def fake_scandir(path):
+            if path == locked:
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        with mock.patch('os.scandir', side_effect=fake_scandir):
+            plan = to_opus.Migrator(source_dir, target_dir, del_removed=True).plan()
+
+        self.assertEqual([], [job.rel_path for job in plan.jobs if job.action == 'delete'])
+        self.assertEqual([], plan.empty_dirs)
+
+    def test_main_plan(self):
+        exit_code = to_opus.main(main_cfg(plan=plan_file))
+
+        self.assertEqual(0, exit_code)
+        self.assertFalse(os.path.exists(target_dir))
+        with open(plan_file) as f:
+            plan = json.load(f)
+        self.assertEqual({'count': 10, 'bytes': 952624}, plan['summary']['convert'])
+        self.assertEqual(7, plan['summary']['copy']['count'])
+        self.assertEqual(17, len(plan['jobs']))
+        self.assertGreater(plan['estimated_cpu_seconds'], 0)
+
+    def test_main_files_from(self):
+        with open(plan_file, 'w') as f:
+            f.write('wave.wav\n' + source_dir + os.sep + 'nested' + os.sep + 'deep\n../outside.wav\n')
+
+        exit_code = to_opus.main(main_cfg(files_from=plan_file, database=db_sqlite))
+
+        self.assertEqual(0, exit_code)
+        self.assertEqual(['nested', 'wave.opus'], sorted(os.listdir(target_dir)))
+        self.assertEqual(8, len(os.listdir(target_dir + os.sep + 'nested' + os.sep + 'deep')))
+        db = state.open_store(db_sqlite)
+        self.assertEqual(9, len(db))
+        db.close()
+
+    def test_plan_paths_does_not_read_the_whole_db(self):
+        db = {}
+        to_opus.Migrator(source_dir, target_dir, db=db).migrate()
+        mig = to_opus.Migrator(source_dir, target_dir, db=db)
+
+        with mock.patch.object(to_opus.Migrator, 'encode_speed', side_effect=AssertionError('reads every record')):
+            plan = mig.plan_paths(['wave.wav'])
+
+        self.assertEqual(['skip'], [job.action for job in plan.jobs])
+
+    def test_main_files_from_stdin(self):
+        to_opus.main(main_cfg())
+        os.remove(target_dir + os.sep + 'flac.opus')
+        open(target_dir + os.sep + 'orphan.opus', 'w').close()
+        stdin = sys.stdin
+        sys.stdin = io.StringIO('flac.flac\0orphan.opus\0')
+        try:
+            exit_code = to_opus.main(main_cfg(files_from='-', del_removed=True))
+        finally:
+            sys.stdin = stdin
+
+        self.assertEqual(0, exit_code)
+        self.assertTrue(os.path.isfile(target_dir + os.sep + 'flac.opus'))
+        self.assertFalse(os.path.exists(target_dir + os.sep + 'orphan.opus'))
+        self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
+
+    def test_main_apply(self):
+        to_opus.main(main_cfg(plan=plan_file))
+
+        exit_code = to_opus.main(main_cfg(source=None, target=None, apply=plan_file))
+
+        self.assertEqual(0, exit_code)
+        self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
+
+    def test_plan_after_migration(self):
+        to_opus.main(main_cfg(del_removed=True))
+        # As if opusenc had failed on wave.wav
+        os.remove(target_dir + os.sep + 'wave.opus')
+        shutil.copyfile(source_dir + os.sep + 'wave.wav', target_dir + os.sep + 'wave.wav')
+        os.utime(target_dir + os.sep + 'wave.wav', (0, os.path.getmtime(source_dir + os.sep + 'wave.wav') - 1))
+        os.utime(target_dir + os.sep + 'vorbis.ogg', (0, os.path.getmtime(source_dir + os.sep + 'vorbis.ogg') - 1))
+        open(target_dir + os.sep + 'orphan.opus', 'w').close()
+
+        mig = to_opus.Migrator(source_dir, target_dir, del_removed=True)
+        plan = mig.plan()
+
+        summary = plan.summary()
+        # wave.wav is detected as lossless, so the failure might have been transient
+        self.assertEqual(0, summary['fallback-copy']['count'])
+        self.assertEqual(1, summary['copy']['count'])
+        self.assertEqual(1, summary['delete']['count'])
+        self.assertEqual(1, summary['convert']['count'])
+        self.assertEqual(15, summary['skip']['count'])
+
+        mig.execute(plan)
+        self.assertTrue(os.path.exists(target_dir + os.sep + 'wave.opus'))
+        self.assertFalse(os.path.exists(target_dir + os.sep + 'wave.wav'))
+
+    def test_plan_fallback_copy(self):
+        src_dir = target_dir + os.sep + 'src'
+        dest_dir = target_dir + os.sep + 'dest'
+        os.makedirs(src_dir)
+        os.makedirs(dest_dir)
+        for path in [src_dir + os.sep + 'unknown.flac', dest_dir + os.sep + 'unknown.flac']:
+            with open(path, 'wb') as f:
+                f.write(b'not audio')
+        shutil.copyfile(source_dir + os.sep + 'wave.wav', src_dir + os.sep + 'wave.wav')
+        shutil.copyfile(source_dir + os.sep + 'wave.wav', dest_dir + os.sep + 'wave.wav')
+        shutil.copyfile(golden_dir + os.sep + 'wave.opus', dest_dir + os.sep + 'wave.opus')
+        # Converted by a run that wasn't given the plan's target index (like --apply)
+        src_path = src_dir + os.sep + 'wave.wav'
+        db = {'wave': to_opus.Migrator(src_dir, dest_dir).entry('wave', src_path, os.stat(src_path), None,
+                                                                [to_opus.DEFAULT_PROFILE])}
+        mig = to_opus.Migrator(src_dir, dest_dir, db=db)
+
+        plan = mig.plan()
+
+        self.assertEqual({('fallback-copy', 'unknown'), ('skip', 'wave'), ('delete', 'wave')},
+                         {(job.action, job.rel_path) for job in plan.jobs})
+        mig.execute(plan)
+        self.assertEqual(['unknown.flac', 'wave.opus'], sorted(os.listdir(dest_dir)))
+        # The converted file is still recorded
+        self.assertIn('wave', db)
+
+    def test_plan_deletes_partial_outputs(self):
+        to_opus.main(main_cfg())
+        partial = target_dir + os.sep + 'nested' + os.sep + 'wave.opus.part'
+        open(partial, 'w').close()
+
+        plan = to_opus.Migrator(source_dir, target_dir).plan()
+
+        self.assertEqual([('delete', 'nested' + os.sep + 'wave.opus', '.part')],
+                         [job.key() for job in plan.jobs if job.action != 'skip'])
+        to_opus.Migrator(source_dir, target_dir).execute(plan)
+        self.assertFalse(os.path.exists(partial))
+        self.assertEqual(0, base_diff.diff_dirs(source_dir, target_dir, ignored_files))
+
+    def test_main_resume(self):
+        plan = to_opus.Migrator(source_dir, target_dir).plan()
+        jobs = {job.rel_path: job for job in plan.jobs}
+        # An interrupted run, which finished flac and died while converting wave
+        journal = state.Journal(journal_file)
+        journal.begin(plan.to_json())
+        journal.started(jobs['flac'].key())
+        journal.finished(jobs['flac'].key())
+        journal.started(jobs['wave'].key())
+        journal.close()
+        os.makedirs(target_dir)
+        open(target_dir + os.sep + 'wave.opus.part', 'w').close()
+
+        exit_code = to_opus.main(main_cfg(journal=journal_file))
+
+        self.assertEqual(0, exit_code)
+        self.assertFalse(os.path.exists(journal_file))
+        self.assertTrue(os.path.isfile(target_dir + os.sep + 'wave.opus'))
+        self.assertFalse(os.path.exists(target_dir + os.sep + 'wave.opus.part'))
+        # Finished before the run died, so it isn't done again
+        self.assertFalse(os.path.exists(target_dir + os.sep + 'flac.opus'))
+        self.assertTrue(os.path.isfile(target_dir + os.sep + 'nested' + os.sep + 'deep' + os.sep + 'flac.opus'))
+
+    def test_plan_codec(self):
+        mig = to_opus.Migrator(source_dir, target_dir)
+
+        jobs = {job.rel_path: job for job in mig.plan().jobs}
+
+        self.assertEqual(('copy', '.ogg'), (jobs['vorbis'].action, jobs['vorbis'].dest_ext))
+        self.assertEqual(('convert', '.opus'), (jobs['flac-ogg'].action, jobs['flac-ogg'].dest_ext))
+        self.assertEqual(('copy', '.opus'), (jobs['opus'].action, jobs['opus'].dest_ext))
+
+    def test_plan_up_to_date_without_probing(self):
+        to_opus.Migrator(source_dir, target_dir, threads=2).migrate()
+
+        with mock.patch('audio.probe', wraps=to_opus.audio.probe) as probe:
+            plan = to_opus.Migrator(source_dir, target_dir, threads=2).plan()
+
+        self.assertEqual({'skip'}, {job.action for job in plan.jobs})
+        # Only the copied Vorbis files, whose codec tells whether they are lossy copies or failed conversions
+        self.assertEqual(['vorbis.ogg', 'vorbis.ogg'], sorted(os.path.basename(call.args[0])
+                                                              for call in probe.call_args_list))
+
+    def test_record_codec(self):
+        db = {}
+        mig = to_opus.Migrator(source_dir, target_dir, db=db)
+
+        mig.record('vorbis', source_dir + os.sep + 'vorbis.ogg')
+        mig.record('opus', source_dir + os.sep + 'opus.opus')
+
+        self.assertEqual('vorbis', db['vorbis']['codec'])
+        self.assertNotIn('codec', db['opus'])
+
+    def test_main_exit_code(self):
+        exit_code = to_opus.main(main_cfg(verbose=False, threads=2))
+
+        self.assertEqual(0, exit_code)
+
+    def test_main_summary(self):
+        exit_code = to_opus.main(main_cfg(database=db_sqlite, summary=summary_file, progress=0,
+                                          metrics=['prometheus:' + metrics_file]))
+
+        self.assertEqual(0, exit_code)
+        with open(summary_file) as f:
+            summary = json.load(f)
+        self.assertEqual({'count': 10, 'bytes': 952624}, summary['files']['convert'])
+        self.assertEqual(0, summary['failures'])
+        self.assertEqual(1, summary['stages']['scan']['count'])
+        self.assertEqual(10, summary['stages']['encode']['count'])
+        self.assertGreater(summary['stages']['db']['count'], 10)
+        with open(metrics_file) as f:
+            self.assertIn('to_opus_action_files{action="convert"} 10\n', f.read())
+
+    def test_migrate_continues_after_failure(self):
+        db = {}
+        mig = to_opus.Migrator(source_dir, target_dir, threads=2, db=db)
+        mig.migrations['convert'] = failing_migration
+
+        mig.migrate()
+
+        self.assertEqual(10, len(mig.failures))
+        self.assertEqual(10, mig.stats.failures)
+        self.assertNotIn('wave', db)
+        self.assertIn('opus', db)
+        self.assertTrue(os.path.isfile(target_dir + os.sep + 'opus.opus'))
+
+    def test_fingerprint_in_workers(self):
+        db = {}
+        mig = to_opus.Migrator(source_dir, target_dir, threads=2, db=db, check='hash')
+        plan = mig.plan()
+        fingerprint = to_opus.audio.fingerprint
+        fingerprinted = []
+
+        def logging_fingerprint(path: str) -> str:
+            # Pool processes only append to their copy of the list
+            fingerprinted.append(path)
+            return fingerprint(path)
+
+        with mock.patch('audio.fingerprint', side_effect=logging_fingerprint):
+            mig.execute(plan)
+
+        converted = {source_dir + os.sep + job.rel_path + job.src_ext for job in plan.jobs if job.action == 'convert'}
+        self.assertEqual(10, len(converted))
+        self.assertEqual(set(), converted & set(fingerprinted))
+        self.assertEqual(fingerprint(source_dir + os.sep + 'wave.wav'), db['wave']['hash'])
+
+    def test_migrate_survives_db_errors(self):
+        class FailingDb(dict):
+            def __setitem__(self, key, value):
+                raise OSError('disk full')
+
+        mig = to_opus.Migrator(source_dir, target_dir, threads=2, db=FailingDb())
+        thread = threading.Thread(target=mig.migrate, daemon=True)
+        thread.start()
+        thread.join(60)
+
+        self.assertFalse(thread.is_alive(), 'waiting for the pool forever')
+        self.assertEqual(17, len(mig.failures))
+
+    def test_execute_longest_first(self):
+        copied = []
+        mig = to_opus.Migrator(source_dir, target_dir, threads=1, copy_threads=1, throttle=False)
+        mig.migrations['copy'] = lambda src, dest: copied.append(os.path.getsize(src))
+
+        mig.migrate()
+
+        self.assertGreater(len(copied), 1)
+        self.assertEqual(sorted(copied, reverse=True), copied)
+        self.assertEqual({'cpu': 0, 'io': 0}, {name: lane.running for name, lane in mig.lanes.items()})
+
+    def test_target_size(self):
+        db = {}
+        to_opus.Migrator(source_dir, target_dir, db=db, target_size=10 ** 9).migrate()
+
+        self.assertEqual({256}, {record['bitrate'] for record in db.values() if 'bitrate' in record})
+        self.assertAlmostEqual(4.0, db['flac']['seconds'])
+        plan = to_opus.Migrator(source_dir, target_dir, db=db, target_size=10 ** 9).plan()
+        self.assertEqual(0, plan.summary()['convert']['count'])
+
+        copied = sum(job.size for job in plan.jobs if job.dest_ext != '.opus')
+        mig = to_opus.Migrator(source_dir, target_dir, db=db, target_size=int((copied + 300000) / budget.HEADROOM))
+        plan = mig.plan()
+        converted = [job for job in plan.jobs if job.action == 'convert']
+        self.assertEqual(10, len(converted))
+        self.assertTrue(all(job.bitrate < 256 for job in converted))
+        mig.execute(plan)
+        self.assertEqual(0, to_opus.Migrator(source_dir, target_dir, db=db, target_size=mig.target_size).plan()
+                         .summary()['convert']['count'])
+        # Without a target size the configured bitrate applies again
+        self.assertEqual(10, to_opus.Migrator(source_dir, target_dir, db=db).plan().summary()['convert']['count'])
+
+    def test_execute_group_albums(self):
+        mig = to_opus.Migrator(source_dir, target_dir, threads=1, group_albums=True, db={})
+        mig.migrations['convert'] = logging_migration
+
+        mig.migrate()
+
+        with open(migration_log) as f:
+            converted = f.read().splitlines()
+        dirs = [os.path.dirname(path) for path in converted]
+        # Each directory converted in one go, in track order
+        self.assertEqual(2, len(set(dirs)))
+        self.assertEqual(1, sum(1 for a, b in zip(dirs, dirs[1:]) if a != b))
+        first = dirs.count(dirs[0])
+        track_order = partial(sorted, key=lambda path: os.path.splitext(path)[0])
+        self.assertEqual(track_order(converted[:first]), converted[:first])
+        self.assertEqual(track_order(converted[first:]), converted[first:])
+        # The failed tracks don't keep the rest of their album from being converted and recorded
+        self.assertEqual(2, len(mig.failures))
+        self.assertNotIn('wave', mig.db)
+        self.assertIn('flac', mig.db)
+        self.assertEqual({'cpu': 0, 'io': 0}, {name: lane.running for name, lane in mig.lanes.items()})
+
+    def test_batches(self):
+        mig = to_opus.Migrator(source_dir, target_dir, group_albums=True)
+        jobs = [to_opus.Job('convert', 'a' + os.sep + str(i), '.wav', '.opus', 1000) for i in range(50, 0, -1)]
+        jobs.append(to_opus.Job('convert', 'b' + os.sep + '1', '.wav', '.opus', 100000))
+
+        batches = mig.batches(jobs)
+
+        # Taken from the end
+        self.assertEqual([10, 40, 1], [len(batch) for batch in batches])
+        self.assertEqual('a' + os.sep + '1', batches[1][0].rel_path)
+        self.assertEqual(51, len(to_opus.Migrator(source_dir, target_dir).batches(jobs)))
+
+    def test_execute_per_directory(self):
+        db = to_opus.state.JsonStore()
+        mig = to_opus.Migrator(source_dir, target_dir, db=db)
+        target_dirs = {target_dir, target_dir + os.sep + 'nested', target_dir + os.sep + 'nested' + os.sep + 'deep'}
+        for path in target_dirs:
+            # Otherwise makedirs creates the missing parents by calling itself
+            os.makedirs(path, exist_ok=True)
+
+        with mock.patch('os.makedirs', wraps=os.makedirs) as makedirs:
+            mig.migrate()
+
+        self.assertEqual(sorted(target_dirs), sorted(call[0][0] for call in makedirs.call_args_list))
+
+        writes = db.writes
+        plan = mig.plan()
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            mig.execute(plan)
+
+        self.assertEqual({'skip'}, {job.action for job in plan.jobs})
+        # Recorded with the stat data of the scan, and not at all as the records are up to date
+        self.assertEqual([], [call for call in stat.call_args_list if str(call[0][0]).startswith(source_dir)])
+        self.assertEqual(writes, db.writes)
+
+    def test_import(self):
+        # No side effects like exiting without opusenc, and none of the modules only some runs need
+        code = 'import sys, to_opus; print(" ".join(m for m in %r if m in sys.modules))' % LAZY_MODULES
+        env = dict(os.environ, PATH='')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=os.path.dirname(test_dir))
+        self.assertEqual(b'', output.strip())
+
+    def test_parse_args_imports(self):
+        # Only the options given decide what is imported, not the ones that could be
+        lazy = [module for module in LAZY_MODULES + ['distributed'] if module != 'configargparse']
+        code = ('import sys, to_opus; sys.argv = ["to_opus.py", "-s", "src", "-t", "dest"]; to_opus.parse_args(); '
+                'print(" ".join(m for m in %r if m in sys.modules))' % lazy)
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(test_dir))
+        self.assertEqual(b'', output.strip())
+
+    @unittest.skipIf(sys.version_info < (3, 7), '-X importtime is available from Python 3.7')
+    def test_import_time(self):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import to_opus'], check=True,
+                                stderr=subprocess.PIPE, cwd=os.path.dirname(test_dir))
+        # "import time: self [us] | cumulative | imported package"
+        times = {line.split('|')[2].strip(): int(line.split('|')[1]) for line in result.stderr.decode().splitlines()
+                 if line.startswith('import time:') and line.split('|')[1].strip().isdigit()}
+        self.assertLess(times['to_opus'] / 1e6, IMPORT_BUDGET)
+
+    def test_main_without_opusenc(self):
+        path = os.environ['PATH']
+        os.environ['PATH'] = ''
+        to_opus.encoders.find.cache_clear()
+        try:
+            self.assertEqual(1, to_opus.main(main_cfg()))
+        finally:
+            os.environ['PATH'] = path
+            to_opus.encoders.find.cache_clear()
+        self.assertFalse(os.path.exists(target_dir))
+
+    def test_main_plan_without_opusenc(self):
+        path = os.environ['PATH']
+        os.environ['PATH'] = ''
+        to_opus.encoders.find.cache_clear()
+        try:
+            self.assertEqual(0, to_opus.main(main_cfg(plan=plan_file)))
+        finally:
+            os.environ['PATH'] = path
+            to_opus.encoders.find.cache_clear()
+            to_opus.encoders.version.cache_clear()
+        self.assertTrue(os.path.exists(plan_file))
+
+    def test_encode_timeout_scales_with_duration(self):
+        short = to_opus.encode_timeout('short.wav', 1024)
+        long = to_opus.encode_timeout('long.flac', 1024 ** 3)
+
+        self.assertGreaterEqual(short, to_opus.ENCODE_TIMEOUT)
+        self.assertGreater(long, short + 3600)
+
     def test_parse_args_min(self):
         sys.argv = [
             'cmd',
@@ -138,6 +764,17 @@ class TestToOpus(unittest.TestCase):
         self.assertEqual(['--cvbr', '--quiet'], cfg.opusenc_args)
         self.assertEqual(['desktop.ini.txt', 'Folder.jpg.txt'], cfg.exclude)
 
+    def test_parse_args_apply(self):
+        sys.argv = [
+            'cmd',
+            '--apply', 'plan.json',
+        ]
+
+        cfg = to_opus.parse_args()
+
+        self.assertEqual('plan.json', cfg.apply)
+        self.assertIsNone(cfg.source)
+
     def test_parse_cfg_min(self):
         sys.argv = [
             'cmd',
@@ -174,37 +811,108 @@ class TestToOpus(unittest.TestCase):
     def test_needs_migration_no_db_migrated(self):
         mig = to_opus.Migrator(source_dir, target_dir)
 
-        self.assertEqual(False,
-                         mig.needs_migration(source_dir + os.sep + 'wave.wav', golden_dir + os.sep + 'wave.opus'))
+        self.assertEqual(False, mig.needs_migration(source_dir + os.sep + 'wave.wav', migrated('wave.opus')))
+
+    def test_needs_migration_no_db_outdated(self):
+        src_file = source_dir + os.sep + 'wave.wav'
+        dest_file = migrated('wave.opus')
+        os.utime(dest_file, (0, os.path.getmtime(src_file) - 1))
+
+        mig = to_opus.Migrator(source_dir, target_dir)
+
+        self.assertEqual(True, mig.needs_migration(src_file, dest_file))
 
     def test_needs_migration_db_no_entry(self):
         mig = to_opus.Migrator(source_dir, target_dir, db={})
 
-        self.assertEqual(True, mig.needs_migration(source_dir + os.sep + 'wave.wav', golden_dir + os.sep + 'wave.opus'))
+        self.assertEqual(True, mig.needs_migration(source_dir + os.sep + 'wave.wav', migrated('wave.opus')))
 
     def test_needs_migration_db_wrongsize(self):
         src_file = source_dir + os.sep + 'wave.wav'
-        db = {src_file: {'size': 1, 'last_modified': os.path.getmtime(src_file)}}
+        db = {'wave': {'size': 1, 'last_modified': os.path.getmtime(src_file)}}
 
         mig = to_opus.Migrator(source_dir, target_dir, db=db)
 
-        self.assertEqual(True, mig.needs_migration(src_file, golden_dir + os.sep + 'wave.opus'))
+        self.assertEqual(True, mig.needs_migration(src_file, migrated('wave.opus')))
 
     def test_needs_migration_db_old_modification_date(self):
         src_file = source_dir + os.sep + 'wave.wav'
-        db = {src_file: {'size': 94182, 'last_modified': 123}}
+        db = {'wave': {'size': 94182, 'last_modified': 123}}
 
         mig = to_opus.Migrator(source_dir, target_dir, db=db)
 
-        self.assertEqual(True, mig.needs_migration(src_file, golden_dir + os.sep + 'wave.opus'))
+        self.assertEqual(True, mig.needs_migration(src_file, migrated('wave.opus')))
 
     def test_needs_migration_db_migrated(self):
         src_file = source_dir + os.sep + 'wave.wav'
-        db = {src_file: {'size': 94182, 'last_modified': os.path.getmtime(src_file)}}
+        db = {'wave': {'size': 94182, 'last_modified': os.path.getmtime(src_file)}}
 
         mig = to_opus.Migrator(source_dir, target_dir, db=db)
 
-        self.assertEqual(False, mig.needs_migration(src_file, golden_dir + os.sep + 'wave.opus'))
+        self.assertEqual(False, mig.needs_migration(src_file, migrated('wave.opus'), 'wave'))
+
+    def test_needs_migration_db_other_inode(self):
+        src_file = source_dir + os.sep + 'wave.wav'
+        src_stat = os.stat(src_file)
+        db = {'wave': {'size': src_stat.st_size, 'last_modified': src_stat.st_mtime, 'inode': src_stat.st_ino + 1}}
+
+        mig = to_opus.Migrator(source_dir, target_dir, db=db)
+
+        # E.g. restored from a backup, size and mtime are trusted
+        self.assertEqual(False, mig.needs_migration(src_file, migrated('wave.opus')))
+
+        db['wave']['hash'] = to_opus.audio.fingerprint(src_file)
+        self.assertEqual(False, mig.needs_migration(src_file, migrated('wave.opus')))
+
+        db['wave']['hash'] = '0' * 32
+        self.assertEqual(True, mig.needs_migration(src_file, migrated('wave.opus')))
+
+    def test_restored_source_is_not_converted_again(self):
+        src_dir = target_dir + os.sep + 'src'
+        dest_dir = target_dir + os.sep + 'dest'
+        shutil.copytree(source_dir, src_dir)
+        db = {}
+        to_opus.Migrator(src_dir, dest_dir, db=db).migrate()
+        src_file = src_dir + os.sep + 'wave.wav'
+        shutil.copy2(src_file, src_file + '.restored')
+        os.replace(src_file + '.restored', src_file)
+
+        mig = to_opus.Migrator(src_dir, dest_dir, db=db)
+        plan = mig.plan()
+        self.assertEqual(0, plan.summary()['convert']['count'])
+        mig.execute(plan)
+
+        self.assertEqual(os.stat(src_file).st_ino, db['wave']['inode'])
+
+    def test_needs_migration_check_hash_touched(self):
+        src_file = target_dir + os.sep + 'src' + os.sep + 'wave.wav'
+        os.makedirs(os.path.dirname(src_file))
+        shutil.copyfile(source_dir + os.sep + 'wave.wav', src_file)
+        dest_file = migrated('wave.opus')
+        db = {}
+
+        mig = to_opus.Migrator(target_dir + os.sep + 'src', target_dir, db=db, check='hash')
+        mig.record('wave', src_file)
+        os.utime(src_file, (0, os.path.getmtime(src_file) + 10))
+
+        self.assertEqual(False, mig.needs_migration(src_file, dest_file, 'wave'))
+
+        with open(src_file, 'r+b') as f:
+            f.seek(1000)
+            f.write(b'\0\0\0\0')
+
+        self.assertEqual(True, mig.needs_migration(src_file, dest_file, 'wave'))
+
+    def test_needs_migration_check_content(self):
+        src_file = source_dir + os.sep + 'nested' + os.sep + 'text.txt'
+        dest_file = target_dir + os.sep + 'text.txt'
+        os.makedirs(target_dir)
+        with open(dest_file, 'w') as f:
+            f.write('changed')
+
+        self.assertEqual(False, to_opus.Migrator(source_dir, target_dir).needs_migration(src_file, dest_file))
+        self.assertEqual(True,
+                         to_opus.Migrator(source_dir, target_dir, check='content').needs_migration(src_file, dest_file))
 
     def test_needs_migration_exclude(self):
         mig = to_opus.Migrator(source_dir, target_dir, exclude_regexes={".+\\.png", ".+\\.txt"})
@@ -0,0 +1,123 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+import time
+
+import watch
+
+
+def inotify_watcher(root: str, settle: float):
+    try:
+        return watch.InotifyWatcher(root, settle)
+    except OSError:
+        return None
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = self.tmp_dir + os.sep + 'root'
+        os.makedirs(self.root + os.sep + 'album')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, rel_path: str, data: str = 'data') -> None:
+        with open(self.root + os.sep + rel_path, 'w') as f:
+            f.write(data)
+
+    def wait_for(self, watcher: watch.Watcher, expected, timeout: float = 5):
+        changes = set()
+        deadline = time.monotonic() + timeout
+        while not expected <= changes and time.monotonic() < deadline:
+            changes |= watcher.wait(deadline - time.monotonic())
+        return changes
+
+    def test_settle(self):
+        watcher = watch.Watcher(self.root, settle=10)
+        watcher.changed('a.flac')
+
+        self.assertEqual(set(), watcher.settled())
+        self.assertGreater(watcher.next_settled(), 9)
+
+        watcher.pending['a.flac'] -= 10
+        self.assertEqual({'a.flac'}, watcher.settled())
+        self.assertIsNone(watcher.next_settled())
+
+    def test_polling(self):
+        self.write('album' + os.sep + 'old.flac')
+        watcher = watch.PollingWatcher(self.root, settle=0, interval=0.01)
+
+        self.write('album' + os.sep + 'new.flac')
+        os.remove(self.root + os.sep + 'album' + os.sep + 'old.flac')
+
+        expected = {'album' + os.sep + 'new.flac', 'album' + os.sep + 'old.flac'}
+        self.assertEqual(expected, self.wait_for(watcher, expected))
+        self.assertEqual(set(), watcher.wait(0.05))
+
+    def test_polling_waits_until_files_settle(self):
+        watcher = watch.PollingWatcher(self.root, settle=0.2, interval=0.01)
+
+        self.write('new.flac', 'a')
+        self.assertEqual(set(), watcher.wait(0.05))
+        self.write('new.flac', 'ab')
+        self.assertEqual(set(), watcher.wait(0.05))
+
+        self.assertEqual({'new.flac'}, self.wait_for(watcher, {'new.flac'}))
+
+    def test_inotify(self):
+        watcher = inotify_watcher(self.root, settle=0)
+        if watcher is None:
+            self.skipTest('inotify is not available')
+        try:
+            self.write('album' + os.sep + 'track.flac')
+            expected = {'album' + os.sep + 'track.flac'}
+            self.assertEqual(expected, self.wait_for(watcher, expected))
+
+            # New directories are watched as well
+            os.makedirs(self.root + os.sep + 'new' + os.sep + 'nested')
+            self.write('new' + os.sep + 'nested' + os.sep + 'track.wav')
+            expected = {'new' + os.sep + 'nested' + os.sep + 'track.wav'}
+            self.assertLessEqual(expected, self.wait_for(watcher, expected))
+
+            # Directories moved in or out are reported as a whole
+            os.rename(self.root + os.sep + 'album', self.tmp_dir + os.sep + 'album')
+            os.rename(self.tmp_dir + os.sep + 'album', self.root + os.sep + 'renamed')
+            expected = {'album', 'renamed'}
+            self.assertEqual(expected, self.wait_for(watcher, expected))
+
+            # The moved directory is still watched under its new name
+            os.remove(self.root + os.sep + 'renamed' + os.sep + 'track.flac')
+            expected = {'renamed' + os.sep + 'track.flac'}
+            self.assertEqual(expected, self.wait_for(watcher, expected))
+        finally:
+            watcher.close()
+
+    def test_inotify_waits_until_files_settle(self):
+        watcher = inotify_watcher(self.root, settle=0.3)
+        if watcher is None:
+            self.skipTest('inotify is not available')
+        try:
+            with open(self.root + os.sep + 'track.flac', 'w') as f:
+                f.write('a')
+                f.flush()
+                self.assertEqual(set(), watcher.wait(0.1))
+                f.write('b')
+                f.flush()
+                self.assertEqual(set(), watcher.wait(0.1))
+
+            self.assertEqual({'track.flac'}, self.wait_for(watcher, {'track.flac'}))
+        finally:
+            watcher.close()
+
+    def test_create(self):
+        watcher = watch.create(self.root, 5, poll_interval=60)
+        self.assertIsInstance(watcher, watch.PollingWatcher)
+        watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
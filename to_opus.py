@@ -1,202 +1,1315 @@
 import sys
-from multiprocessing import Pool
+import threading
+from contextlib import contextmanager
+from functools import partial
+from itertools import groupby
 
-import configargparse
 import json
 import logging
 import os
 import re
-import filecmp
-from pathlib import Path
-from shutil import copyfile, which
-from subprocess import Popen
-from typing import Callable, Dict, List, Set, Optional
+import struct
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Set, Optional, Tuple, Union
+
+import audio
+import budget
+import encoders
+import metrics
+import scan
+import scheduler
+import state
+import worker
 
 SOURCE_EXTENSIONS = ['.wav', '.flac', '.ogg', '.aif', '.aiff']
 
-if which('opusenc') is None:
-    print("ERROR: opusenc not found in PATH - please make sure it's installed", file=sys.stderr)
-    exit(1)
+# Minimum time an encoder job gets before it is killed, the rest of the timeout scales with the audio duration
+ENCODE_TIMEOUT = 60
+# Uncompressed 16 bit / 44.1 kHz stereo, used to estimate durations from file sizes
+PCM_BYTES_PER_SECOND = 44100 * 2 * 2
+# Rough size of compressed sources relative to PCM, so a FLAC rip gets (at least) the time its duration needs
+COMPRESSION_RATIOS = {'.flac': 0.5, '.ogg': 0.5}
 
+# How needs_migration decides whether an existing output is up to date:
+# - stat: trust size, modification time and inode of the source (as recorded in the db) and the output's mtime
+# - content: additionally compare copied files byte by byte
+# - hash: like stat, but when a source's stat data changed its audio fingerprint decides (needs a db)
+CHECK_MODES = ['stat', 'content', 'hash']
 
-def opusenc(src: str, dest: str) -> None:
-    if Popen(['opusenc', src, dest] + opusenc_args).wait() == 0:
-        logging.info('converted "%s" -> "%s"', src, dest)
-    else:
-        # Fallback to copy
-        # Can happen if a .ogg file is encoded as Vorbis, not FLAC
-        logging.warning('Falling back to copy for %s', src)
-        _, src_ext = os.path.splitext(src)
-        target_base, _ = os.path.splitext(dest)
-        copyfile(src, target_base + src_ext)
+# Name of the profile --target is encoded with, see encoders.profile
+DEFAULT_PROFILE = 'default'
+
+# What happens to a file, see Migrator.plan
+ACTIONS = ['convert', 'copy', 'fallback-copy', 'move', 'skip', 'delete']
+
+# Copies running at once, they mostly wait for the disks
+COPY_THREADS = 4
+# Most tracks of a directory encoded one after the other by the same worker (see Migrator.batches), larger
+# directories are split so a folder of thousands of singles doesn't end up on a single worker
+ALBUM_TRACKS = 40
+
+# Environment variable --authkey is read from, like by distributed.py. Defined here, so parsing the arguments doesn't
+# import distributed and its networking modules.
+AUTHKEY_ENV = 'TO_OPUS_AUTHKEY'
+
+# Seconds without further events before --watch hands on a changed path, so files that are still being written
+# (e.g. an album being copied into the source) aren't converted half done
+SETTLE_SECONDS = 5
+
+# Seconds of audio encoded per CPU second, until the db knows better
+ENCODE_SPEED = 40
+# Number of recorded encode times the speed estimate is based on
+ENCODE_SPEED_SAMPLES = 1000
+
+
+def estimated_duration(path: str, size: int) -> float:
+    _, ext = os.path.splitext(path)
+    return size / (PCM_BYTES_PER_SECOND * COMPRESSION_RATIOS.get(ext.lower(), 1))
+
+
+def encode_timeout(path: str, size: int) -> float:
+    # opusenc runs many times faster than realtime, so a job taking longer than the track itself is stuck
+    return ENCODE_TIMEOUT + estimated_duration(path, size)
+
+
+def read_duration(path: str) -> float:
+    try:
+        seconds = audio.duration(path)
+    except (OSError, ValueError, struct.error) as e:
+        logging.warning('could not read header of "%s": %s', path, e)
+        seconds = None
+    # Files that don't tell are assumed to be 16 bit / 44.1 kHz stereo
+    return seconds if seconds is not None else estimated_duration(path, os.path.getsize(path))
+
+
+def probe(path: str) -> Optional[str]:
+    try:
+        return audio.probe(path)
+    except OSError as e:
+        # Left to opusenc, which reports the problem when converting
+        logging.warning('could not read header of "%s": %s', path, e)
+        return None
+
+
+class Job(NamedTuple):
+    action: str
+    # Relative path of the source without extension, also the db key
+    rel_path: str
+    src_ext: str
+    dest_ext: str
+    # Source size, or output size for deletions
+    size: int = 0
+    # For moves: relative path of the existing output (without extension) that is moved to rel_path
+    moved_from: Optional[str] = None
+    # For conversions: the profiles (targets) to encode, None for just the default one
+    profiles: Optional[List[str]] = None
+    # For conversions with --target-size: the bitrate of the default target's output, see Migrator.fit_budget
+    bitrate: Optional[int] = None
+    # Stat data of the source from the scan, so executing the job doesn't stat it again. Not saved with the plan.
+    stat: Optional[os.stat_result] = None
+
+    def key(self) -> Tuple[str, str, str]:
+        """
+        Identifies the job within its plan, e.g. in the journal.
+        """
+        return self.action, self.rel_path, self.dest_ext
+
+
+class Plan(object):
+    """
+    Everything a run is going to do, so it can be inspected or saved and executed later without scanning again.
+    """
+
+    def __init__(self, source_dir: str, target_dir: str, jobs: List[Job], empty_dirs: List[str],
+                 estimated_cpu_seconds: float = 0):
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+        self.jobs = jobs
+        # Target directories (relative) that are empty once the plan is executed
+        self.empty_dirs = empty_dirs
+        self.estimated_cpu_seconds = estimated_cpu_seconds
 
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        summary = {action: {'count': 0, 'bytes': 0} for action in ACTIONS}
+        for job in self.jobs:
+            summary[job.action]['count'] += 1
+            summary[job.action]['bytes'] += job.size
+        return summary
+
+    def to_json(self) -> Dict:
+        return {
+            'source': self.source_dir,
+            'target': self.target_dir,
+            'summary': self.summary(),
+            'estimated_cpu_seconds': self.estimated_cpu_seconds,
+            # Skipped files have nothing to execute, leaving them out keeps saved plans small
+            'jobs': [{k: v for k, v in job._asdict().items() if k != 'stat'}
+                     for job in self.jobs if job.action != 'skip'],
+            'empty_dirs': self.empty_dirs,
+        }
+
+    @staticmethod
+    def from_json(data: Dict) -> 'Plan':
+        return Plan(data['source'], data['target'], [Job(**job) for job in data['jobs']], data['empty_dirs'],
+                    data['estimated_cpu_seconds'])
+
+    def save(self, path: str) -> None:
+        if path == '-':
+            json.dump(self.to_json(), sys.stdout, indent=2)
+            print()
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.to_json(), f, indent=2)
+
+    @staticmethod
+    def load(path: str) -> 'Plan':
+        with open(path, 'r') as f:
+            return Plan.from_json(json.load(f))
 
-def copy(src: str, dest: str) -> None:
-    copyfile(src, dest)
+
+def resume(journal: state.Journal) -> Plan:
+    """
+    Returns the plan of an interrupted run with the jobs it didn't finish, after removing the partial outputs of
+    the jobs that were running when it died.
+    """
+    data, started, finished = journal.load()
+    plan = Plan.from_json(data)
+    for job in plan.jobs:
+        if job.key() in started and job.key() not in finished:
+            # opusenc writes a copy next to the .opus output if it can't read the source
+            for ext in {job.dest_ext, job.src_ext}:
+                encoders.remove_partial(plan.target_dir + os.sep + job.rel_path + ext + encoders.PARTIAL_SUFFIX)
+
+    plan.jobs = [job for job in plan.jobs if job.key() not in finished]
+    return plan
 
 
 class Migrator(object):
     def __init__(self,
                  src_dir: str,
                  dest_dir: str,
-                 threads: int = 8,
+                 threads: Optional[int] = None,
                  del_removed: bool = False,
                  opus_args: Optional[List[str]] = None,
-                 db: Optional[Dict[str, Dict]] = None,
+                 db: Optional[Union[Dict[str, Dict], state.Store]] = None,
                  exclude_regexes: Optional[Set] = None,
                  db_file: Optional[str] = None,
-                 db_write_frequency: int = 100):
+                 db_write_frequency: int = 100,
+                 copy_threads: Optional[int] = None,
+                 check: str = 'stat',
+                 encoder: str = 'opusenc',
+                 stats: Optional[metrics.Metrics] = None,
+                 journal: Optional[state.Journal] = None,
+                 scan_threads: int = scan.SCAN_THREADS,
+                 throttle: bool = True,
+                 hardlink: bool = False,
+                 extra_targets: Optional[List[Tuple[str, str, List[str]]]] = None,
+                 group_albums: bool = False,
+                 target_size: Optional[int] = None,
+                 serve: Optional[Tuple[str, int]] = None,
+                 authkey: Optional[bytes] = None):
         if opus_args is None:
             opus_args = []
         if exclude_regexes is None:
             exclude_regexes = set([])
+        if threads is None:
+            threads = scheduler.cpu_count()
+        if copy_threads is None:
+            copy_threads = COPY_THREADS
+        if extra_targets is None:
+            extra_targets = []
+        if check not in CHECK_MODES:
+            raise ValueError('unknown check mode: ' + check)
+        if target_size is not None and (db is None or encoder != 'opusenc'):
+            raise ValueError('a target size needs a database and the opusenc encoder')
+        # Fails early if the encoder is unknown or its dependencies are missing, not in every worker
+        encoders.create(encoder, opus_args)
+        if db is not None and not isinstance(db, state.Store):
+            # Plain dicts keep the original behaviour of periodically dumping the whole db to db_file
+            db = state.JsonStore(db_file, db, db_write_frequency)
 
         self.logger = logging.getLogger('migrator')
 
         self.source_dir = src_dir
         self.target_dir = dest_dir
+        self.threads = threads
+        self.copy_threads = copy_threads
+        self.scan_threads = scan_threads
         self.opusenc_args = opus_args
+        self.encoder = encoder
+        # Further targets the converted files are encoded to with their own arguments, by profile name
+        self.extra_targets: Dict[str, Tuple[str, List[str]]] = {
+            name: (target_dir, args) for name, target_dir, args in extra_targets}
+        # Version the outputs are encoded with, unknown if the encoder isn't installed (it isn't needed for --plan).
+        # With --serve the workers encode with whatever they have installed and report it with each result.
+        self.encoder_version = encoders.version(encoder) if serve is None else encoders.UNKNOWN_VERSION
+        self.profile_args = {DEFAULT_PROFILE: opus_args, **{name: args for name, _, args in extra_targets}}
+        # Fingerprints of the encoder settings per profile, recorded for every output so changed settings are noticed.
+        # By encoder version, see profile.
+        self.profiles: Dict[Tuple[str, str], str] = {}
         self.db = db
         self.exclude_regexes = [re.compile(expr) for expr in exclude_regexes]
-        self.db_file = db_file
+        self.check = check
+        # Encode the tracks of a directory one after the other on the same worker, see batches
+        self.group_albums = group_albums
+        # Bytes the outputs of the default target should fit into, see fit_budget
+        self.target_size = target_size
+        # Fingerprints and codecs detected while deciding, so recording the file afterwards doesn't read it again
+        self.fingerprints: Dict[str, Tuple[Tuple[int, int, float], str]] = {}
+        self.codecs: Dict[str, Tuple[Tuple[int, int, float], Optional[str]]] = {}
+        self.durations: Dict[str, Tuple[Tuple[int, int, float], float]] = {}
         self.n = 0
-        self.db_write_frequency = db_write_frequency
+        self.failures: List[str] = []
+        # Counters and timers per stage, for the progress line and the exporters
+        self.stats = stats if stats is not None else metrics.Metrics()
+        # Started and finished jobs of the plan being executed, for resuming it if the run dies
+        self.journal = journal
+
+        # Lowers the number of jobs per lane while the machine is busy otherwise, None to always use all workers
+        self.throttle = scheduler.Throttle() if throttle else None
+        # Set whenever a job finishes, so the scheduler can submit the next one
+        self.slot_freed = threading.Event()
+        # Completion callbacks run on the pool's result thread while the walk keeps updating the db
+        self.lock = threading.Lock()
 
-        if del_removed:
-            self.delete_removed()
+        self.del_removed = del_removed
+        # Outputs whose source doesn't exist anymore, by (size, last_modified) and fingerprint of the old source.
+        # A new source matching one of them was moved or renamed, so its output is moved along instead of re-encoded.
+        self.removed_by_stat: Dict[Tuple[int, float], List[Tuple[str, str]]] = {}
+        self.removed_by_hash: Dict[str, List[Tuple[str, str]]] = {}
+        # Outputs that existed when the run started, saves looking up every output on its own
+        self.target_index: Optional[scan.Index] = None
+        self.extra_indexes: Dict[str, scan.Index] = {}
+        # Target directories created (or found) by the plan being executed, each is only created once
+        self.dirs_made: Set[str] = set()
 
         self.extensions_to_action = {
             # Convert files with these extensions to .opus
-            **{ext: self.to_opus for ext in SOURCE_EXTENSIONS},
+            **{ext: 'convert' for ext in SOURCE_EXTENSIONS},
 
             # Ignore files with these extensions
             # My source folder is synced with google drive and I don't want to copy google drive metadata
             # TODO: make configurable
-            **{ext: lambda *args: None for ext in ['.driveupload', '.drivedownload']}
+            **{ext: None for ext in ['.driveupload', '.drivedownload']}
+        }
+        # Everything else is copied
+        self.default_action = 'copy'
+
+        # Overrides the action for files that are converted by extension, once their header shows the actual codec.
+        # Lossy sources are copied rather than re-encoded (and opusenc can't read Vorbis anyway).
+        # Files with an unknown codec are left to opusenc.
+        self.codecs_to_action = {
+            **{codec: 'convert' for codec in ['wav', 'aiff', 'flac']},
+            **{codec: 'copy' for codec in ['vorbis', 'opus', 'speex']},
         }
 
-        self.pool = Pool(processes=threads, initializer=init_worker, initargs=[opus_args, self.logger.level])
+        # What the pool workers run for each action
+        self.migrations: Dict[str, Callable[[str, str], None]] = {
+            'convert': worker.encode,
+            'copy': partial(encoders.copy, hardlink=hardlink),
+            'fallback-copy': partial(encoders.copy, hardlink=hardlink),
+        }
+
+        # Pools by lane name, see start
+        self.lanes: Dict[str, scheduler.Lane] = {}
+        # Address the conversions are handed to workers on other hosts on, see distributed.Coordinator
+        self.serve = serve
+        self.authkey = authkey
+
+    def plan(self) -> Plan:
+        self.logger.info('scanning source and target directories')
+        with self.stats.timer('scan'):
+            source_index = scan.scan(self.source_dir, threads=self.scan_threads)
+            self.target_index = scan.scan(self.target_dir, stat=False, threads=self.scan_threads)
+            self.extra_indexes = {name: scan.scan(target_dir, stat=False, threads=self.scan_threads)
+                                  for name, (target_dir, _) in self.extra_targets.items()}
+
+        self.logger.info('checking for unconverted files')
+        return self.plan_index(source_index)
+
+    def plan_paths(self, rel_paths: Iterable[str]) -> Plan:
+        """
+        Plans only the given source files and directories (relative to the source directory), which were added,
+        changed, removed or renamed - see watch.
+        """
+        if self.target_size is not None:
+            # The bitrates depend on the whole library
+            return self.plan()
+        rel_paths = list(rel_paths)
+        with self.stats.timer('scan'):
+            source_index = scan.scan_paths(self.source_dir, rel_paths, threads=self.scan_threads)
+            self.target_index = scan.scan_paths(self.target_dir, rel_paths, stat=False, threads=self.scan_threads)
+            self.extra_indexes = {name: scan.scan_paths(target_dir, rel_paths, stat=False, threads=self.scan_threads)
+                                  for name, (target_dir, _) in self.extra_targets.items()}
+        # Folders of removed files (and their parents) might be empty now, removing them fails harmlessly if they aren't
+        for rel_path in rel_paths:
+            rel_dir = os.path.dirname(rel_path)
+            while rel_dir:
+                self.target_index.dirs.append(rel_dir)
+                rel_dir = os.path.dirname(rel_dir)
+
+        return self.plan_index(source_index)
+
+    def plan_index(self, source_index: scan.Index) -> Plan:
+        """
+        Plans the files of source_index, given self.target_index contains the existing outputs of the same files.
+        """
+        self.removed_by_stat, self.removed_by_hash = {}, {}
+        with self.stats.timer('decide'):
+            removed = []
+            if self.del_removed:
+                removed = self.find_removed(source_index, self.target_index)
+                self.index_removed(removed)
+
+            jobs = []
+            for rel_path, src_ext, src_stat in source_index.entries():
+                job = self.plan_file(rel_path, src_ext, src_stat)
+                if job is not None:
+                    jobs.append(job)
+            if self.target_size is not None:
+                jobs = self.fit_budget(jobs)
+
+        # Whatever wasn't moved to a new location was really removed from the source
+        moved = {(job.moved_from, job.dest_ext) for job in jobs if job.action == 'move'}
+        deleted = [job for job in removed if (job.rel_path, job.dest_ext) not in moved]
+        deleted += self.find_partial(source_index, self.target_index)
+        deleted += self.find_fallback_copies(jobs, self.target_index)
 
-    def to_opus(self, src_base: str, src_ext: str) -> None:
-        self.base_action(src_base, src_ext, '.opus', opusenc)
+        empty_dirs = []
+        if self.del_removed:
+            # Like deleting outputs, removing directories that are empty (now) is left to --del-removed
+            gone = moved | {(job.rel_path, job.dest_ext) for job in deleted}
+            empty_dirs = self.find_empty_dirs(self.target_index, gone)
 
-    def copy(self, src_base: str, src_ext: str) -> None:
-        self.base_action(src_base, src_ext, src_ext, copy)
+        return Plan(self.source_dir, self.target_dir, jobs + deleted, empty_dirs)
 
-    def base_action(self, src_base: str, src_ext: str, dest_ext: str, migrate: Callable[[str, str], None]):
-        rel_path = os.path.relpath(src_base, self.source_dir)
-        dest_base = self.target_dir + os.sep + rel_path
-        dest_path = dest_base + dest_ext
-        Path(dest_base).parent.mkdir(parents=True, exist_ok=True)
-        src_path = src_base + src_ext
+    def plan_file(self, rel_path: str, src_ext: str, src_stat: Optional[os.stat_result] = None) -> Optional[Job]:
+        action = self.extensions_to_action.get(src_ext, self.default_action)
+        if action is None:
+            return None
 
-        if self.needs_migration(src_path, dest_path, rel_path):
-            self.logger.info('migrating: "%s" -> "%s"', src_path, dest_path)
-            result = self.pool.apply_async(migrate, (src_path, dest_path,), error_callback=logging.error)
-            result.get(timeout=60)
+        src_path = self.source_dir + os.sep + rel_path + src_ext
+        if src_stat is None:
+            src_stat = os.stat(src_path)
 
+        codec = None
+        if action == 'convert':
+            # Probing the codec reads the file, which isn't needed to skip an up to date conversion. Copies (lossy
+            # sources, fallback copies) are told apart by the codec.
+            opus_path = self.target_dir + os.sep + rel_path + '.opus'
+            opus_exists = self.target_index.contains(rel_path, '.opus') if self.target_index is not None else None
+            if opus_exists is not False and not self.needs_migration(src_path, opus_path, rel_path, opus_exists,
+                                                                     src_stat):
+                job = Job('skip', rel_path, src_ext, '.opus', src_stat.st_size, stat=src_stat)
+                return self.plan_extra_targets(job, opus_path) if self.extra_targets else job
+
+            record = self.db.get(rel_path) if self.db is not None else None
+            codec = self.codec(src_path, src_stat, record)
+            action = self.codecs_to_action.get(codec, action)
+
+        dest_ext = '.opus' if action == 'convert' else src_ext
+        if action == 'convert' and codec is None and self.target_index is not None \
+                and self.target_index.contains(rel_path, src_ext) and not self.target_index.contains(rel_path, '.opus'):
+            # opusenc failed on an earlier run and the file was copied instead. Sources detected as lossless are
+            # converted again, the failure might have been a timeout or the like.
+            action, dest_ext = 'fallback-copy', src_ext
+
+        dest_exists = None
+        if self.target_index is not None:
+            dest_exists = self.target_index.contains(rel_path, dest_ext)
+
+        if not dest_exists and self.removed_by_stat:
+            moved = self.find_moved(src_path, src_stat, {dest_ext, src_ext})
+            if moved is not None:
+                old_dest_path, old_rel_path = moved
+                return Job('move', rel_path, src_ext, os.path.splitext(old_dest_path)[1], src_stat.st_size,
+                           old_rel_path, stat=src_stat)
+
+        dest_path = self.target_dir + os.sep + rel_path + dest_ext
+        if self.needs_migration(src_path, dest_path, rel_path, dest_exists, src_stat):
+            job = Job(action, rel_path, src_ext, dest_ext, src_stat.st_size, stat=src_stat)
+        else:
+            job = Job('skip', rel_path, src_ext, dest_ext, src_stat.st_size, stat=src_stat)
+
+        if action == 'convert' and self.extra_targets:
+            return self.plan_extra_targets(job, dest_path)
+        return job
+
+    def plan_extra_targets(self, job: Job, dest_path: str) -> Job:
+        """
+        Adds the extra targets whose output is missing or was encoded with other settings to the conversion of a
+        file, which turns into one if the default target is up to date. Outputs of the extra targets are written
+        along with the default one whenever it's encoded, reading the source once for all of them.
+        """
+        if any(p.match(os.path.basename(dest_path)) for p in self.exclude_regexes):
+            return job
+
+        record = self.db.get(job.rel_path) if self.db is not None else None
+        profiles = [DEFAULT_PROFILE] if job.action == 'convert' else []
+        for name, (target_dir, _) in self.extra_targets.items():
+            index = self.extra_indexes.get(name)
+            if index is not None:
+                # A copy if opusenc couldn't read the source
+                exists = index.contains(job.rel_path, '.opus') or index.contains(job.rel_path, job.src_ext)
+            else:
+                exists = os.path.isfile(target_dir + os.sep + job.rel_path + '.opus')
+            # Without a db there's no telling which settings an existing output was encoded with
+            outdated = self.db is not None and (record is None or self.profile_outdated(name, record))
+            if job.action == 'convert' or not exists or outdated:
+                profiles.append(name)
+
+        if not profiles:
+            return job
+        return job._replace(action='convert', profiles=profiles)
+
+    def fit_budget(self, jobs: List[Job]) -> List[Job]:
+        """
+        Picks a bitrate per directory so the outputs of the default target fit into target_size (see budget.assign),
+        and converts the files whose output was encoded with another bitrate again. Copies take what they take,
+        the conversions share the rest.
+        """
+        copied = 0
+        seconds: Dict[str, float] = {}
+        files: Dict[str, int] = {}
+        # Bitrates the outputs of each directory were encoded with, by number of outputs
+        encoded_with: Dict[str, Dict[int, int]] = {}
+        for job in jobs:
+            if job.action == 'delete':
+                continue
+            if job.dest_ext != '.opus' or job.src_ext == '.opus':
+                copied += job.size
+                continue
+            rel_dir = os.path.dirname(job.rel_path)
+            src_path = self.source_dir + os.sep + job.rel_path + job.src_ext
+            src_stat = job.stat if job.stat is not None else os.stat(src_path)
+            record = self.db.get(job.moved_from if job.action == 'move' else job.rel_path)
+            seconds[rel_dir] = seconds.get(rel_dir, 0) + self.duration(src_path, src_stat, record)
+            files[rel_dir] = files.get(rel_dir, 0) + 1
+            if record is not None and record.get('bitrate') is not None:
+                counts = encoded_with.setdefault(rel_dir, {})
+                counts[record['bitrate']] = counts.get(record['bitrate'], 0) + 1
+
+        albums = {rel_dir: budget.Album(seconds[rel_dir], files[rel_dir],
+                                        max(encoded_with[rel_dir], key=encoded_with[rel_dir].get)
+                                        if rel_dir in encoded_with else None)
+                  for rel_dir in seconds}
+        size = self.target_size * budget.HEADROOM - copied
+        bitrates = budget.assign(albums, size)
+        if bitrates and sum(album.size(bitrates[rel_dir]) for rel_dir, album in albums.items()) > size:
+            self.logger.warning('the target does not fit into %.1f GB even at %d kbit/s',
+                                self.target_size / 1e9, budget.BITRATES[0])
+
+        fitted = []
+        for job in jobs:
+            if job.dest_ext == '.opus' and job.src_ext != '.opus' and job.action in ('convert', 'skip') \
+                    and not any(p.match(os.path.basename(job.rel_path + job.dest_ext)) for p in self.exclude_regexes):
+                bitrate = bitrates[os.path.dirname(job.rel_path)]
+                record = self.db.get(job.rel_path)
+                if record is None or record.get('bitrate') != bitrate:
+                    if job.action == 'skip':
+                        job = job._replace(action='convert')
+                    elif job.profiles is not None and DEFAULT_PROFILE not in job.profiles:
+                        # Only extra targets were going to be encoded
+                        job = job._replace(profiles=[DEFAULT_PROFILE] + job.profiles)
+                job = job._replace(bitrate=bitrate)
+            fitted.append(job)
+        return fitted
+
+    def estimate_cpu_seconds(self, plan: Plan) -> float:
+        duration = sum(estimated_duration(job.rel_path + job.src_ext, job.size) * len(job.profiles or [None])
+                       for job in plan.jobs if job.action == 'convert')
+        return duration / self.encode_speed()
+
+    def encode_speed(self) -> float:
+        """
+        Encoded seconds of audio per CPU second, from the encode times recorded in the db.
+        """
+        duration = encode_time = 0
+        samples = 0
         if self.db is not None:
-            size = os.path.getsize(src_path)
-            mod_time = os.path.getmtime(src_path)
+            for record in self.db.values():
+                if record.get('encode_time'):
+                    duration += record['duration']
+                    encode_time += record['encode_time']
+                    samples += 1
+                    if samples == ENCODE_SPEED_SAMPLES:
+                        break
+
+        if encode_time == 0:
+            return ENCODE_SPEED
+        return duration / encode_time
+
+    def execute(self, plan: Plan) -> None:
+        self.start()
+        todo = [job for job in plan.jobs if job.action != 'skip']
+        self.stats.start(len(todo), sum(job.size for job in todo))
+        if self.journal is not None:
+            self.journal.begin(plan.to_json())
+
+        self.dirs_made = set()
+        # Moves and deletions are cheap and run right away, the rest waits for a free worker of its lane.
+        # Skipped files are only recorded, a directory at a time.
+        lane_jobs: Dict[str, List[Job]] = {name: [] for name in self.lanes}
+        skipped = []
+        for job in plan.jobs:
+            if job.action in self.migrations:
+                lane_jobs[self.lane_name(job)].append(job)
+            elif job.action == 'skip':
+                skipped.append(job)
+            else:
+                self.run(job)
+        # The jobs of a directory are next to each other, as the scan lists a directory at a time
+        for _, jobs in groupby(skipped, key=lambda job: os.path.dirname(job.rel_path)):
+            self.record_dir(list(jobs))
+        self.schedule({name: self.batches(jobs) for name, jobs in lane_jobs.items()})
+
+        self.logger.info('finishing conversions')
+        for lane in self.lanes.values():
+            lane.close()
+
+        self.delete_empty_dirs(plan.empty_dirs)
+        for target_dir, _ in self.extra_targets.values():
+            self.delete_empty_dirs(plan.empty_dirs, target_dir)
+        if self.journal is not None:
+            self.journal.close(complete=True)
+
+        if self.failures:
+            self.logger.error('%d file(s) failed to migrate', len(self.failures))
+
+    def migrate(self):
+        self.execute(self.plan())
+
+    def start(self) -> None:
+        from multiprocessing import Pool
+        from multiprocessing.pool import ThreadPool
+
+        # Encodes are CPU bound and run in processes, copies mostly wait for I/O and are fine in threads
+        setup = (self.encoder, self.opusenc_args, self.logger.level)
+        if self.serve is None:
+            cpu = scheduler.Lane('cpu', Pool(processes=self.threads, initializer=worker.init_worker, initargs=setup),
+                                 self.threads, cpu_bound=True)
+        else:
+            import distributed
+            # All encodes are queued right away, every worker slot takes the next one (the longest) when it's free
+            cpu = scheduler.Lane('cpu', distributed.Coordinator(self.serve, self.authkey, setup), sys.maxsize,
+                                 cpu_bound=True, throttled=False)
+        self.lanes = {
+            'cpu': cpu,
+            'io': scheduler.Lane('io', ThreadPool(self.copy_threads), self.copy_threads, cpu_bound=False),
+        }
+
+    @staticmethod
+    def lane_name(job: Job) -> str:
+        return 'cpu' if job.action == 'convert' else 'io'
+
+    @staticmethod
+    def job_cost(job: Job) -> float:
+        # Encode time grows with the duration of the audio, copy time with the size
+        if job.action == 'convert':
+            return estimated_duration(job.rel_path + job.src_ext, job.size)
+        return job.size
+
+    def batches(self, jobs: List[Job]) -> List[List[Job]]:
+        """
+        Splits the jobs of a lane into batches that each run on a single worker, in the order they are submitted
+        (from the end). Every job is a batch of its own, unless group_albums is set: then the conversions of a
+        directory are a batch, so each worker reads one folder after the other (which stays in the page cache, and
+        on spinning disks isn't a seek per track) rather than all workers reading from all over the library.
+        """
+        if not self.group_albums:
+            batches = [[job] for job in jobs]
+        else:
+            batches = []
+            albums: Dict[str, List[Job]] = {}
+            for job in jobs:
+                if job.action == 'convert':
+                    albums.setdefault(os.path.dirname(job.rel_path), []).append(job)
+                else:
+                    batches.append([job])
+            for tracks in albums.values():
+                # In track order, which usually is the order the files were written in
+                tracks.sort(key=lambda job: job.rel_path)
+                batches.extend(tracks[i:i + ALBUM_TRACKS] for i in range(0, len(tracks), ALBUM_TRACKS))
+        # Longest first, so no long batch starts when the others are almost done
+        batches.sort(key=lambda batch: sum(self.job_cost(job) for job in batch))
+        return batches
+
+    def schedule(self, pending: Dict[str, List[List[Job]]]) -> None:
+        """
+        Submits the pending batches of each lane whenever it has a free worker, until all are submitted.
+        """
+        while any(pending.values()):
+            # Cleared before looking for free workers, so a job finishing in between isn't missed
+            self.slot_freed.clear()
+            submitted = False
+            for name, batches in pending.items():
+                while batches and self.lanes[name].try_acquire(self.throttle):
+                    batch = batches.pop()
+                    if len(batch) == 1:
+                        self.run(batch[0])
+                    else:
+                        self.run_batch(batch)
+                    submitted = True
+            if not submitted:
+                with self.stats.timer('queue_wait'):
+                    # Also wakes up now and then without a finished job, the throttle might allow more by now
+                    self.slot_freed.wait(scheduler.THROTTLE_INTERVAL)
+
+    def run(self, job: Job) -> None:
+        src_path = self.source_dir + os.sep + job.rel_path + job.src_ext
+        dest_path = self.target_dir + os.sep + job.rel_path + job.dest_ext
+
+        if job.action == 'skip':
+            record = self.db.get(job.rel_path) if self.db is not None else None
+            self.record(job.rel_path, src_path, self.unrecorded_profiles(job, record), src_stat=job.stat)
+        elif job.action == 'move':
+            self.move(job, src_path, dest_path)
+            self.finished(job)
+        elif job.action == 'delete':
+            self.delete(job)
+            self.finished(job)
+        else:
+            self.stats.source_read(os.path.dirname(job.rel_path))
+            self.lanes[self.lane_name(job)].pool.apply_async(worker.run_migration, self.prepare(job),
+                                                             callback=partial(self.on_migrated, job, src_path),
+                                                             error_callback=partial(self.on_failed, job, src_path))
+
+    def run_batch(self, jobs: List[Job]) -> None:
+        """
+        Submits migrations that run one after the other on the same worker.
+        """
+        self.stats.source_read(os.path.dirname(jobs[0].rel_path))
+        migrations = [self.prepare(job) for job in jobs]
+        self.lanes[self.lane_name(jobs[0])].pool.apply_async(worker.run_migrations, (migrations,),
+                                                             callback=partial(self.on_batch_migrated, jobs),
+                                                             error_callback=partial(self.on_batch_failed, jobs))
+
+    def prepare(self, job: Job) -> Tuple[Callable[[str, str], None], str, str, bool]:
+        """
+        Returns what a pool worker runs for a migration: the function with its arguments, source and dest path, and
+        whether to fingerprint the source (see worker.run_migration).
+        """
+        src_path = self.source_dir + os.sep + job.rel_path + job.src_ext
+        dest_path = self.target_dir + os.sep + job.rel_path + job.dest_ext
+        migrate = self.migrations[job.action]
+        if job.action == 'convert':
+            migrate = partial(migrate, timeout=encode_timeout(src_path, job.size))
+        if job.profiles is not None or job.bitrate is not None:
+            outputs = [self.output(name, job.rel_path, job.bitrate) for name in job.profiles or [DEFAULT_PROFILE]]
+            for path, _ in outputs[1:]:
+                self.make_dirs(path)
+            dest_path, args = outputs[0]
+            migrate = partial(migrate, args=args, extra_outputs=outputs[1:])
+        self.make_dirs(dest_path)
+
+        self.logger.info('migrating: "%s" -> "%s"', src_path, dest_path)
+        if self.journal is not None:
+            self.journal.started(job.key())
+        # Unless planning needed it already. Computed by the worker, not when recording on the pool's result thread
+        with self.lock:
+            fingerprint = self.check == 'hash' and src_path not in self.fingerprints
+        return migrate, src_path, dest_path, fingerprint
+
+    def make_dirs(self, path: str) -> None:
+        """
+        Creates the directory of path, once per directory rather than for every file in it.
+        """
+        dir_path = os.path.dirname(path)
+        if dir_path not in self.dirs_made:
+            os.makedirs(dir_path, exist_ok=True)
+            self.dirs_made.add(dir_path)
 
-            self.db[rel_path] = {
-                'size': size,
-                'last_modified': mod_time,
-            }
+    def output(self, profile: str, rel_path: str, bitrate: Optional[int] = None) -> encoders.Output:
+        """
+        Returns the path and encoder arguments of the output of a profile. bitrate replaces the one of the default
+        target's arguments.
+        """
+        if profile == DEFAULT_PROFILE:
+            args = self.opusenc_args if bitrate is None else budget.with_bitrate(self.opusenc_args, bitrate)
+            return self.target_dir + os.sep + rel_path + '.opus', args
+        target_dir, args = self.extra_targets[profile]
+        return target_dir + os.sep + rel_path + '.opus', args
 
-            if self.n%self.db_write_frequency == 0 and self.db_file is not None:
-                logging.info('updating db file')
-                with open(self.db_file, 'w') as f:
-                    f.write(json.dumps(self.db))
-                logging.info('updated db file')
+    def on_migrated(self, job: Job, src_path: str, result: worker.Result) -> None:
+        with self.guarded([job]):
+            self.release(job)
+            self.migrated(job, src_path, result)
 
-        self.n += 1
+    def on_failed(self, job: Job, src_path: str, error: BaseException) -> None:
+        with self.guarded([job]):
+            self.release(job)
+            self.failed(job, src_path, error)
 
+    def on_batch_migrated(self, jobs: List[Job],
+                          results: List[Tuple[Optional[worker.Result], Optional[BaseException]]]) -> None:
+        with self.guarded(jobs):
+            self.release(jobs[0])
+            for job, (result, error) in zip(jobs, results):
+                src_path = self.source_dir + os.sep + job.rel_path + job.src_ext
+                if error is None:
+                    self.migrated(job, src_path, result)
+                else:
+                    self.failed(job, src_path, error)
 
-    def needs_migration(self, src_file: str, dest_file: str, rel_path: str) -> bool:
+    def on_batch_failed(self, jobs: List[Job], error: BaseException) -> None:
+        with self.guarded(jobs):
+            self.release(jobs[0])
+            for job in jobs:
+                self.failed(job, self.source_dir + os.sep + job.rel_path + job.src_ext, error)
+
+    @contextmanager
+    def guarded(self, jobs: List[Job]) -> Iterator[None]:
+        """
+        Wraps the callbacks of the pools, which run on a pool's result thread. An exception would end that thread,
+        and waiting for the pool would never return.
+        """
+        try:
+            yield
+        except Exception:
+            self.logger.exception('failed to handle the result of %d job(s)', len(jobs))
+            with self.lock:
+                self.failures.extend(self.source_dir + os.sep + job.rel_path + job.src_ext for job in jobs)
+
+    def migrated(self, job: Job, src_path: str, result: worker.Result) -> None:
+        elapsed = result.elapsed
+        try:
+            self.stats.add_time('encode' if job.action == 'convert' else 'copy', elapsed)
+            if result.fingerprint is not None and job.stat is not None:
+                with self.lock:
+                    # Picked up by entry, instead of reading the source once more
+                    self.fingerprints[src_path] = ((job.stat.st_ino, job.stat.st_size, job.stat.st_mtime),
+                                                   result.fingerprint)
+            if job.action == 'convert':
+                profiles = job.profiles or [DEFAULT_PROFILE]
+                extra = {'bitrate': job.bitrate} if job.bitrate is not None and DEFAULT_PROFILE in profiles else {}
+                # Keeps track of the encode speed for estimating future runs
+                self.record(job.rel_path, src_path, profiles, src_stat=job.stat,
+                            duration=estimated_duration(src_path, job.size), encode_time=elapsed / len(profiles),
+                            encoder_version=result.encoder_version, **extra)
+                if self.target_index is not None and self.target_index.contains(job.rel_path, job.src_ext):
+                    self.delete_fallback_copy(job)
+            else:
+                self.record(job.rel_path, src_path, src_stat=job.stat)
+        except Exception as e:
+            # E.g. the db can't be written, the output is there but not recorded
+            self.failed(job, src_path, e)
+            return
+        self.finished(job)
+
+    def failed(self, job: Job, src_path: str, error: BaseException) -> None:
+        self.finished(job, failed=True)
+        # Not recorded in the db, so the file is retried on the next run
+        self.logger.error('failed to migrate "%s": %s', src_path, error)
+        with self.lock:
+            self.failures.append(src_path)
+
+    def release(self, job: Job) -> None:
+        self.lanes[self.lane_name(job)].release()
+        self.slot_freed.set()
+
+    def finished(self, job: Job, failed: bool = False) -> None:
+        self.stats.job_done(job.action, job.size, failed)
+        if self.journal is not None:
+            # Failed jobs are finished as well, they are retried by the next full run like without a journal
+            self.journal.finished(job.key())
+
+    def record(self, rel_path: str, src_path: str, profiles: Iterable[str] = (),
+               src_stat: Optional[os.stat_result] = None, **extra) -> None:
+        """
+        Records a migrated or skipped file in the db. src_stat should be the stat data the decision was based on
+        (the scan's), so a source changed while it was being encoded is migrated again on the next run.
+        """
+        with self.lock:
+            if self.db is not None:
+                if src_stat is None:
+                    src_stat = os.stat(src_path)
+                entry = self.entry(rel_path, src_path, src_stat, self.db.get(rel_path), profiles, **extra)
+                with self.stats.timer('db'):
+                    self.db[rel_path] = entry
+
+            self.n += 1
+
+    def record_dir(self, jobs: List[Job]) -> None:
+        """
+        Records the skipped files of a directory in a single db update, leaving out those whose record is current.
+        What else is recorded about their outputs (e.g. encode times) still holds, as they weren't written again.
+        """
+        with self.lock:
+            if self.db is not None:
+                entries = {}
+                for job in jobs:
+                    src_path = self.source_dir + os.sep + job.rel_path + job.src_ext
+                    src_stat = job.stat if job.stat is not None else os.stat(src_path)
+                    record = self.db.get(job.rel_path)
+                    entry = dict(record or {}, **self.entry(job.rel_path, src_path, src_stat, record,
+                                                            self.unrecorded_profiles(job, record)))
+                    if entry != record:
+                        entries[job.rel_path] = entry
+                if entries:
+                    with self.stats.timer('db'):
+                        self.db.update(entries)
+
+            self.n += len(jobs)
+
+    def profile(self, name: str, encoder_version: str) -> str:
+        key = (name, encoder_version)
+        if key not in self.profiles:
+            self.profiles[key] = encoders.profile(self.encoder, self.profile_args[name], encoder_version)
+        return self.profiles[key]
+
+    def profile_outdated(self, name: str, record: Dict) -> bool:
+        """
+        Returns whether the output of a profile was recorded with other settings or another encoder version than the
+        current ones. If the encoder version isn't known here, the current settings are compared with the version the
+        output was encoded with, and outputs recorded without it count as up to date.
+        """
+        encoder_version = self.encoder_version
+        if encoder_version == encoders.UNKNOWN_VERSION:
+            encoder_version = record.get('encoder_version')
+            if encoder_version is None:
+                return False
+        return record.get('profiles', {}).get(name) != self.profile(name, encoder_version)
+
+    def unrecorded_profiles(self, job: Job, record: Optional[Dict]) -> List[str]:
+        """
+        Returns the profile of a skipped conversion if its output was recorded before profiles were. It was just
+        found up to date, so it's recorded with the current settings and encoded again once they change.
+        """
+        if self.encoder_version == encoders.UNKNOWN_VERSION:
+            # There is no telling which profile that is
+            return []
+        if job.dest_ext == '.opus' and job.src_ext != '.opus' \
+                and (record is None or DEFAULT_PROFILE not in record.get('profiles', {})):
+            return [DEFAULT_PROFILE]
+        return []
+
+    def entry(self, rel_path: str, src_path: str, src_stat: os.stat_result, record: Optional[Dict],
+              profiles: Iterable[str] = (), encoder_version: Optional[str] = None, **extra) -> Dict:
+        """
+        Returns the db record of a file. profiles are the outputs that were just encoded, with encoder_version
+        (the installed one unless given).
+        """
+        entry = {
+            'size': src_stat.st_size,
+            'last_modified': src_stat.st_mtime,
+            'inode': src_stat.st_ino,
+            **extra,
+        }
+        if self.check == 'hash':
+            entry['hash'] = self.fingerprint(src_path, src_stat, record)
+            self.fingerprints.pop(src_path, None)
+        if self.extensions_to_action.get(os.path.splitext(src_path)[1]) == 'convert':
+            entry['codec'] = self.codec(src_path, src_stat, record)
+            self.codecs.pop(src_path, None)
+            if self.target_size is not None:
+                entry['seconds'] = self.duration(src_path, src_stat, record)
+                self.durations.pop(src_path, None)
+        if profiles and DEFAULT_PROFILE not in profiles and record is not None and record.get('bitrate') is not None:
+            # Only extra targets were encoded, the default output keeps its bitrate
+            entry['bitrate'] = record['bitrate']
+        # Settings the outputs were encoded with, kept for the outputs that weren't encoded now
+        encoded_with = dict(record.get('profiles', {})) if record is not None else {}
+        if record is not None and record.get('encoder_version') is not None:
+            entry['encoder_version'] = record['encoder_version']
+        encoder_version = encoder_version or self.encoder_version
+        if profiles and encoder_version != encoders.UNKNOWN_VERSION:
+            encoded_with.update({name: self.profile(name, encoder_version) for name in profiles})
+            # Needed to compare the settings where the encoder isn't installed, see profile_outdated
+            entry['encoder_version'] = encoder_version
+        if encoded_with:
+            entry['profiles'] = encoded_with
+        return entry
+
+    def needs_migration(self, src_file: str, dest_file: str, rel_path: Optional[str] = None,
+                        dest_exists: Optional[bool] = None, src_stat: Optional[os.stat_result] = None) -> bool:
         base_name = os.path.basename(dest_file)
         if any(p.match(base_name) for p in self.exclude_regexes):
             return False
 
-        if not os.path.isfile(dest_file):
+        if dest_exists is False:
             return True
 
-        size = os.path.getsize(src_file)
-        mod_time = os.path.getmtime(src_file)
+        if self.db is None:
+            try:
+                dest_stat = os.stat(dest_file)
+            except FileNotFoundError:
+                return True
 
-        if filecmp.cmp(src_file, dest_file):
-            return False
+            if src_stat is None:
+                src_stat = os.stat(src_file)
 
-        if self.db is not None:
-            if rel_path in self.db:
-                return (self.db[rel_path]['size'] != size) | (self.db[rel_path]['last_modified'] != mod_time)
-            else:
+            # The output was written after the source was last changed, so an output older than its source is stale
+            if dest_stat.st_mtime < src_stat.st_mtime:
                 return True
+            return self.check == 'content' and self.content_differs(src_file, dest_file)
+
+        if dest_exists is None and not os.path.isfile(dest_file):
+            return True
 
-        return needs_migration
+        if src_stat is None:
+            src_stat = os.stat(src_file)
 
-    def migrate(self):
-        self.logger.info('checking for unconverted files')
-        for root, _, files in os.walk(self.source_dir):
-            for file in files:
-                file_base, src_ext = os.path.splitext(file)
-                src_base = root + os.sep + file_base
-                self.extensions_to_action.get(src_ext, self.copy)(src_base, src_ext)
+        if rel_path is None:
+            rel_path, _ = os.path.splitext(os.path.relpath(src_file, self.source_dir))
 
-        self.logger.info('finishing conversions')
-        self.pool.close()
-        self.pool.join()
+        record = self.db.get(rel_path)
+        if record is None:
+            return True
+
+        if os.path.splitext(dest_file)[1] == '.opus' and DEFAULT_PROFILE in record.get('profiles', {}) \
+                and self.profile_outdated(DEFAULT_PROFILE, record):
+            # Encoded with other arguments or another encoder version. Outputs recorded before profiles were, are
+            # assumed to be up to date, and recorded with the current profile when skipped (see unrecorded_profiles).
+            return True
+
+        if os.path.splitext(dest_file)[1] == '.opus' and self.target_size is None and record.get('bitrate') is not None:
+            # Encoded with a bitrate picked for a target size, which isn't set anymore
+            return True
+
+        if record['size'] == src_stat.st_size and record['last_modified'] == src_stat.st_mtime:
+            inode = record.get('inode')
+            if inode is not None and inode != src_stat.st_ino and record.get('hash') is not None:
+                # Replaced by a file with the same size and mtime, the fingerprint tells if it's the same
+                return self.fingerprint(src_file, src_stat, record) != record['hash']
+            # Otherwise another inode alone doesn't mean much: restored from a backup (rsync -a), moved to another
+            # disk or remounted. The new one is recorded along with the skipped file.
+            return self.check == 'content' and self.content_differs(src_file, dest_file)
+
+        # Stat data changed - look at the content
+        if self.check == 'hash' and record.get('hash') is not None:
+            # Retagging, touch or a sync client rewriting mtimes doesn't change the audio
+            return self.fingerprint(src_file, src_stat, record) != record['hash']
+
+        return True
+
+    def fingerprint(self, src_file: str, src_stat: os.stat_result, record: Optional[Dict]) -> str:
+        """
+        Returns the audio fingerprint of src_file, reusing the one in its db record while inode, size and mtime match.
+        """
+        return self.cached('hash', self.fingerprints, audio.fingerprint, src_file, src_stat, record)
+
+    def duration(self, src_file: str, src_stat: os.stat_result, record: Optional[Dict]) -> float:
+        """
+        Returns the duration of src_file in seconds from its header, reusing the one in its db record while inode,
+        size and mtime match.
+        """
+        return self.cached('seconds', self.durations, read_duration, src_file, src_stat, record)
+
+    def codec(self, src_file: str, src_stat: os.stat_result, record: Optional[Dict]) -> Optional[str]:
+        """
+        Returns the codec detected from the header of src_file, reusing the one in its db record while inode, size
+        and mtime match.
+        """
+        return self.cached('codec', self.codecs, probe, src_file, src_stat, record)
+
+    @staticmethod
+    def cached(field: str, cache: Dict[str, Tuple[Tuple[int, int, float], Any]], compute: Callable[[str], Any],
+               src_file: str, src_stat: os.stat_result, record: Optional[Dict]) -> Any:
+        key = (src_stat.st_ino, src_stat.st_size, src_stat.st_mtime)
+        if record is not None and record.get(field) is not None \
+                and (record.get('inode'), record['size'], record['last_modified']) == key:
+            return record[field]
+
+        cached_key, value = cache.get(src_file, (None, None))
+        if cached_key != key:
+            value = compute(src_file)
+            cache[src_file] = (key, value)
+        return value
+
+    @staticmethod
+    def content_differs(src_file: str, dest_file: str) -> bool:
+        if os.path.splitext(src_file)[1] != os.path.splitext(dest_file)[1]:
+            # A converted file can't be compared to its source
+            return True
+
+        import filecmp
+        return not filecmp.cmp(src_file, dest_file, shallow=False)
 
     def delete_removed(self):
+        self.target_index = scan.scan(self.target_dir, stat=False, threads=self.scan_threads)
+        removed = self.find_removed(scan.scan(self.source_dir, stat=False, threads=self.scan_threads),
+                                    self.target_index)
+        for job in removed:
+            self.delete(job)
+        gone = {(job.rel_path, job.dest_ext) for job in removed}
+        self.delete_empty_dirs(self.find_empty_dirs(self.target_index, gone))
+
+    def find_removed(self, source_index: scan.Index, target_index: scan.Index) -> List[Job]:
+        """
+        Returns delete jobs for all outputs for which source files do not exist anymore.
+        """
         self.logger.info('checking source files that do not exist anymore')
-        for root, _, files in os.walk(self.target_dir):
-            for file in files:
-                file_base, dest_ext = os.path.splitext(file)
-                dest_base = root + os.sep + file_base
-                dest_path = dest_base + dest_ext
-                src_base = self.source_dir + os.sep + os.path.relpath(dest_base, self.target_dir)
-
-                needs_deletion = True
-                if dest_ext == ".opus":  # check for unconverted origin file
-                    for ext in SOURCE_EXTENSIONS:
-                        if os.path.isfile(src_base + ext):
-                            needs_deletion = False
-                            break
-                elif os.path.isfile(src_base + dest_ext):  # check any other file types (images, etc.)
-                    needs_deletion = False
-
-                if needs_deletion:
-                    self.logger.info("deleting " + dest_path + " (source file doesn't exist anymore)")
-                    os.remove(dest_path)
-                    if self.db is not None:
-                        if dest_ext == ".opus":
-                            for ext in SOURCE_EXTENSIONS:  # this (fishing for dict key) could be better
-                                if self.db.get(src_base + ext) is not None:
-                                    del self.db[src_base + ext]
-                        elif self.db.get(file) is not None:
-                            del self.db[file]
-                    continue
-
-        for root, dirs, _ in os.walk(self.target_dir):  # check for empty dirs AFTER it deleted all possible files
-            for directory in dirs:
-                dir_path = root + os.sep + directory
-                if not os.listdir(dir_path):
-                    self.logger.info("deleting " + dir_path + " (empty directory)")
-                    os.rmdir(dir_path)
+        removed = []
+        for rel_path, dest_ext, _ in target_index.entries():
+            src_exts = source_index.extensions(rel_path)
+            if dest_ext in src_exts:  # any file types that are copied (images, etc.)
+                continue
+            if dest_ext == encoders.PARTIAL_SUFFIX:  # see find_partial
+                continue
+            if not source_index.readable(rel_path):  # the source might still exist
+                continue
+            if dest_ext == '.opus' and not src_exts.keys().isdisjoint(SOURCE_EXTENSIONS):  # converted origin file
+                continue
+
+            size = os.path.getsize(self.target_dir + os.sep + rel_path + dest_ext)
+            removed.append(Job('delete', rel_path, '', dest_ext, size))
+        return removed
+
+    @staticmethod
+    def find_partial(source_index: scan.Index, target_index: scan.Index) -> List[Job]:
+        """
+        Returns delete jobs for outputs that were left incomplete by an interrupted run.
+        """
+        partial = []
+        for rel_path, ext, _ in target_index.entries():
+            if ext == encoders.PARTIAL_SUFFIX and not source_index.contains(rel_path, ext):
+                partial.append(Job('delete', rel_path, '', ext))
+        return partial
+
+    def find_fallback_copies(self, jobs: List[Job], target_index: scan.Index) -> List[Job]:
+        """
+        Returns delete jobs for copies that opusenc fell back to on an earlier run, of files that are converted by now.
+        """
+        copies = []
+        for job in jobs:
+            if job.dest_ext == '.opus' and job.src_ext != '.opus' and job.action == 'skip' \
+                    and target_index.contains(job.rel_path, job.src_ext):
+                size = os.path.getsize(self.target_dir + os.sep + job.rel_path + job.src_ext)
+                # With the source's extension, unlike outputs whose source was removed
+                copies.append(Job('delete', job.rel_path, job.src_ext, job.src_ext, size))
+        return copies
+
+    def index_removed(self, removed: List[Job]) -> None:
+        if self.db is None:
+            return
+
+        for job in removed:
+            record = self.db.get(job.rel_path)
+            if record is None:
+                continue
+
+            entry = (self.target_dir + os.sep + job.rel_path + job.dest_ext, job.rel_path)
+            self.removed_by_stat.setdefault((record['size'], record['last_modified']), []).append(entry)
+            if record.get('hash') is not None:
+                self.removed_by_hash.setdefault(record['hash'], []).append(entry)
+
+    def find_moved(self, src_path: str, src_stat: os.stat_result, dest_exts: Set[str]) -> Optional[Tuple[str, str]]:
+        """
+        Returns (dest_path, rel_path) of the removed output a new source file was moved from, if there is one.
+        """
+        candidates = self.removed_by_stat.get((src_stat.st_size, src_stat.st_mtime))
+        if not candidates and self.removed_by_hash:
+            # Moving files usually keeps mtimes, but copying them around might not
+            candidates = self.removed_by_hash.get(self.fingerprint(src_path, src_stat, None))
+
+        match = self.pick_moved(candidates, os.path.basename(src_path), dest_exts)
+        if match is None:
+            return None
+
+        # Every output can only be moved once
+        for index in [self.removed_by_stat, self.removed_by_hash]:
+            for key, entries in list(index.items()):
+                if match in entries:
+                    entries.remove(match)
+                    if not entries:
+                        del index[key]
+        return match
+
+    @staticmethod
+    def pick_moved(candidates: Optional[List[Tuple[str, str]]], src_name: str,
+                   dest_exts: Set[str]) -> Optional[Tuple[str, str]]:
+        """
+        Picks the removed output a new source file was moved from, None if there is no unambiguous one.
+        """
+        if not candidates:
+            return None
+
+        candidates = [c for c in candidates if os.path.splitext(c[0])[1] in dest_exts]
+        if len(candidates) > 1:
+            # Several files with the same size and mtime (or audio), an album folder rename keeps the file names
+            src_base, _ = os.path.splitext(src_name)
+            candidates = [c for c in candidates if os.path.splitext(os.path.basename(c[0]))[0] == src_base]
+
+        return candidates[0] if len(candidates) == 1 else None
+
+    def move(self, job: Job, src_path: str, dest_path: str) -> None:
+        old_dest_path = self.target_dir + os.sep + job.moved_from + job.dest_ext
+        if os.path.exists(old_dest_path) or not os.path.exists(dest_path):
+            self.logger.info('moving "%s" -> "%s" (source file was moved)', old_dest_path, dest_path)
+            self.make_dirs(dest_path)
+            os.rename(old_dest_path, dest_path)
+        # else a resumed run, which died between moving the output and journaling it
+
+        if job.dest_ext == '.opus':
+            for target_dir, _ in self.extra_targets.values():
+                old_path = target_dir + os.sep + job.moved_from + job.dest_ext
+                if os.path.exists(old_path):
+                    new_path = target_dir + os.sep + job.rel_path + job.dest_ext
+                    self.make_dirs(new_path)
+                    os.rename(old_path, new_path)
+
+        if self.db is not None:
+            src_stat = job.stat if job.stat is not None else os.stat(src_path)
+            with self.lock:
+                record = self.db.pop(job.moved_from, {})
+                # Keeps the fingerprint, the new location is recorded with its current stat data
+                self.db[job.rel_path] = dict(record, size=src_stat.st_size, last_modified=src_stat.st_mtime,
+                                             inode=src_stat.st_ino)
+
+    def delete_fallback_copy(self, job: Job) -> None:
+        """
+        Deletes the copy an earlier run fell back to once a file is converted, unless the encoder fell back to copying
+        once more.
+        """
+        if os.path.exists(self.target_dir + os.sep + job.rel_path + '.opus'):
+            self.delete(Job('delete', job.rel_path, job.src_ext, job.src_ext))
+
+    def delete(self, job: Job) -> None:
+        dest_path = self.target_dir + os.sep + job.rel_path + job.dest_ext
+        if job.src_ext:
+            # See find_fallback_copies, the source and its record stay
+            self.logger.info("deleting " + dest_path + " (copy of a file that is converted now)")
+            try:
+                os.remove(dest_path)
+            except FileNotFoundError:
+                pass
+            return
+        if job.dest_ext == encoders.PARTIAL_SUFFIX:
+            self.logger.info("deleting " + dest_path + " (incomplete output of an interrupted run)")
+        else:
+            self.logger.info("deleting " + dest_path + " (source file doesn't exist anymore)")
+        try:
+            os.remove(dest_path)
+        except FileNotFoundError:
+            # A resumed run, which died between deleting the output and journaling it
+            pass
+        if job.dest_ext == '.opus':
+            for target_dir, _ in self.extra_targets.values():
+                try:
+                    os.remove(target_dir + os.sep + job.rel_path + job.dest_ext)
+                except FileNotFoundError:
+                    pass
+        if self.db is not None:
+            with self.lock:
+                self.db.pop(job.rel_path, None)
+
+    @staticmethod
+    def find_empty_dirs(target_index: scan.Index, gone: Set[Tuple[str, str]]) -> List[str]:
+        """
+        Returns the directories of the index that are empty once the gone (rel_path, ext) outputs are removed,
+        deepest first.
+        """
+        # Directories that still contain a file, and their parents
+        used = set()
+        for rel_path, exts in target_index.files.items():
+            if all((rel_path, ext) in gone for ext in exts):
+                continue
+            rel_dir = os.path.dirname(rel_path)
+            while rel_dir and rel_dir not in used:
+                used.add(rel_dir)
+                rel_dir = os.path.dirname(rel_dir)
+
+        # Deepest first, so parents that only contained empty directories are removed as well
+        return sorted(set(target_index.dirs) - used, key=lambda d: d.count(os.sep), reverse=True)
+
+    def delete_empty_dirs(self, empty_dirs: List[str], target_dir: Optional[str] = None) -> None:
+        for rel_dir in empty_dirs:
+            dir_path = (target_dir or self.target_dir) + os.sep + rel_dir
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                # Received new outputs during this run
+                continue
+            self.logger.info("deleting " + dir_path + " (empty directory)")
 
 
 def parse_args():
+    import configargparse
+
     p = configargparse.ArgParser()
     p.add_argument('-c', '--config', is_config_file=True, help='config file path')
-    p.add_argument('-s', '--source', required=True, help='path to source directory')
-    p.add_argument('-t', '--target', required=True, help='path to target directory')
-    p.add_argument('-thr', '--threads', metavar="COUNT", help='thread count for parallel processing')
+    p.add_argument('-s', '--source', help='path to source directory (required unless --apply is used)')
+    p.add_argument('-t', '--target', help='path to target directory (required unless --apply is used)')
+    p.add_argument('-thr', '--threads', metavar="COUNT",
+                   help='number of parallel encoder processes (default: number of CPU cores)')
+    p.add_argument('--copy-threads', metavar='COUNT', type=int, default=COPY_THREADS,
+                   help='number of files copied in parallel (default: %(default)s)')
+    p.add_argument('--no-throttle', action='store_true',
+                   help='always use all encoder processes and copy threads. by default fewer are used while other '
+                        'processes keep the CPUs busy (load average) or the disks cannot keep up (I/O pressure)')
+    p.add_argument('--group-albums', action='store_true',
+                   help='encode the tracks of a directory one after the other in the same encoder process, '
+                        'so the source disks read one folder at a time instead of a track from each of them')
+    p.add_argument('--serve', metavar='[HOST]:PORT',
+                   help='encode on other hosts: listen on PORT for workers started with distributed.py and hand them '
+                        'the conversions, everything else runs here. source and target have to be on storage all '
+                        'hosts can reach')
+    p.add_argument('--authkey', env_var=AUTHKEY_ENV,
+                   help='key the workers need to connect with --serve, preferably set in the environment '
+                        'so it doesn\'t show up in the process list')
+    p.add_argument('--scan-threads', metavar='COUNT', type=int, default=scan.SCAN_THREADS,
+                   help='number of directories listed concurrently (default: %(default)s), '
+                        'more help on network mounts with high latency')
     p.add_argument('-del', '--del-removed', action='store_true',
                    help='delete converted opus files, for which source files do not exist anymore')
     p.add_argument('-a', '--opusenc-args', action='append', default=[],
                    help='arguments to pass to opusenc. '
                         '(see https://mf4.xiph.org/jenkins/view/opus/job/opus-tools/ws/man/opusenc.html)')
+    p.add_argument('--extra-target', metavar='NAME:DIR[:OPUSENC_ARGS]', action='append', default=[],
+                   help='also encode the converted files to DIR with other opusenc arguments, e.g. '
+                        '"phone:/media/phone:--bitrate 64". the source is read once for all targets. '
+                        'NAME identifies the target in the database, can be given multiple times')
+    p.add_argument('--target-size', metavar='SIZE', type=budget.parse_size,
+                   help='fit the target into SIZE (e.g. 64G for a phone) by picking a bitrate per directory, '
+                        'replacing --bitrate in --opusenc-args. files are only encoded again when their bitrate '
+                        'changes. needs --database and the opusenc encoder')
+    p.add_argument('-e', '--encoder', choices=encoders.ENCODERS, default='opusenc',
+                   help='opusenc (default) runs opusenc for every file, '
+                        'sndfile encodes in-process with libsndfile which is faster for many short files '
+                        '(requires the soundfile package, ignores --opusenc-args)')
+    p.add_argument('--hardlink', action='store_true',
+                   help='hardlink files that are not converted (images, lossy sources) instead of copying them, '
+                        'if source and target are on the same filesystem. changing such an output in place changes '
+                        'the source as well')
     p.add_argument('-db', '--database', help='path to the database file')
+    p.add_argument('--db-backend', choices=['json', 'sqlite'],
+                   help='database format, by default sqlite for .sqlite/.sqlite3/.db files and json otherwise. '
+                        'use state.py to import an existing json database into sqlite')
+    p.add_argument('--check', choices=CHECK_MODES, default='stat',
+                   help='how to decide if an existing output is up to date. '
+                        'stat (default) only looks at sizes and modification times, '
+                        'content also compares copied files byte by byte, '
+                        'hash skips files whose audio fingerprint is unchanged even if they were touched or retagged '
+                        '(requires --database)')
+    p.add_argument('--plan', metavar='PLAN_FILE',
+                   help='only scan and decide what to do, without converting anything. '
+                        'writes the plan with counts, sizes and an estimated CPU time per action as JSON to '
+                        'PLAN_FILE (- for stdout)')
+    p.add_argument('--apply', metavar='PLAN_FILE', help='execute a plan previously saved with --plan')
+    p.add_argument('--files-from', metavar='LIST_FILE',
+                   help='only migrate the files listed in LIST_FILE (- for stdin) instead of scanning the whole '
+                        'source directory. one path per line or NUL separated (like base_diff.py --format nul), '
+                        'relative to the source directory. directories are migrated completely, with --del-removed '
+                        'the outputs of listed files that do not exist anymore are deleted')
+    p.add_argument('--journal', metavar='JOURNAL_FILE',
+                   help='log started and finished jobs to JOURNAL_FILE while converting. if a run dies, the next run '
+                        'with the same journal continues the interrupted plan instead of scanning again')
+    p.add_argument('-w', '--watch', action='store_true',
+                   help='keep running after the migration and migrate files as soon as they are added, changed, '
+                        'removed or renamed in the source directory')
+    p.add_argument('--poll', metavar='SECONDS', type=float,
+                   help='with --watch, scan the source directory every SECONDS instead of using inotify. '
+                        'needed for network mounts, inotify only sees changes made by the local machine')
+    p.add_argument('--settle', metavar='SECONDS', type=float, default=SETTLE_SECONDS,
+                   help='with --watch, wait until files were not changed for SECONDS (default: %(default)s), '
+                        'so files that are still being written are not converted')
+    p.add_argument('--progress', metavar='SECONDS', type=float, default=60,
+                   help='log a progress line with throughput and ETA every SECONDS while converting (0 to disable)')
+    p.add_argument('--summary', metavar='SUMMARY_FILE',
+                   help='write counters and per stage timings (scan, decide, queue wait, encode, copy, db) of the run '
+                        'as JSON to SUMMARY_FILE')
+    p.add_argument('--metrics', metavar='EXPORTER', action='append', default=[],
+                   help='export the metrics with every progress line: prometheus:PATH writes the Prometheus text '
+                        'format to PATH, statsd:HOST:PORT sends statsd gauges over UDP')
     p.add_argument('-v', '--verbose', action='store_true', help='print debug information')
     p.add_argument('-x', '--exclude', action='append', default=[],
                    help='files (Python REGEX) to exclude in the migration. '
@@ -204,24 +1317,48 @@ def parse_args():
 
     options = p.parse_args()
 
+    if options.apply is None and (options.source is None or options.target is None):
+        p.error('the following arguments are required: -s/--source, -t/--target')
+    if options.files_from is not None and options.apply is not None:
+        p.error('argument --files-from: not allowed with argument --apply')
+    if options.watch and options.plan is not None:
+        p.error('argument -w/--watch: not allowed with argument --plan')
+    if options.serve is not None and options.authkey is None:
+        p.error('argument --serve: needs --authkey')
+    if options.serve is not None and options.watch:
+        p.error('argument -w/--watch: not allowed with argument --serve')
+    if options.target_size is not None and (options.database is None or options.encoder != 'opusenc'):
+        p.error('argument --target-size: needs --database and the opusenc encoder')
+
     # to avoid configargparse misinterpreting the opusenc-args values we need to use single quotes around them
     options.opusenc_args = list(map(lambda arg: arg.replace("'", ''), options.opusenc_args))
 
-    return options
+    extra_targets = []
+    for spec in options.extra_target:
+        try:
+            extra_targets.append(parse_extra_target(spec))
+        except ValueError as e:
+            p.error('argument --extra-target: ' + str(e))
+    names = [name for name, _, _ in extra_targets]
+    if len(set(names)) != len(names):
+        p.error('argument --extra-target: names must be unique')
+    options.extra_target = extra_targets
 
+    return options
 
-def init_worker(opus_args: List[str], log_level: int):
-    global opusenc_args
-    opusenc_args = opus_args
-    configure_logging(log_level)
 
+def parse_extra_target(spec: str) -> Tuple[str, str, List[str]]:
+    """
+    Parses NAME:DIR[:OPUSENC_ARGS] into (name, dir, args).
+    """
+    import shlex
 
-def configure_logging(log_level: int):
-    logging.basicConfig(
-        stream=sys.stdout,
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=log_level,
-        datefmt='%Y-%m-%d %H:%M:%S')
+    parts = spec.split(':', 2)
+    if len(parts) < 2 or not parts[0] or not parts[1]:
+        raise ValueError('expected NAME:DIR[:OPUSENC_ARGS], got "%s"' % spec)
+    if parts[0] == DEFAULT_PROFILE:
+        raise ValueError('"%s" is the name of the --target profile' % DEFAULT_PROFILE)
+    return parts[0], parts[1], shlex.split(parts[2]) if len(parts) > 2 else []
 
 
 def main(cfg):
@@ -229,35 +1366,140 @@ def main(cfg):
         True: logging.DEBUG,
         False: logging.INFO,
     }[cfg.verbose]
-    configure_logging(log_level)
+    # Keep stdout clean when the plan is written to it
+    worker.configure_logging(log_level, sys.stderr if cfg.plan == '-' else sys.stdout)
 
     logging.debug('config: %s', cfg)
 
+    # Plans are only written, with --serve the workers encode, and libsndfile encodes itself
+    if encoders.find('opusenc') is None and cfg.plan is None and cfg.serve is None:
+        if cfg.encoder == 'opusenc':
+            logging.error("opusenc not found in PATH - please make sure it's installed")
+            return 1
+        logging.warning('opusenc not found in PATH, files libsndfile cannot read will fail to convert')
+
     if cfg.threads is not None:
         cfg.threads = int(cfg.threads)
 
-    db: Optional[Dict[str, Dict]] = None
+    db: Optional[state.Store] = None
 
     if cfg.database is not None:
-        if os.path.exists(cfg.database):
-            with open(cfg.database, 'r') as f:
-                db = json.load(f)
-        else:
-            db = {}
+        db = state.open_store(cfg.database, cfg.db_backend)
 
     if cfg.exclude is not None:
         exclude = set(cfg.exclude)
     else:
         exclude = None
 
-    Migrator(cfg.source, cfg.target, cfg.threads, cfg.del_removed, cfg.opusenc_args, db, exclude, cfg.database).migrate()
+    plan = None
+    if cfg.apply is not None:
+        plan = Plan.load(cfg.apply)
+        # Source and target can be overridden, e.g. if they are mounted somewhere else now
+        plan.source_dir = cfg.source or plan.source_dir
+        plan.target_dir = cfg.target or plan.target_dir
+        cfg.source, cfg.target = plan.source_dir, plan.target_dir
+
+    serve = authkey = None
+    if cfg.serve is not None:
+        import distributed
+        # Listens on all interfaces unless a host is given
+        serve = distributed.parse_address(cfg.serve, default_host='')
+        authkey = cfg.authkey.encode()
+
+    stats = metrics.Metrics(cfg.progress, [metrics.create_exporter(spec) for spec in cfg.metrics])
+    journal = None
+    if cfg.journal is not None:
+        journal = state.Journal(cfg.journal)
+        if plan is None and cfg.plan is None and journal.exists():
+            plan = resume(journal)
+            logging.info('resuming interrupted run, %d jobs left', len(plan.jobs))
+            cfg.source, cfg.target = plan.source_dir, plan.target_dir
+
+    migrator = Migrator(cfg.source, cfg.target, cfg.threads, cfg.del_removed, cfg.opusenc_args, db, exclude,
+                        check=cfg.check, encoder=cfg.encoder, stats=stats, journal=journal,
+                        scan_threads=cfg.scan_threads, copy_threads=cfg.copy_threads, throttle=not cfg.no_throttle,
+                        hardlink=cfg.hardlink, extra_targets=cfg.extra_target, group_albums=cfg.group_albums,
+                        target_size=cfg.target_size, serve=serve, authkey=authkey)
+    watcher = None
+    try:
+        if cfg.watch:
+            import watch
+            # Started first, so nothing that changes during the initial run is missed
+            watcher = watch.create(cfg.source, cfg.settle, cfg.poll)
+        if plan is None and cfg.files_from is not None:
+            plan = migrator.plan_paths(read_paths(cfg.files_from, cfg.source))
+        if plan is None:
+            plan = migrator.plan()
+        if cfg.plan is not None:
+            # Only for plans that are saved, as the encode speed is read from the whole db
+            plan.estimated_cpu_seconds = migrator.estimate_cpu_seconds(plan)
+            log_plan(plan)
+            plan.save(cfg.plan)
+            return 0
+
+        migrator.execute(plan)
+        if watcher is not None:
+            logging.info('watching "%s" for changes', cfg.source)
+            run_watch(migrator, watcher.changes())
+    except KeyboardInterrupt:
+        if watcher is None:
+            raise
+        logging.info('stopped watching')
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if journal is not None:
+            journal.close()
+        if db is not None:
+            with stats.timer('db'):
+                db.close()
+        stats.finish(cfg.summary)
+
+    return 1 if migrator.failures else 0
+
+
+def read_paths(list_file: str, source_dir: str) -> List[str]:
+    """
+    Reads the paths of --files-from, relative to source_dir.
+    """
+    if list_file == '-':
+        data = sys.stdin.read()
+    else:
+        with open(list_file, 'r') as f:
+            data = f.read()
+
+    rel_paths = []
+    for path in data.split('\0') if '\0' in data else data.splitlines():
+        if not path:
+            continue
+        rel_path = os.path.relpath(path, source_dir) if os.path.isabs(path) else os.path.normpath(path)
+        if rel_path == os.curdir or rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            logging.warning('ignoring "%s", which is not in the source directory', path)
+            continue
+        rel_paths.append(rel_path)
+    return rel_paths
+
+
+def run_watch(migrator: Migrator, changes: Iterable[Set[str]]) -> None:
+    """
+    Migrates every batch of changed source paths, see watch.Watcher.
+    """
+    import watch
+
+    for rel_paths in changes:
+        if watch.EVERYTHING in rel_paths:
+            plan = migrator.plan()
+        else:
+            plan = migrator.plan_paths(sorted(rel_paths))
+        if plan.jobs:
+            migrator.execute(plan)
 
-    if db is not None:
-        logging.info('updating db file')
 
-        with open(cfg.database, 'w') as f:
-            f.write(json.dumps(db))
+def log_plan(plan: Plan):
+    for action, totals in plan.summary().items():
+        logging.info('%-13s %8d files %12d bytes', action, totals['count'], totals['bytes'])
+    logging.info('estimated CPU time: %ds', plan.estimated_cpu_seconds)
 
 
 if __name__ == '__main__':
-    main(parse_args())
+    sys.exit(main(parse_args()))
@@ -0,0 +1,247 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import scan
+
+# Seconds between scans of the polling watcher
+POLL_INTERVAL = 30
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+# Reported instead of single paths when events were lost, means everything has to be checked
+EVERYTHING = ''
+
+
+class Watcher(object):
+    """
+    Reports paths below root (relative to it) that were added, changed, removed or renamed, once they settled.
+    Directories that were moved in or out are reported as a whole.
+    """
+
+    def __init__(self, root: str, settle: float):
+        self.logger = logging.getLogger('migrator')
+        self.root = root
+        self.settle = settle
+        # Changed paths by the time of their last event
+        self.pending: Dict[str, float] = {}
+
+    def changed(self, rel_path: str) -> None:
+        self.pending[rel_path] = time.monotonic()
+
+    def settled(self) -> Set[str]:
+        """
+        Removes and returns the pending paths that had no events for the settle time.
+        """
+        now = time.monotonic()
+        ready = {rel_path for rel_path, last_event in self.pending.items() if now - last_event >= self.settle}
+        for rel_path in ready:
+            del self.pending[rel_path]
+        return ready
+
+    def next_settled(self) -> Optional[float]:
+        """
+        Returns the seconds until the next pending path settles, None if there are none.
+        """
+        if not self.pending:
+            return None
+        return max(0.0, min(self.pending.values()) + self.settle - time.monotonic())
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Blocks until there are settled changes or timeout seconds passed, returns the changes (possibly none).
+        """
+        raise NotImplementedError
+
+    def changes(self) -> Iterator[Set[str]]:
+        while True:
+            changes = self.wait()
+            if changes:
+                yield changes
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watches every directory below root with inotify (Linux only), which costs no CPU while nothing changes.
+    Doesn't see changes made by other machines to network mounts, use PollingWatcher for those.
+    """
+
+    def __init__(self, root: str, settle: float):
+        super().__init__(root, settle)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+        # Relative directory paths by watch descriptor
+        self.dirs: Dict[int, str] = {}
+        self.add_watches('')
+
+    def add_watches(self, rel_dir: str) -> List[str]:
+        """
+        Watches rel_dir and all directories below it, returns the files found in them.
+        """
+        files = []
+        pending = [rel_dir]
+        while pending:
+            rel_dir = pending.pop()
+            path = self.root + os.sep + rel_dir if rel_dir else self.root
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                # Removed again in the meantime, or out of watches (see fs.inotify.max_user_watches)
+                self.logger.warning('cannot watch "%s": %s', path, os.strerror(ctypes.get_errno()))
+                continue
+            # A directory moved within the tree keeps its watch, under its new path
+            self.dirs[wd] = rel_dir
+
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        rel_path = rel_dir + os.sep + entry.name if rel_dir else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(rel_path)
+                        else:
+                            files.append(rel_path)
+            except FileNotFoundError:
+                continue
+        return files
+
+    def remove_watches(self, rel_dir: str) -> None:
+        """
+        Stops watching rel_dir and the directories below it, e.g. because they were moved out of root.
+        """
+        for wd, watched in list(self.dirs.items()):
+            if watched == rel_dir or watched.startswith(rel_dir + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        next_settled = self.next_settled()
+        if next_settled is not None and (timeout is None or next_settled < timeout):
+            timeout = next_settled
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            for mask, rel_path in self.read_events():
+                self.handle(mask, rel_path)
+        return self.settled()
+
+    def read_events(self) -> Iterator[Tuple[int, str]]:
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                yield mask, EVERYTHING
+                continue
+            if mask & IN_IGNORED:
+                # The directory was removed, its contents are reported by their own events
+                self.dirs.pop(wd, None)
+                continue
+            rel_dir = self.dirs.get(wd)
+            if rel_dir is None or not name:
+                # Events about a watched directory itself are reported by its parent as well
+                continue
+            yield mask, rel_dir + os.sep + name if rel_dir else name
+
+    def handle(self, mask: int, rel_path: str) -> None:
+        if rel_path == EVERYTHING:
+            self.logger.warning('lost filesystem events, checking everything')
+            self.changed(EVERYTHING)
+        elif mask & IN_ISDIR and mask & IN_CREATE:
+            # Files copied into the new directory are reported by their own events once it's watched,
+            # the ones created before are reported here
+            for rel_file in self.add_watches(rel_path):
+                self.changed(rel_file)
+        elif mask & IN_ISDIR and mask & IN_MOVED_TO:
+            self.add_watches(rel_path)
+            self.changed(rel_path)
+        elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+            # Watched again under the new path if it was moved within root
+            self.remove_watches(rel_path)
+            self.changed(rel_path)
+        elif mask & IN_ISDIR and not mask & IN_DELETE:
+            # Attribute changes of directories don't matter
+            return
+        else:
+            self.changed(rel_path)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher(Watcher):
+    """
+    Scans root every interval seconds and compares sizes and modification times, for filesystems without inotify
+    support like network mounts.
+    """
+
+    def __init__(self, root: str, settle: float, interval: float = POLL_INTERVAL):
+        super().__init__(root, settle)
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+        self.last_poll = time.monotonic()
+
+    def take_snapshot(self) -> Dict[str, Tuple[int, float]]:
+        index = scan.scan(self.root)
+        return {rel_base + ext: (stat.st_size, stat.st_mtime) for rel_base, ext, stat in index.entries()}
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        next_poll = max(0.0, self.last_poll + self.interval - time.monotonic())
+        if timeout is None or next_poll < timeout:
+            time.sleep(next_poll)
+            self.poll()
+        else:
+            time.sleep(timeout)
+        return self.settled()
+
+    def poll(self) -> None:
+        snapshot = self.take_snapshot()
+        self.last_poll = time.monotonic()
+        for rel_path in snapshot.keys() | self.snapshot.keys():
+            if snapshot.get(rel_path) != self.snapshot.get(rel_path):
+                self.changed(rel_path)
+        self.snapshot = snapshot
+
+
+def create(root: str, settle: float, poll_interval: Optional[float] = None) -> Watcher:
+    """
+    Returns a watcher for root, using inotify if it's available and no poll interval is given.
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(root, settle)
+        except (OSError, AttributeError) as e:
+            logging.getLogger('migrator').warning('inotify is not available (%s), polling every %ds instead',
+                                                  e, POLL_INTERVAL)
+            poll_interval = POLL_INTERVAL
+    return PollingWatcher(root, settle, poll_interval)
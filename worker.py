@@ -0,0 +1,73 @@
+import logging
+import sys
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import audio
+import encoders
+
+# Everything the pool workers run lives here and only needs this module, encoders and audio. Where workers are spawned
+# rather than forked (Windows, macOS) each of them imports it, so it has to stay cheap to import.
+
+# The worker's encoder and its name, see init_worker
+encoder: Optional[encoders.Encoder] = None
+encoder_name: Optional[str] = None
+
+
+def init_worker(name: str, opus_args: List[str], log_level: int):
+    global encoder, encoder_name
+    encoder = encoders.create(name, opus_args)
+    encoder_name = name
+    configure_logging(log_level)
+
+
+def configure_logging(log_level: int, stream=sys.stdout):
+    logging.basicConfig(
+        stream=stream,
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=log_level,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def encode(src: str, dest: str, timeout: Optional[float] = None, args: Optional[List[str]] = None,
+           extra_outputs: Optional[List[encoders.Output]] = None) -> None:
+    encoder.encode_many(src, [(dest, encoder.args if args is None else args)] + (extra_outputs or []), timeout)
+
+
+class Result(NamedTuple):
+    """
+    What a pool worker reports about a migration.
+    """
+    elapsed: float
+    # Audio fingerprint of the source, if it was asked for
+    fingerprint: Optional[str] = None
+    # Version of the worker's encoder, which is what the output was encoded with. Workers on other hosts may have
+    # another one installed than the host that records it.
+    encoder_version: Optional[str] = None
+
+
+def run_migration(migrate: Callable[[str, str], None], src: str, dest: str, fingerprint: bool = False) -> Result:
+    """
+    Runs in a pool worker, returns how long the migration took. The fingerprint is read right before, so the
+    migration reads the source from the page cache.
+    """
+    source_hash = audio.fingerprint(src) if fingerprint else None
+    start = time.monotonic()
+    migrate(src, dest)
+    return Result(time.monotonic() - start, source_hash,
+                  encoders.version(encoder_name) if encoder_name is not None else None)
+
+
+def run_migrations(migrations: List[Tuple[Callable[[str, str], None], str, str, bool]]) \
+        -> List[Tuple[Optional[Result], Optional[BaseException]]]:
+    """
+    Runs (migrate, src, dest, fingerprint) migrations one after the other in the same pool worker. Returns the
+    result of each or why it failed, a failed one doesn't keep the others from running.
+    """
+    results = []
+    for migration in migrations:
+        try:
+            results.append((run_migration(*migration), None))
+        except Exception as e:
+            results.append((None, e))
+    return results